@@ -1,4 +1,5 @@
 import os
+import math
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
@@ -15,21 +16,110 @@ def load_user(user_id):
     from models import Admin
     return Admin.query.get(int(user_id))
 
-def create_app():
+def create_app(config=None):
+    """Build the app; config overrides the environment-derived settings."""
     app = Flask(__name__)
     
+    from utils.uploads import UploadRequest
+    app.request_class = UploadRequest
+    
     # Config
     app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY", "default-secret-key")
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL")
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.config['UPLOAD_FOLDER'] = '/tmp/zsign_uploads'
+    app.config['UPLOAD_FOLDER'] = os.environ.get("UPLOAD_FOLDER", '/tmp/zsign_uploads')
     app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
+    app.config['SIGNED_FOLDER'] = os.environ.get("SIGNED_FOLDER", '/tmp/zsign_signed')
+    app.config['ARTIFACT_TTL'] = int(os.environ.get("ARTIFACT_TTL", 7 * 24 * 60 * 60))  # seconds a signed IPA stays downloadable
+    app.config['ARTIFACT_MAX_BYTES'] = int(os.environ.get("ARTIFACT_MAX_BYTES", 20 * 1024 * 1024 * 1024))  # oldest are removed beyond this; 0 for no limit
+    app.config['ARTIFACT_SWEEP_INTERVAL'] = int(os.environ.get("ARTIFACT_SWEEP_INTERVAL", 5 * 60))  # seconds
+    app.config['UPLOAD_SESSION_TTL'] = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 60 * 60))  # seconds
+    app.config['SIGNED_CACHE_FOLDER'] = os.environ.get("SIGNED_CACHE_FOLDER", '/tmp/zsign_cache/signed')
+    app.config['SIGNED_CACHE_MAX_BYTES'] = int(os.environ.get("SIGNED_CACHE_MAX_BYTES", 5 * 1024 * 1024 * 1024))  # 0 disables the cache
+    app.config['BUNDLE_CACHE_FOLDER'] = os.environ.get("BUNDLE_CACHE_FOLDER", '/tmp/zsign_cache/bundles')
+    app.config['BUNDLE_CACHE_MAX_BYTES'] = int(os.environ.get("BUNDLE_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024))  # 0 disables the cache
+    app.config['CREDENTIAL_CACHE_SIZE'] = int(os.environ.get("CREDENTIAL_CACHE_SIZE", 256))
+    app.config['DYLIB_FOLDER'] = os.environ.get("DYLIB_FOLDER", '/tmp/zsign_dylibs')
+    app.config['BLOB_FOLDER'] = os.environ.get("BLOB_FOLDER", '/tmp/zsign_blobs')  # same filesystem as UPLOAD_FOLDER for hard links
+    app.config['BLOB_TTL'] = int(os.environ.get("BLOB_TTL", 24 * 60 * 60))  # seconds since last use; 0 disables the blob store
+    app.config['RATE_LIMIT_STORE'] = os.environ.get("RATE_LIMIT_STORE", '/tmp/zsign_ratelimit.sqlite')  # 'memory' for a single process
+    app.config['RATE_LIMIT_WINDOW'] = int(os.environ.get("RATE_LIMIT_WINDOW", 24 * 60 * 60))  # seconds
+    app.config['RATE_LIMIT_FLUSH_INTERVAL'] = int(os.environ.get("RATE_LIMIT_FLUSH_INTERVAL", 30))  # seconds
+    app.config['KEY_CACHE_TTL'] = int(os.environ.get("KEY_CACHE_TTL", 30))  # seconds
+    app.config['KEY_CACHE_SIZE'] = int(os.environ.get("KEY_CACHE_SIZE", 10000))
+    app.config['KEY_CACHE_REVALIDATE'] = int(os.environ.get("KEY_CACHE_REVALIDATE", 2))  # seconds before other workers see a disabled key
+    app.config['ZSIGN_PATH'] = os.environ.get("ZSIGN_PATH", '/tmp/zsign/zsign')
+    app.config['ZSIGN_SHA256'] = os.environ.get("ZSIGN_SHA256")  # pin the binary; unset skips the check
+    app.config['ZSIGN_INSTALL_URL'] = os.environ.get("ZSIGN_INSTALL_URL", 'https://github.com/gyke69/compiled-zsign.git')
+    app.config['ZSIGN_INSTALL_REF'] = os.environ.get("ZSIGN_INSTALL_REF")  # commit to fetch; unset fetches the default branch once and pins the checksum of what it got
+    app.config['ZSIGN_SMOKE_IPA'] = os.environ.get("ZSIGN_SMOKE_IPA")  # IPA for the smoke sign; unset generates a tiny one
+    app.config['ZSIGN_RECHECK_INTERVAL'] = int(os.environ.get("ZSIGN_RECHECK_INTERVAL", 60))  # seconds between background re-verifications; 0 checks only at startup
+    app.config['ZSIGN_WARMUP'] = os.environ.get("ZSIGN_WARMUP", "1") == "1"
+    app.config['SIGNING_WORKERS'] = int(os.environ.get("SIGNING_WORKERS", os.cpu_count() or 1))  # zsign runs at once across all web workers
+    app.config['SIGNING_PROCESS_WORKERS'] = int(os.environ.get("SIGNING_PROCESS_WORKERS", math.ceil(app.config['SIGNING_WORKERS'] / int(os.environ.get("WEB_WORKERS", 2)))))  # pool size of each web worker
+    app.config['SIGNING_LEDGER'] = os.environ.get("SIGNING_LEDGER", '/tmp/zsign_slots.sqlite')  # running slots shared by web workers; 'memory' for a single process
+    app.config['SIGNING_RESERVED_WORKERS'] = int(os.environ.get("SIGNING_RESERVED_WORKERS", app.config['SIGNING_WORKERS'] // 4))  # kept for enterprise keys
+    app.config['SIGNING_BACKLOG_LIMIT'] = int(os.environ.get("SIGNING_BACKLOG_LIMIT", app.config['SIGNING_WORKERS'] * 8))  # queued regular or premium jobs per process
+    app.config['ZSIGN_TIMEOUT'] = int(os.environ.get("ZSIGN_TIMEOUT", 10 * 60))  # seconds per zsign run, then its process group is killed
+    app.config['ZSIGN_MAX_MEMORY'] = int(os.environ.get("ZSIGN_MAX_MEMORY", 4 * 1024 * 1024 * 1024))  # address space in bytes; 0 for no limit
+    app.config['ZSIGN_MAX_FILE_SIZE'] = int(os.environ.get("ZSIGN_MAX_FILE_SIZE", 4 * 1024 * 1024 * 1024))  # bytes per file zsign writes; 0 for no limit
+    app.config['ZSIGN_MAX_OPEN_FILES'] = int(os.environ.get("ZSIGN_MAX_OPEN_FILES", 1024))  # 0 for no limit
+    app.config['ZSIGN_NICE'] = os.environ.get("ZSIGN_NICE", 'regular=10 premium=5 enterprise=0')  # niceness per tier
+    app.config['ZSIGN_CPUS'] = os.environ.get("ZSIGN_CPUS", '')  # CPUs per tier, e.g. 'regular=0-1 premium=0-3'; unset tiers may use any
+    app.config['SIGNING_MIN_FREE_BYTES'] = int(os.environ.get("SIGNING_MIN_FREE_BYTES", 1024 * 1024 * 1024))  # left free on the upload disk after extracting
+    app.config['JOB_HEARTBEAT_INTERVAL'] = int(os.environ.get("JOB_HEARTBEAT_INTERVAL", 15))  # seconds between refreshes of a queued job's heartbeat
+    app.config['JOB_ORPHAN_AFTER'] = int(os.environ.get("JOB_ORPHAN_AFTER", 90))  # seconds without a heartbeat before a job is failed as orphaned
+    app.config['BATCH_RESULT_TIMEOUT'] = int(os.environ.get("BATCH_RESULT_TIMEOUT", app.config['ZSIGN_TIMEOUT'] + app.config['JOB_ORPHAN_AFTER'] + 5 * 60))  # seconds without a finished item before a batch stream ends
+    app.config['REPACK_THREADS'] = int(os.environ.get("REPACK_THREADS", os.cpu_count() or 1))  # deflate threads per signed IPA
+    app.config['BATCH_MAX_ITEMS'] = int(os.environ.get("BATCH_MAX_ITEMS", 100))
+    app.config['BATCH_MAX_PARALLEL'] = int(os.environ.get("BATCH_MAX_PARALLEL", app.config['SIGNING_WORKERS']))  # per batch
+    app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")  # bearer token for /metrics; unset leaves it open
+    app.config['METRICS_FOLDER'] = os.environ.get("METRICS_FOLDER", '/tmp/zsign_metrics')  # shared by web workers; empty reports only the scraped one
+    app.config['METRICS_FLUSH_INTERVAL'] = int(os.environ.get("METRICS_FLUSH_INTERVAL", 10))  # seconds
+    app.config['WEBHOOK_TIMEOUT'] = int(os.environ.get("WEBHOOK_TIMEOUT", 10))  # seconds per delivery attempt
+    app.config['WEBHOOK_MAX_ATTEMPTS'] = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", 8))
+    app.config['WEBHOOK_BACKOFF'] = int(os.environ.get("WEBHOOK_BACKOFF", 30))  # seconds before the first retry, doubling after
+    app.config['WEBHOOK_MAX_BACKOFF'] = int(os.environ.get("WEBHOOK_MAX_BACKOFF", 6 * 60 * 60))  # seconds
+    app.config['WEBHOOK_POLL_INTERVAL'] = int(os.environ.get("WEBHOOK_POLL_INTERVAL", 5))  # seconds
+    app.config['WEBHOOK_CONCURRENCY'] = int(os.environ.get("WEBHOOK_CONCURRENCY", 4))
+    app.config['WEBHOOK_ALLOW_PRIVATE'] = os.environ.get("WEBHOOK_ALLOW_PRIVATE", "0") == "1"  # allow loopback and private addresses, for local testing
+    app.config['JOB_RETENTION_DAYS'] = int(os.environ.get("JOB_RETENTION_DAYS", 90))  # finished jobs older than this are archived
+    app.config['JOB_ARCHIVE_FOLDER'] = os.environ.get("JOB_ARCHIVE_FOLDER", os.path.join(app.instance_path, 'job_archive'))
+    if config:
+        app.config.update(config)
     
     # Initialize extensions
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'admin.login'
     
+    from utils.job_queue import signing_queue
+    from utils.signed_cache import signed_cache
+    from utils.artifacts import artifact_store
+    from utils.bundle_cache import bundle_cache
+    from utils.uploads import upload_store
+    from utils.credentials import credential_registry
+    from utils.dylib_store import dylib_store
+    from utils.blob_store import blob_store
+    from utils.rate_limit import rate_limiter
+    from utils.key_cache import key_cache
+    from utils.toolchain import toolchain
+    from utils.webhooks import webhooks
+    from utils.metrics import registry
+    signing_queue.init_app(app)
+    signed_cache.init_app(app)
+    artifact_store.init_app(app)
+    bundle_cache.init_app(app)
+    upload_store.init_app(app)
+    credential_registry.init_app(app)
+    dylib_store.init_app(app)
+    blob_store.init_app(app)
+    rate_limiter.init_app(app)
+    key_cache.init_app(app)
+    toolchain.init_app(app)
+    webhooks.init_app(app)
+    registry.init_app(app)
+    
     # Register blueprints
     from routes.admin import admin_bp
     from routes.api import api_bp
@@ -39,10 +129,19 @@ def create_app():
     app.register_blueprint(api_bp)
     app.register_blueprint(web_bp)
     
+    # CLI commands
+    from utils.rollups import rebuild_rollups_command
+    app.cli.add_command(rebuild_rollups_command)
+    from utils.retention import archive_jobs_command
+    app.cli.add_command(archive_jobs_command)
+    
     # Create upload directory
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
     with app.app_context():
         db.create_all()
+        # create_all leaves existing tables alone; add what newer models have on top
+        from utils.migrations import upgrade_schema
+        upgrade_schema()
         
     return app
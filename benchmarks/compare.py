@@ -0,0 +1,72 @@
+"""Compare two benchmark reports from benchmarks.load and flag regressions.
+
+    python -m benchmarks.compare results/base.json results/head.json --threshold 10
+
+Exits with status 1 when any tracked metric got worse by more than the
+threshold percentage.
+"""
+import sys
+import json
+import argparse
+
+# (path into results, True when a larger value is better)
+TRACKED = [
+    (('requests_per_second',), True),
+    (('latency_seconds', 'p50'), False),
+    (('latency_seconds', 'p95'), False),
+    (('latency_seconds', 'p99'), False),
+    (('admission_seconds', 'p95'), False),
+    (('disk_bytes_written',), False),
+    (('bytes_written_syscalls',), False),
+    (('peak_rss_bytes',), False),
+    (('peak_child_rss_bytes',), False)
+]
+
+
+def lookup(results, path):
+    for part in path:
+        if not isinstance(results, dict):
+            return None
+        results = results.get(part)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports.')
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=10, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    print(f"{'metric':32} {'base':>14} {'head':>14} {'change':>9}")
+    regressions = []
+    for path, higher_is_better in TRACKED:
+        name = '.'.join(path)
+        old = lookup(base['results'], path)
+        new = lookup(head['results'], path)
+        if not old or new is None:
+            print(f'{name:32} {str(old):>14} {str(new):>14} {"n/a":>9}')
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > args.threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:32} {old:>14.4g} {new:>14.4g} {change:>+8.1f}%{flag}')
+
+    if base.get('config') != head.get('config'):
+        print('\nWarning: the two runs used different configurations')
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed by more than {args.threshold}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Offline stand-in for zsign with a configurable CPU and I/O cost.
+
+Point ZSIGN_PATH at this file. It accepts the zsign arguments sign_ipa
+passes. A folder input is "signed" in place, rewriting the tail of the
+app's executable and its _CodeSignature the way a real signature does,
+and the input (or the zipped folder) is written to -o if given. Like
+zsign, it keeps a .zsign_cache in the directory it runs in. Cost is set
+through the environment:
+
+    BENCH_ZSIGN_CPU_MS     CPU time to burn per signing (default 200)
+    BENCH_ZSIGN_IO_PASSES  extra full reads of the input (default 1)
+    BENCH_ZSIGN_FAIL       exit with a zsign-style error on stderr, e.g. "password error"
+"""
+import os
+import sys
+import time
+import shutil
+import glob
+import hashlib
+import plistlib
+import zipfile
+
+VERSION = 'zsign version: 0.5 (benchmark stand-in)'
+VALUE_FLAGS = {'-k', '-c', '-p', '-m', '-o', '-z', '-l', '-b', '-n', '-r'}
+
+
+def parse(argv):
+    options = {}
+    positional = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in VALUE_FLAGS and i + 1 < len(argv):
+            options[arg] = argv[i + 1]
+            i += 2
+        else:
+            positional.append(arg)
+            i += 1
+    return options, positional
+
+
+def burn_cpu(milliseconds):
+    deadline = time.process_time() + milliseconds / 1000
+    digest = hashlib.sha256()
+    while time.process_time() < deadline:
+        digest.update(b'\0' * 65536)
+
+
+def read_all(path):
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+    for item in paths:
+        with open(item, 'rb') as f:
+            while f.read(1024 * 1024):
+                pass
+
+
+def sign_folder(folder, key):
+    apps = glob.glob(os.path.join(folder, 'Payload', '*.app'))
+    if not apps:
+        return
+    app = apps[0]
+    with open(os.path.join(app, 'Info.plist'), 'rb') as f:
+        executable = plistlib.load(f).get('CFBundleExecutable')
+    signature = hashlib.sha256(key.encode() + str(time.time()).encode()).digest() * 8
+    path = os.path.join(app, executable or '')
+    if executable and os.path.isfile(path):
+        with open(path, 'r+b') as f:
+            f.seek(max(0, os.path.getsize(path) - len(signature)))
+            f.write(signature)
+    os.makedirs(os.path.join(app, '_CodeSignature'), exist_ok=True)
+    with open(os.path.join(app, '_CodeSignature', 'CodeResources'), 'wb') as f:
+        f.write(plistlib.dumps({'signature': signature}))
+
+
+def write_cache(source):
+    # zsign caches per-file hashes of what it signed under its working directory
+    cache = os.path.join('.zsign_cache', hashlib.sha1(os.path.abspath(source).encode()).hexdigest())
+    os.makedirs(cache, exist_ok=True)
+    with open(os.path.join(cache, 'hashes'), 'wb') as f:
+        f.write(b'\0' * 4096)
+
+
+def write_output(source, output, level):
+    if not os.path.isdir(source):
+        shutil.copyfile(source, output)
+        return
+    compression = zipfile.ZIP_DEFLATED if level > 0 else zipfile.ZIP_STORED
+    with zipfile.ZipFile(output, 'w', compression, compresslevel=level or None) as archive:
+        for root, _, names in os.walk(source):
+            for name in names:
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, source))
+
+
+def main():
+    argv = sys.argv[1:]
+    if '-v' in argv:
+        print(VERSION)
+        return 0
+
+    options, positional = parse(argv)
+    if not positional or ('-o' not in options and not os.path.isdir(positional[-1])):
+        print('usage: zsign [-options] [-k privkey.pem] [-m dev.prov] [-o output.ipa] file|folder', file=sys.stderr)
+        return 1
+
+    failure = os.environ.get('BENCH_ZSIGN_FAIL')
+    if failure:
+        print(f'>>> {failure}!', file=sys.stderr)
+        return 1
+
+    source = positional[-1]
+    for _ in range(int(os.environ.get('BENCH_ZSIGN_IO_PASSES', 1))):
+        read_all(source)
+    burn_cpu(int(os.environ.get('BENCH_ZSIGN_CPU_MS', 200)))
+    if os.path.isdir(source):
+        sign_folder(source, options.get('-k', ''))
+    write_cache(source)
+    if '-o' in options:
+        write_output(source, options['-o'], int(options.get('-z', 9)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
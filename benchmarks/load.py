@@ -0,0 +1,261 @@
+"""Offline load test for POST /api/sign.
+
+Runs create_app() in this process against a throwaway SQLite database and
+the fake zsign, drives it from concurrent test clients, and writes the
+results as JSON:
+
+    python -m benchmarks.load --requests 200 --concurrency 8 --output results/base.json
+
+Each request uploads an IPA and, when it is queued, polls its job until
+it finishes, so latency covers the whole signing and not just admission.
+By default every request sends a different IPA so the signed cache never
+hits; --distinct-ipas 1 measures the cached path instead.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import platform
+import resource
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.synthetic_ipa import make_ipa, make_credentials, P12_PASSWORD
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_ZSIGN = os.path.join(BENCHMARK_DIR, 'fake_zsign.py')
+# Enterprise keys allow 1000 signings a day; stay clear of the limit
+REQUESTS_PER_KEY = 900
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def latency_summary(values):
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None
+    }
+
+
+def process_io():
+    """Return this process's I/O counters, including children it has reaped."""
+    try:
+        with open('/proc/self/io') as f:
+            return {name: int(value) for name, value in (line.split(': ') for line in f)}
+    except OSError:
+        return {}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_variant(base, dest, index):
+    """Copy base and add one unique entry so its hash, and its cache key, differ."""
+    shutil.copyfile(base, dest)
+    with zipfile.ZipFile(dest, 'a') as archive:
+        archive.writestr('Payload/Bench.app/variant', str(index))
+    return dest
+
+
+def configure(workdir, args):
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}",
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'ZSIGN_PATH': FAKE_ZSIGN,
+        'ZSIGN_INSTALL_URL': '',
+        'ZSIGN_WARMUP': '1',
+        'SIGNED_FOLDER': os.path.join(workdir, 'signed'),
+        'SIGNED_CACHE_FOLDER': os.path.join(workdir, 'cache', 'signed'),
+        'BUNDLE_CACHE_FOLDER': os.path.join(workdir, 'cache', 'bundles'),
+        'DYLIB_FOLDER': os.path.join(workdir, 'dylibs'),
+        'BLOB_FOLDER': os.path.join(workdir, 'blobs'),
+        'RATE_LIMIT_STORE': 'memory',
+        'SIGNING_WORKERS': str(args.workers),
+        # One process runs every signing here
+        'WEB_WORKERS': '1',
+        'SIGNING_LEDGER': 'memory',
+        'BENCH_ZSIGN_CPU_MS': str(args.zsign_cpu_ms),
+        'BENCH_ZSIGN_IO_PASSES': str(args.zsign_io_passes)
+    })
+    if not args.bundle_cache:
+        os.environ['BUNDLE_CACHE_MAX_BYTES'] = '0'
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='zsign-bench-')
+    configure(workdir, args)
+    os.chmod(FAKE_ZSIGN, 0o755)
+
+    from app import create_app, db
+    from models import APIKey
+    from utils.job_queue import signing_queue
+    from utils.rate_limit import rate_limiter
+    from utils.metrics import sign_phase_seconds
+
+    app = create_app()
+    with app.app_context():
+        # Enough keys that neither the daily limit nor the per-key scheduling caps shape the results
+        tier = APIKey(tier='enterprise')
+        count = max(
+            -(-args.requests // REQUESTS_PER_KEY),
+            -(-args.workers // tier.get_max_concurrent()),
+            -(-args.concurrency // tier.get_max_queued()),
+            1
+        )
+        keys = []
+        for index in range(count):
+            api_key = APIKey(key=APIKey.generate_key(), name=f'bench-{index}', tier='enterprise')
+            db.session.add(api_key)
+            keys.append(api_key.key)
+        db.session.commit()
+
+    inputs = os.path.join(workdir, 'inputs')
+    os.makedirs(inputs)
+    base = make_ipa(os.path.join(inputs, 'base.ipa'), int(args.ipa_size_mb * 1024 * 1024),
+                    args.ipa_files, args.compressible)
+    distinct = min(args.distinct_ipas or args.requests, args.requests)
+    ipas = [make_variant(base, os.path.join(inputs, f'{i}.ipa'), i) for i in range(distinct)]
+    p12_path, profile_path = make_credentials(inputs)
+    with open(p12_path, 'rb') as f:
+        p12 = f.read()
+    with open(profile_path, 'rb') as f:
+        profile = f.read()
+    ipa_bytes = os.path.getsize(ipas[0])
+
+    results = []
+    results_lock = threading.Lock()
+    local = threading.local()
+
+    def one_request(index):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        headers = {'X-API-Key': keys[index % len(keys)]}
+
+        start = time.perf_counter()
+        with open(ipas[index % distinct], 'rb') as ipa:
+            response = client.post('/api/sign', headers=headers, data={
+                'ipa': (ipa, 'bench.ipa'),
+                'p12': (io.BytesIO(p12), 'bench.p12'),
+                'mobileprovision': (io.BytesIO(profile), 'bench.mobileprovision'),
+                'p12_password': P12_PASSWORD
+            })
+        admitted = time.perf_counter()
+
+        status = 'rejected'
+        if response.status_code in (200, 202):
+            status = response.json['status']
+            status_url = response.json['status_url']
+            while status not in ('completed', 'failed'):
+                time.sleep(args.poll_interval)
+                status = client.get(status_url, headers=headers).json['status']
+        finished = time.perf_counter()
+
+        with results_lock:
+            results.append({
+                'status': status,
+                'http_status': response.status_code,
+                'admission': admitted - start,
+                'latency': finished - start
+            })
+
+    io_before = process_io()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one_request, range(args.requests)))
+    wall = time.perf_counter() - started
+
+    # Reap the pool workers so their I/O and peak RSS reach this process's counters
+    signing_queue.shutdown(wait=True)
+    rate_limiter.shutdown()
+    io_after = process_io()
+
+    completed = [r for r in results if r['status'] == 'completed']
+    phases = {key[0]: {'count': count, 'total_seconds': total}
+              for key, (count, total) in sign_phase_seconds.totals().items()}
+    report = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'config': dict(
+            {name: value for name, value in vars(args).items() if name not in ('output', 'keep')},
+            ipa_bytes=ipa_bytes,
+            distinct_ipas=distinct
+        ),
+        'results': {
+            'requests': len(results),
+            'completed': len(completed),
+            'failed': sum(1 for r in results if r['status'] == 'failed'),
+            'rejected': sum(1 for r in results if r['status'] == 'rejected'),
+            'wall_seconds': wall,
+            'requests_per_second': len(completed) / wall if wall else None,
+            'latency_seconds': latency_summary([r['latency'] for r in completed]),
+            'admission_seconds': latency_summary([r['admission'] for r in results]),
+            'disk_bytes_written': io_after.get('write_bytes', 0) - io_before.get('write_bytes', 0) if io_after else None,
+            'bytes_written_syscalls': io_after.get('wchar', 0) - io_before.get('wchar', 0) if io_after else None,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'peak_child_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            'phases': phases
+        }
+    }
+
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for POST /api/sign.')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='SIGNING_WORKERS')
+    parser.add_argument('--ipa-size-mb', type=float, default=20)
+    parser.add_argument('--ipa-files', type=int, default=200)
+    parser.add_argument('--compressible', type=float, default=0.5)
+    parser.add_argument('--distinct-ipas', type=int, default=0, help='0 sends a different IPA every request')
+    parser.add_argument('--zsign-cpu-ms', type=int, default=200)
+    parser.add_argument('--zsign-io-passes', type=int, default=1)
+    parser.add_argument('--no-bundle-cache', dest='bundle_cache', action='store_false')
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary work directory')
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    return 0 if report['results']['completed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""Generate synthetic IPAs, and a P12 and profile that can sign them, for benchmarking.
+
+    python -m benchmarks.synthetic_ipa out.ipa --size-mb 200 --files 2000
+"""
+import os
+import random
+import zipfile
+import argparse
+import plistlib
+
+BUNDLE_NAME = 'Bench.app'
+P12_PASSWORD = 'bench'
+
+
+def make_ipa(path, size, files, compressible=0.5, seed=0, bundle_id='com.example.bench'):
+    """Write an IPA of roughly size bytes spread over files entries and return its path.
+
+    compressible is the fraction of each file that is zeros rather than
+    random bytes, which controls how much work deflate has to do. The
+    same seed always produces the same bytes.
+    """
+    rng = random.Random(seed)
+    files = max(2, files)
+    per_file = max(1, size // files)
+    root = f'Payload/{BUNDLE_NAME}'
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+        archive.writestr(f'{root}/Info.plist', plistlib.dumps({
+            'CFBundleIdentifier': bundle_id,
+            'CFBundleName': 'Bench',
+            'CFBundleExecutable': 'Bench',
+            'CFBundleShortVersionString': '1.0',
+            'CFBundleVersion': str(seed)
+        }))
+        for index in range(files - 1):
+            name = 'Bench' if index == 0 else f'Resources/{index // 100:03d}/asset-{index}.bin'
+            random_part = int(per_file * (1 - compressible))
+            data = rng.randbytes(random_part) + bytes(per_file - random_part)
+            archive.writestr(f'{root}/{name}', data)
+    return path
+
+
+def make_credentials(folder, password=P12_PASSWORD):
+    """Write a self-signed P12 and a matching wildcard profile and return their paths.
+
+    They pass the service's inspection of sign requests, which garbage
+    files would not.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    from utils.toolchain import write_smoke_credentials
+
+    paths = write_smoke_credentials(folder)
+    with open(paths['key'], 'rb') as f:
+        key = serialization.load_pem_private_key(f.read(), None)
+    with open(paths['cert'], 'rb') as f:
+        certificate = x509.load_pem_x509_certificate(f.read())
+    p12_path = os.path.join(folder, 'bench.p12')
+    with open(p12_path, 'wb') as f:
+        f.write(pkcs12.serialize_key_and_certificates(
+            b'bench', key, certificate, None,
+            serialization.BestAvailableEncryption(password.encode())
+        ))
+    return p12_path, paths['profile']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output')
+    parser.add_argument('--size-mb', type=float, default=50)
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--compressible', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    make_ipa(args.output, int(args.size_mb * 1024 * 1024), args.files, args.compressible, args.seed)
+    print(f'Wrote {args.output} ({os.path.getsize(args.output)} bytes)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
+import sys
+
 from utils.discord_bot import run_bot
 
 if __name__ == '__main__':
-    run_bot()
+    sys.exit(run_bot())
@@ -0,0 +1,69 @@
+import os
+import logging
+
+# Gunicorn settings for the web tier; main.py starts it with this file.
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+wsgi_app = 'wsgi:app'
+
+# Create the app, check the database and verify zsign once in the master, then fork
+preload_app = True
+workers = int(os.environ.get('WEB_WORKERS', 2))
+# Threads keep a slow upload from blocking a whole worker
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+# Uploads of a few hundred MB can take a while on slow links
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+# How long a stopping worker may spend finishing its queued signings: longer than one zsign
+# run (ZSIGN_TIMEOUT) plus extracting and repacking around it. Jobs still queued when it runs
+# out are failed by the other workers once their heartbeat goes stale.
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', int(os.environ.get('ZSIGN_TIMEOUT', 600)) + 300))
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    from wsgi import app
+    from app import db
+    from utils.webhooks import webhooks
+    from utils.artifacts import artifact_store
+    from utils.metrics import registry
+    from utils.job_queue import signing_queue
+    from utils.toolchain import toolchain
+    # Connections opened by the master while preloading must not be shared with the worker
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # Picks up webhook retries left by earlier workers
+    webhooks.start()
+    artifact_store.start()
+    registry.start()
+    # Keeps this worker's jobs alive and fails the ones a dead worker left behind
+    signing_queue.start()
+    # Re-verifies zsign off the request path
+    toolchain.start()
+
+
+def worker_exit(server, worker):
+    from utils.job_queue import signing_queue
+    from utils.rate_limit import rate_limiter
+    from utils.webhooks import webhooks
+    from utils.artifacts import artifact_store
+    from utils.metrics import registry
+    from utils.toolchain import toolchain
+    log = logging.getLogger('gunicorn.error')
+    pending = signing_queue.pending()
+    if pending:
+        log.info(f'Worker {worker.pid} finishing {pending} queued signing job(s) before exit')
+    # Runs every job already accepted by this worker, then writes out usage counters
+    signing_queue.shutdown(wait=True)
+    rate_limiter.shutdown()
+    # Deliveries still pending are sent by the other workers
+    webhooks.shutdown()
+    artifact_store.shutdown()
+    toolchain.shutdown()
+    # Last, so the jobs finished above are in the values left for the other workers
+    registry.shutdown()
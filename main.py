@@ -1,15 +1,134 @@
-from app import create_app
-from utils.discord_bot import run_bot
-import threading
+"""Production entry point: the gunicorn web tier and the Discord bot as supervised processes.
 
-def run_flask_app():
-    app = create_app()
-    app.run(host='0.0.0.0', port=5000)
+    python main.py          web and bot (bot only when DISCORD_BOT_TOKEN is set)
+    python main.py web      web only
+    python main.py bot      bot only
 
-if __name__ == '__main__':
-    # Start the Flask app in a separate thread
-    flask_thread = threading.Thread(target=run_flask_app)
-    flask_thread.start()
+A process that exits unexpectedly is restarted with backoff. SIGTERM or
+SIGINT is passed on to both, and gunicorn lets each worker finish its
+accepted signings before exiting.
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import logging
+import subprocess
+
+logger = logging.getLogger('supervisor')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+COMMANDS = {
+    'web': [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py')],
+    'bot': [sys.executable, os.path.join(ROOT, 'discord_bot_runner.py')]
+}
+# A process that stays up this long has its restart backoff reset
+STABLE_AFTER = 60
+MAX_BACKOFF = 60
+
+
+def recover():
+    """Clean up after a previous run that was killed before its workers drained.
+
+    Runs before any web worker starts, so every unfinished job, job
+    workspace on disk and signing slot in the ledger belongs to a process
+    that no longer exists.
+    """
+    from app import create_app
+    from utils.job_queue import fail_interrupted_jobs
+    from utils.rate_limit import rate_limiter
+    from utils.scheduler import SQLiteSlots
+
+    app = create_app({'ZSIGN_WARMUP': False})
+    with app.app_context():
+        failed = fail_interrupted_jobs()
+    rate_limiter.shutdown()
+    if failed:
+        logger.warning(f'Marked {failed} interrupted signing job(s) as failed')
+
+    # A new process can reuse a dead worker's pid, which would keep its slots held
+    ledger = app.config['SIGNING_LEDGER']
+    if ledger != 'memory':
+        SQLiteSlots(ledger).clear()
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    for entry in os.scandir(upload_folder):
+        if entry.is_dir() and entry.name.startswith(('job-', 'test-', 'batch-')):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+class Supervisor:
+    def __init__(self, names):
+        self.names = names
+        self.processes = {}
+        self.started_at = {}
+        self.failures = {name: 0 for name in names}
+        self.restart_at = {}
+        self.stopping = False
 
-    # Start the Discord bot
-    run_bot()
\ No newline at end of file
+    def start(self, name):
+        logger.info(f'Starting {name}')
+        self.processes[name] = subprocess.Popen(COMMANDS[name], cwd=ROOT)
+        self.started_at[name] = time.monotonic()
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info('Shutting down; waiting for workers to finish their signings')
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for name in self.names:
+            self.start(name)
+
+        while not self.stopping:
+            time.sleep(1)
+            now = time.monotonic()
+            for name in self.names:
+                if name in self.restart_at:
+                    if now >= self.restart_at[name] and not self.stopping:
+                        del self.restart_at[name]
+                        self.start(name)
+                    continue
+
+                code = self.processes[name].poll()
+                if code is None:
+                    continue
+                if now - self.started_at[name] >= STABLE_AFTER:
+                    self.failures[name] = 0
+                delay = min(MAX_BACKOFF, 2 ** self.failures[name])
+                self.failures[name] += 1
+                logger.error(f'{name} exited with status {code}; restarting in {delay}s')
+                self.restart_at[name] = now + delay
+
+        # Gunicorn enforces its own graceful_timeout on the workers
+        for process in self.processes.values():
+            process.wait()
+        return 0
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)s %(message)s')
+    names = sys.argv[1:] or ['web'] + (['bot'] if os.environ.get('DISCORD_BOT_TOKEN') else [])
+    unknown = [name for name in names if name not in COMMANDS]
+    if unknown:
+        print(f"Unknown process {', '.join(unknown)}; choose from {', '.join(COMMANDS)}", file=sys.stderr)
+        return 2
+    # Restarting can't make a missing token appear
+    if 'bot' in names and not os.environ.get('DISCORD_BOT_TOKEN'):
+        print('The bot needs DISCORD_BOT_TOKEN set', file=sys.stderr)
+        return 2
+
+    if 'web' in names:
+        recover()
+    return Supervisor(names).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 from datetime import datetime
+from sqlalchemy.orm import declared_attr
 from app import db
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -18,12 +19,16 @@ class Admin(UserMixin, db.Model):
 class APIKey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(64), unique=True, nullable=False)
-    name = db.Column(db.String(100), nullable=False)
-    tier = db.Column(db.String(20), nullable=False)  # 'regular', 'premium', or 'enterprise'
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    name = db.Column(db.String(100), nullable=False, index=True)
+    tier = db.Column(db.String(20), nullable=False, index=True)  # 'regular', 'premium', or 'enterprise'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     last_used = db.Column(db.DateTime)
     daily_usage = db.Column(db.Integer, default=0)
     is_active = db.Column(db.Boolean, default=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # last change to what KeyCache holds
+    discord_user_id = db.Column(db.BigInteger, unique=True, index=True)  # owner of a free key from the Discord bot
+    webhook_url = db.Column(db.String(2048))  # receives every finished job unless the request names its own
+    webhook_secret = db.Column(db.String(64))  # HMAC key for webhook signatures
 
     @staticmethod
     def generate_key():
@@ -37,12 +42,130 @@ class APIKey(db.Model):
         }
         return limits.get(self.tier, 10)
 
+    def get_max_concurrent(self):
+        """Signings of this key that may run at the same time."""
+        limits = {
+            'regular': 1,
+            'premium': 2,
+            'enterprise': 4
+        }
+        return limits.get(self.tier, 1)
+
+    def get_max_queued(self):
+        """Unfinished jobs this key may have before new sign requests are turned away."""
+        limits = {
+            'regular': 3,
+            'premium': 10,
+            'enterprise': 50
+        }
+        return limits.get(self.tier, 3)
+
+    def get_zip_level(self):
+        """Default deflate level of this key's signed IPAs; lower builds faster, higher downloads smaller."""
+        levels = {
+            'regular': 6,
+            'premium': 4,
+            'enterprise': 1
+        }
+        return levels.get(self.tier, 6)
+
 class SigningJob(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id'), nullable=False)
-    status = db.Column(db.String(20), nullable=False)  # 'pending', 'processing', 'completed', 'failed'
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, index=True)  # 'pending', 'processing', 'completed', 'failed'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    started_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
     input_file = db.Column(db.String(255))
     output_file = db.Column(db.String(255))
+    cache_hit = db.Column(db.Boolean)  # None when the signed cache was not consulted
     error_message = db.Column(db.Text)
+    callback_url = db.Column(db.String(2048))  # per-request webhook, overrides the key's
+    zsign_wall_time = db.Column(db.Float)  # seconds
+    zsign_cpu_time = db.Column(db.Float)  # seconds
+    zsign_peak_rss = db.Column(db.BigInteger)  # bytes
+    kill_reason = db.Column(db.String(32))  # e.g. 'timeout' or 'file_size' when zsign was killed
+    duration = db.Column(db.Float, index=True)  # seconds from the request being received to the job finishing
+    trace = db.Column(db.Text)  # JobTrace JSON, see utils/trace.py
+    usage_event_id = db.Column(db.Integer)  # the rate limiter use refunded if the job fails
+    worker_pid = db.Column(db.Integer)  # web worker whose queue holds the job
+    heartbeat_at = db.Column(db.DateTime)  # refreshed by that worker until the job finishes
+
+    api_key = db.relationship('APIKey')
+
+class WebhookDelivery(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id'), nullable=False, index=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('signing_job.id'), nullable=False, index=True)
+    url = db.Column(db.String(2048), nullable=False)
+    event = db.Column(db.String(32), nullable=False)  # 'job.completed' or 'job.failed'
+    payload = db.Column(db.Text, nullable=False)  # exact JSON body, signed at send time
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'delivered', 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    last_status_code = db.Column(db.Integer)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime)
+
+    api_key = db.relationship('APIKey')
+
+class SigningCredential(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id'), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    certificate_name = db.Column(db.String(255))
+    certificate_serial = db.Column(db.String(64))
+    team_id = db.Column(db.String(20))
+    profile_name = db.Column(db.String(255))
+    bundle_id = db.Column(db.String(255))  # pattern from the profile, e.g. 'com.example.*'
+    expires_at = db.Column(db.DateTime, nullable=False)  # earliest of certificate and profile expiry
+    p12_sha256 = db.Column(db.String(64), nullable=False)
+    profile_sha256 = db.Column(db.String(64), nullable=False)
+    key_material = db.Column(db.LargeBinary, nullable=False)  # unlocked key + cert PEM, encrypted with SECRET_KEY
+    profile = db.Column(db.LargeBinary, nullable=False)
+
+class Dylib(db.Model):
+    """A dylib an API key has uploaded; the file itself is shared by sha256 in the dylib store."""
+    id = db.Column(db.Integer, primary_key=True)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id'), nullable=False, index=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    filename = db.Column(db.String(255))
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('api_key_id', 'sha256'),)
+
+class Blob(db.Model):
+    """An API key's reference to an uploaded signing input; the file itself is shared by sha256 in the blob store."""
+    id = db.Column(db.Integer, primary_key=True)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id'), nullable=False, index=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    filename = db.Column(db.String(255))
+    size = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # expires BLOB_TTL after this
+
+    __table_args__ = (db.UniqueConstraint('api_key_id', 'sha256'),)
+
+class JobRollupMixin:
+    """Job counts per time bucket, API key, the key's tier at the time and final status, kept up to date as jobs finish."""
+    id = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime, nullable=False)  # start of the hour or day the job was created in
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_key.id'), nullable=False)
+    tier = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # 'completed' or 'failed'
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    @declared_attr
+    def __table_args__(cls):
+        # A key that changes tier within a bucket gets a row per tier
+        return (db.UniqueConstraint('bucket', 'api_key_id', 'tier', 'status',
+                                    name=f'uq_{cls.__tablename__}_bucket_key_tier_status'),)
+
+class HourlyJobRollup(JobRollupMixin, db.Model):
+    pass
+
+class DailyJobRollup(JobRollupMixin, db.Model):
+    pass
@@ -1,17 +1,31 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, session
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, session, current_app, stream_with_context
 from flask_login import login_user, login_required, logout_user, current_user
-from models import Admin, APIKey, SigningJob, db
+from models import Admin, APIKey, SigningJob, HourlyJobRollup, DailyJobRollup, db
 from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
 from sqlalchemy import func
 import logging
+import json
 import os
+import re
 from utils.signing import sign_ipa
+from utils.artifacts import artifact_store, send_artifact
+from utils.uploads import save_upload
+from utils.workspace import Workspace
+from utils.key_cache import key_cache
+from utils.rollups import day_bucket, hour_bucket
+from utils.toolchain import toolchain
+from utils.job_queue import signing_queue
+from utils.pagination import keyset_page
+from utils.trace import PHASES, phase_times
+from utils.retention import job_record
 from functools import wraps
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/albos')
 
+# Names the test page stores its results under; anything else is not a test result
+TEST_ARTIFACT_PATTERN = re.compile(r'^test-[A-Za-z0-9_]+\.ipa$')
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -31,8 +45,8 @@ def verify_enterprise_key():
         flash('API key is required', 'danger')
         return redirect(url_for('admin.analytics'))
 
-    key = APIKey.query.filter_by(key=api_key, tier='enterprise', is_active=True).first()
-    if not key:
+    key = key_cache.resolve(api_key)
+    if not key or key.tier != 'enterprise':
         flash('Invalid or non-enterprise API key', 'danger')
         return redirect(url_for('admin.analytics'))
 
@@ -75,63 +89,260 @@ def logout():
     flash('You have been logged out', 'info')
     return redirect(url_for('admin.login'))
 
+KEY_SORTS = {
+    'created': APIKey.created_at,
+    'name': APIKey.name,
+    'tier': APIKey.tier
+}
+JOB_SORTS = {
+    'created': SigningJob.created_at,
+    'status': SigningJob.status
+}
+JOB_STATUSES = ('pending', 'processing', 'completed', 'failed')
+# Slowest first, by the whole job or by zsign alone
+TRACE_SORTS = {
+    'duration': SigningJob.duration,
+    'zsign': SigningJob.zsign_wall_time
+}
+TRACE_WINDOWS = (1, 7, 30)  # days
+PAGE_SIZE = 50
+EXPORT_BATCH_SIZE = 500
+
+def listing_args(sorts):
+    """Read the shared search, sort and cursor query parameters of an admin listing."""
+    sort = request.args.get('sort', 'created')
+    if sort not in sorts:
+        sort = 'created'
+    return {
+        'q': request.args.get('q', '').strip(),
+        'sort': sort,
+        'order': 'asc' if request.args.get('order') == 'asc' else 'desc',
+        'after': request.args.get('after'),
+        'before': request.args.get('before')
+    }
+
 @admin_bp.route('/dashboard')
 @login_required
 def dashboard():
-    api_keys = APIKey.query.all()
-    return render_template('admin/dashboard.html', api_keys=api_keys)
+    args = listing_args(KEY_SORTS)
+    query = APIKey.query
+    if args['q']:
+        # Prefix match on the name, or the exact key
+        query = query.filter(db.or_(APIKey.name.ilike(f"{args['q']}%"), APIKey.key == args['q']))
+        
+    page = keyset_page(
+        query,
+        KEY_SORTS[args['sort']],
+        APIKey.id,
+        descending=args['order'] == 'desc',
+        after=args['after'],
+        before=args['before'],
+        per_page=PAGE_SIZE
+    )
+    return render_template('admin/dashboard.html',
+                         api_keys=page.items,
+                         page=page,
+                         args=args,
+                         sorts=KEY_SORTS,
+                         key_cache_stats=key_cache.stats())
+
+@admin_bp.route('/jobs')
+@login_required
+def jobs():
+    args = listing_args(JOB_SORTS)
+    args['status'] = request.args.get('status') if request.args.get('status') in JOB_STATUSES else ''
+    args['key_id'] = request.args.get('key_id', type=int)
+    
+    query = SigningJob.query.options(db.joinedload(SigningJob.api_key))
+    if args['status']:
+        query = query.filter(SigningJob.status == args['status'])
+    if args['key_id']:
+        query = query.filter(SigningJob.api_key_id == args['key_id'])
+    if args['q']:
+        if args['q'].isdigit():
+            query = query.filter(SigningJob.id == int(args['q']))
+        else:
+            query = query.filter(SigningJob.input_file.ilike(f"{args['q']}%"))
+            
+    page = keyset_page(
+        query,
+        JOB_SORTS[args['sort']],
+        SigningJob.id,
+        descending=args['order'] == 'desc',
+        after=args['after'],
+        before=args['before'],
+        per_page=PAGE_SIZE
+    )
+    return render_template('admin/jobs.html',
+                         jobs=page.items,
+                         page=page,
+                         args=args,
+                         sorts=JOB_SORTS,
+                         statuses=JOB_STATUSES,
+                         retention_days=current_app.config['JOB_RETENTION_DAYS'])
+
+def trace_query():
+    """Read the traces filters and return (args, finished jobs with a trace that match them)."""
+    args = listing_args(TRACE_SORTS)
+    if args['sort'] not in TRACE_SORTS:
+        args['sort'] = 'duration'
+    args['status'] = request.args.get('status') if request.args.get('status') in ('completed', 'failed') else ''
+    args['key_id'] = request.args.get('key_id', type=int)
+    days = request.args.get('days', type=int)
+    args['days'] = days if days in TRACE_WINDOWS else TRACE_WINDOWS[0]
+
+    column = TRACE_SORTS[args['sort']]
+    query = SigningJob.query.filter(
+        column.isnot(None),
+        SigningJob.trace.isnot(None),
+        SigningJob.created_at >= datetime.utcnow() - timedelta(days=args['days'])
+    )
+    if args['status']:
+        query = query.filter(SigningJob.status == args['status'])
+    if args['key_id']:
+        query = query.filter(SigningJob.api_key_id == args['key_id'])
+    if args['q']:
+        if args['q'].isdigit():
+            query = query.filter(SigningJob.id == int(args['q']))
+        else:
+            query = query.filter(SigningJob.input_file.ilike(f"{args['q']}%"))
+    return args, query
+
+@admin_bp.route('/traces')
+@login_required
+def traces():
+    args, query = trace_query()
+    page = keyset_page(
+        query.options(db.joinedload(SigningJob.api_key)),
+        TRACE_SORTS[args['sort']],
+        SigningJob.id,
+        descending=args['order'] == 'desc',
+        after=args['after'],
+        before=args['before'],
+        per_page=PAGE_SIZE
+    )
+    rows = []
+    for job in page.items:
+        trace = json.loads(job.trace)
+        rows.append((job, trace, phase_times(trace['events'])))
+    return render_template('admin/traces.html',
+                         rows=rows,
+                         page=page,
+                         args=args,
+                         sorts=TRACE_SORTS,
+                         windows=TRACE_WINDOWS,
+                         phases=[name for name, _, _ in PHASES])
+
+@admin_bp.route('/traces/export')
+@login_required
+def export_traces():
+    """Stream the filtered traces, slowest first, as JSON lines with each job's columns."""
+    args, query = trace_query()
+    column = TRACE_SORTS[args['sort']]
+    query = query.order_by(column.desc() if args['order'] == 'desc' else column.asc(), SigningJob.id)
+
+    def generate():
+        for job in query.yield_per(EXPORT_BATCH_SIZE):
+            record = job_record(job)
+            record['trace'] = json.loads(job.trace)
+            record['phases'] = phase_times(record['trace']['events'])
+            yield json.dumps(record) + '\n'
+
+    filename = f"traces-{datetime.utcnow():%Y%m%d-%H%M}.jsonl"
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
 
 @admin_bp.route('/analytics')
 @enterprise_required
 def analytics():
     # Get data for the past 7 days
     end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=7)
+    start_date = day_bucket(end_date - timedelta(days=7))
     
-    # Daily signing requests
-    daily_jobs = db.session.query(
-        func.date(SigningJob.created_at).label('date'),
-        func.count(SigningJob.id).label('count')
+    # Daily signing requests, read from the rollups instead of SigningJob
+    daily_jobs = dict(db.session.query(
+        DailyJobRollup.bucket,
+        func.sum(DailyJobRollup.count)
     ).filter(
-        SigningJob.created_at >= start_date
+        DailyJobRollup.bucket >= start_date
     ).group_by(
-        func.date(SigningJob.created_at)
-    ).order_by(
-        func.date(SigningJob.created_at)
-    ).all()
+        DailyJobRollup.bucket
+    ).all())
     
     dates = []
     daily_counts = []
     current_date = start_date
-    while current_date.date() <= end_date.date():
+    while current_date <= end_date:
         dates.append(current_date.strftime('%Y-%m-%d'))
-        count = next((job.count for job in daily_jobs if job.date == current_date.date()), 0)
-        daily_counts.append(count)
+        daily_counts.append(daily_jobs.get(current_date, 0))
         current_date += timedelta(days=1)
     
-    # API key usage distribution
+    # Hourly signing requests over the last 24 hours
+    start_hour = hour_bucket(end_date - timedelta(hours=23))
+    hourly_jobs = dict(db.session.query(
+        HourlyJobRollup.bucket,
+        func.sum(HourlyJobRollup.count)
+    ).filter(
+        HourlyJobRollup.bucket >= start_hour
+    ).group_by(
+        HourlyJobRollup.bucket
+    ).all())
+    hours = [start_hour + timedelta(hours=i) for i in range(24)]
+    hour_labels = [hour.strftime('%H:00') for hour in hours]
+    hourly_counts = [hourly_jobs.get(hour, 0) for hour in hours]
+    
+    # Busiest API keys over the same 7 days
+    usage = func.sum(DailyJobRollup.count).label('usage')
     key_stats = db.session.query(
         APIKey.name,
-        func.count(SigningJob.id).label('usage')
-    ).outerjoin(
-        SigningJob,
-        APIKey.id == SigningJob.api_key_id
+        usage
+    ).join(
+        APIKey,
+        APIKey.id == DailyJobRollup.api_key_id
+    ).filter(
+        DailyJobRollup.bucket >= start_date
     ).group_by(
         APIKey.id,
         APIKey.name
-    ).all()
+    ).order_by(
+        usage.desc()
+    ).limit(20).all()
     
     key_names = [stat.name for stat in key_stats]
     key_usage = [stat.usage for stat in key_stats]
     
-    # Recent signing jobs
-    recent_jobs = SigningJob.query.order_by(
-        SigningJob.created_at.desc()
-    ).limit(10).all()
+    # Outcomes by tier over the same 7 days
+    tier_stats = db.session.query(
+        DailyJobRollup.tier,
+        DailyJobRollup.status,
+        func.sum(DailyJobRollup.count).label('count')
+    ).filter(
+        DailyJobRollup.bucket >= start_date
+    ).group_by(
+        DailyJobRollup.tier,
+        DailyJobRollup.status
+    ).order_by(
+        DailyJobRollup.tier,
+        DailyJobRollup.status
+    ).all()
+    
+    # Recent signing jobs: the first keyset page, read off the created_at index like the job listing
+    recent_jobs = keyset_page(
+        SigningJob.query.options(db.joinedload(SigningJob.api_key)),
+        SigningJob.created_at,
+        SigningJob.id,
+        per_page=10
+    ).items
     
     return render_template('admin/analytics.html',
                          dates=dates,
                          daily_counts=daily_counts,
+                         hour_labels=hour_labels,
+                         hourly_counts=hourly_counts,
+                         tier_stats=tier_stats,
                          key_names=key_names,
                          key_usage=key_usage,
                          recent_jobs=recent_jobs)
@@ -149,64 +360,41 @@ def test():
             flash('P12 password is required', 'danger')
             return render_template('admin/test.html')
 
-        # Save files
-        upload_folder = '/tmp/zsign_uploads'
-        os.makedirs(upload_folder, exist_ok=True)
-
-        ipa_file = request.files['ipa']
-        p12_file = request.files['p12']
-        prov_file = request.files['mobileprovision']
-        
-        ipa_path = os.path.join(upload_folder, secure_filename(ipa_file.filename))
-        p12_path = os.path.join(upload_folder, secure_filename(p12_file.filename))
-        prov_path = os.path.join(upload_folder, secure_filename(prov_file.filename))
+        # Save files into a private workspace so concurrent tests never collide
+        workspace = Workspace(current_app.config['UPLOAD_FOLDER'], prefix='test-')
         
         try:
-            ipa_file.save(ipa_path)
-            p12_file.save(p12_path)
-            prov_file.save(prov_path)
+            save_upload(request.files['ipa'], workspace.ipa_path)
+            save_upload(request.files['p12'], workspace.p12_path)
+            save_upload(request.files['mobileprovision'], workspace.prov_path)
             
             # Sign the IPA
-            output_path = sign_ipa(ipa_path, p12_path, prov_path, p12_password)
-            
-            # Store the output path in session for download
-            session['signed_ipa_path'] = output_path
+            sign_ipa(workspace.ipa_path, workspace.p12_path, workspace.prov_path, p12_password,
+                     workspace.output_path, zsign_path=toolchain.require(), limits=signing_queue.limits)
+            # Kept in the artifact store, which removes it after ARTIFACT_TTL
+            name = f'{os.path.basename(workspace.path)}.ipa'
+            artifact_store.store(name, workspace.output_path)
             
             flash('IPA signed successfully!', 'success')
-            return render_template('admin/test.html', signed_file_path=output_path)
+            return render_template('admin/test.html', signed_name=name)
             
         except Exception as e:
             flash(f'Error signing IPA: {str(e)}', 'danger')
             return render_template('admin/test.html')
         finally:
-            # Cleanup input files
-            for path in [ipa_path, p12_path, prov_path]:
-                if os.path.exists(path):
-                    os.remove(path)
+            # Cleanup the workspace; the signed IPA was moved out of it
+            workspace.cleanup()
     
     return render_template('admin/test.html')
 
-@admin_bp.route('/download_signed_ipa')
+@admin_bp.route('/download_signed_ipa/<name>')
 @login_required
-def download_signed_ipa():
-    file_path = request.args.get('file_path')
-    if not file_path or not os.path.exists(file_path):
+def download_signed_ipa(name):
+    path = artifact_store.path(name)
+    if not TEST_ARTIFACT_PATTERN.match(name) or not os.path.exists(path):
         flash('Signed IPA file not found', 'danger')
         return redirect(url_for('admin.test'))
-    
-    try:
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name='signed.ipa'
-        )
-    except Exception as e:
-        flash(f'Error downloading file: {str(e)}', 'danger')
-        return redirect(url_for('admin.test'))
-    finally:
-        # Cleanup the signed file after download
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    return send_artifact(path, 'signed.ipa')
 
 @admin_bp.route('/keys/create', methods=['POST'])
 @login_required
@@ -221,6 +409,7 @@ def create_key():
     )
     db.session.add(api_key)
     db.session.commit()
+    key_cache.invalidate(api_key.key)
     
     flash(f'API Key created: {api_key.key}')
     return redirect(url_for('admin.dashboard'))
@@ -230,5 +419,8 @@ def create_key():
 def toggle_key(key_id):
     api_key = APIKey.query.get_or_404(key_id)
     api_key.is_active = not api_key.is_active
+    # Tells the other workers' key caches to drop what they hold
+    api_key.updated_at = datetime.utcnow()
     db.session.commit()
+    key_cache.invalidate(api_key.key)
     return redirect(url_for('admin.dashboard'))
\ No newline at end of file
@@ -1,102 +1,920 @@
 import os
-from flask import Blueprint, request, jsonify, current_app
+import json
+import queue
+import logging
+import collections
+import re
+import time
+from flask import Blueprint, Response, request, jsonify, current_app, url_for, make_response, stream_with_context, g
 from werkzeug.utils import secure_filename
-from models import APIKey, SigningJob, db
-from utils.signing import sign_ipa
+from models import APIKey, SigningJob, SigningCredential, Dylib, WebhookDelivery, db
+from utils.job_queue import signing_queue
+from utils.rate_limit import rate_limiter
+from utils.key_cache import key_cache
+from utils.rollups import record_job
+from utils.toolchain import toolchain
+from utils.signed_cache import signed_cache
+from utils.artifacts import artifact_store, job_name, send_artifact
+from utils.bundle_cache import bundle_cache
+from utils.uploads import upload_store, save_upload, UploadError
+from utils.workspace import Workspace
+from utils.credentials import credential_registry, CredentialError
+from utils.dylib_store import dylib_store, DylibError
+from utils.blob_store import blob_store, BlobError
+from utils.provisioning import bundle_id_allowed
+from utils.inspection import InspectionError, inspect_request, read_app_info
+from utils.webhooks import webhooks, enqueue_delivery, url_error, new_secret
+from utils.trace import JobTrace
+from utils.metrics import (
+    sign_phase_seconds, bytes_received_total, bytes_deduplicated_total, jobs_total, inspection_rejections_total
+)
 from datetime import datetime
 import functools
+import math
+
+logger = logging.getLogger(__name__)
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
-def require_api_key(f):
+SHA256_PATTERN = re.compile(r'^[0-9a-fA-F]{64}$')
+BUNDLE_ID_PATTERN = re.compile(r'^[A-Za-z0-9-]+(\.[A-Za-z0-9-]+)*$')
+OPTION_FIELDS = ('weak_dylibs', 'bundle_id', 'bundle_name', 'bundle_version')
+
+SIGNING_FILES = [
+    ('ipa', 'No IPA file provided'),
+    ('p12', 'No P12 certificate provided'),
+    ('mobileprovision', 'No provisioning profile provided')
+]
+
+def require_api_key(f=None, check_limit=True, consume=False):
+    """Resolve the X-API-Key header and pass the key to the view.
+
+    check_limit rejects keys that are over their rolling daily quota;
+    consume also counts this request, and refunds it if the view fails.
+    Both happen before the view touches the request body. The counted
+    use is g.usage_event_id, for a job to refund if it fails later.
+    """
+    if f is None:
+        return functools.partial(require_api_key, check_limit=check_limit, consume=consume)
+        
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
         api_key = request.headers.get('X-API-Key')
         if not api_key:
             return jsonify({'error': 'No API key provided'}), 401
             
-        key = APIKey.query.filter_by(key=api_key, is_active=True).first()
+        key = key_cache.resolve(api_key)
         if not key:
             return jsonify({'error': 'Invalid API key'}), 401
             
         # Check rate limit
-        if key.daily_usage >= key.get_daily_limit():
-            return jsonify({'error': 'Daily limit exceeded'}), 429
+        decision = None
+        if consume:
+            decision = rate_limiter.acquire(key.id, key.get_daily_limit())
+        elif check_limit:
+            decision = rate_limiter.peek(key.id, key.get_daily_limit())
+        g.usage_event_id = decision.event_id if decision else None
+        if decision and not decision.allowed:
+            response = jsonify({'error': 'Daily limit exceeded'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(decision.retry_after))
+            return response
+            
+        try:
+            response = make_response(f(key, *args, **kwargs))
+        except Exception:
+            if consume:
+                rate_limiter.release(key.id, decision.event_id)
+            raise
+        if consume and response.status_code >= 400:
+            rate_limiter.release(key.id, decision.event_id)
+            decision = decision._replace(remaining=decision.remaining + 1)
             
-        return f(key, *args, **kwargs)
+        if decision:
+            response.headers['X-RateLimit-Limit'] = str(decision.limit)
+            response.headers['X-RateLimit-Remaining'] = str(decision.remaining)
+        return response
     return wrapped
 
-@api_bp.route('/sign', methods=['POST'])
-@require_api_key
-def sign_app(api_key):
-    if 'ipa' not in request.files:
-        return jsonify({'error': 'No IPA file provided'}), 400
-        
-    if 'p12' not in request.files:
-        return jsonify({'error': 'No P12 certificate provided'}), 400
+def backpressure_response(backpressure):
+    response = jsonify({'error': backpressure.message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, backpressure.retry_after))
+    return response
+
+def signing_options(api_key, values, credential=None):
+    """Validate the optional dylib injection and Info.plist rewrite fields of a sign request.
+
+    Returns (options, error). Dylibs are kept as hashes so the options can
+    go straight into the signed cache key.
+    """
+    options = {}
+    dylibs = values.get('dylibs') or []
+    if isinstance(dylibs, str):
+        dylibs = [dylibs]
+    if dylibs:
+        if not all(isinstance(h, str) and SHA256_PATTERN.match(h) for h in dylibs):
+            return None, 'Dylibs must be referenced by their SHA-256'
+        try:
+            dylib_store.resolve(api_key.id, dylibs)
+        except DylibError as e:
+            return None, str(e)
+        options['dylibs'] = [h.lower() for h in dylibs]
+        options['weak_dylibs'] = values.get('weak_dylibs') in (True, '1', 'true')
         
-    if 'mobileprovision' not in request.files:
-        return jsonify({'error': 'No provisioning profile provided'}), 400
+    bundle_id = values.get('bundle_id')
+    if bundle_id:
+        if not isinstance(bundle_id, str) or len(bundle_id) > 255 or not BUNDLE_ID_PATTERN.match(bundle_id):
+            return None, 'Invalid bundle ID'
+        if credential and not bundle_id_allowed(credential.bundle_id, bundle_id):
+            return None, f'Bundle ID {bundle_id} is not allowed by the profile ({credential.bundle_id})'
+        options['bundle_id'] = bundle_id
         
-    if 'p12_password' not in request.form:
-        return jsonify({'error': 'No P12 password provided'}), 400
+    for field in ('bundle_name', 'bundle_version'):
+        value = values.get(field)
+        if value:
+            if not isinstance(value, str) or len(value) > 255 or not value.isprintable():
+                return None, f"Invalid {field.replace('_', ' ')}"
+            options[field] = value
+    return options, None
 
-    # Save files
-    ipa_file = request.files['ipa']
-    p12_file = request.files['p12']
-    prov_file = request.files['mobileprovision']
-    
-    ipa_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 
-                           secure_filename(ipa_file.filename))
-    p12_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 
-                           secure_filename(p12_file.filename))
-    prov_path = os.path.join(current_app.config['UPLOAD_FOLDER'],
-                            secure_filename(prov_file.filename))
+def requested_zip_level(value):
+    """Validate the optional zip_level of a sign request; returns (level, error), level None for the key's default."""
+    if value is None or value == '':
+        return None, None
+    try:
+        level = int(value)
+    except (TypeError, ValueError):
+        level = None
+    if isinstance(value, bool) or level is None or not 0 <= level <= 9:
+        return None, 'zip_level must be an integer from 0 to 9'
+    return level, None
+
+def queue_signing(api_key, workspace, input_file, hashes, credential, p12_password, options=None, on_done=None,
+                  callback_url=None, zip_level=None, trace=None, usage_event_id=None):
+    """Create the SigningJob for a filled workspace and either serve it from the signed cache or queue it.
+
+    hashes holds the sha256 of each uploaded file, and a credential stands
+    in for the p12 and mobileprovision hashes. options come from
+    signing_options. The queue owns the workspace once this returns. A
+    cache hit comes back already completed, without calling on_done.
+    callback_url overrides the key's webhook for this job. zip_level only
+    changes how the IPA is compressed, so it isn't part of the cache key.
+    trace is the request's JobTrace, which the job's trace continues.
+    usage_event_id is the rate limiter use the job refunds if it fails.
+    """
+    trace = trace or JobTrace()
+    trace.set(input_bytes=os.path.getsize(workspace.ipa_path))
+    ipa_hash = hashes['ipa']
+    if credential:
+        # The credential id can never collide with a raw P12 hash, so
+        # the password-less key cannot be hit by an unchecked upload
+        hashes = dict(hashes, p12=f'credential-{credential.id}', mobileprovision=credential.profile_sha256)
     
-    ipa_file.save(ipa_path)
-    p12_file.save(p12_path)
-    prov_file.save(prov_path)
+    cache_key = None
+    if signed_cache.enabled:
+        cache_key = signed_cache.make_key(
+            ipa_hash,
+            hashes['p12'],
+            hashes['mobileprovision'],
+            p12_password or '',
+            # A different zsign build may produce a different signature
+            dict(options or {}, zsign=toolchain.sha256)
+        )
+        with sign_phase_seconds.time(phase='cache_lookup'):
+            cached_path = signed_cache.get(cache_key)
+        if cached_path:
+            workspace.cleanup()
+            trace.mark('finished')
+            trace.set(output_bytes=os.path.getsize(cached_path))
+            
+            job = SigningJob(
+                api_key_id=api_key.id,
+                status='completed',
+                input_file=input_file,
+                cache_hit=True,
+                completed_at=datetime.utcnow(),
+                callback_url=callback_url,
+                duration=trace.duration,
+                trace=trace.to_json()
+            )
+            with sign_phase_seconds.time(phase='db_commit'):
+                db.session.add(job)
+                db.session.flush()
+                # The job gets its own link to the cached IPA, which outlives the cache entry
+                job.output_file = artifact_store.store(job_name(job.id), cached_path, keep_source=True)
+                record_job(job, api_key.tier)
+                delivery = enqueue_delivery(job)
+                db.session.commit()
+            if delivery:
+                webhooks.notify()
+            jobs_total.inc(status='cache_hit')
+            return job
     
     # Create signing job
     job = SigningJob(
         api_key_id=api_key.id,
         status='pending',
-        input_file=ipa_path
+        input_file=input_file,
+        cache_hit=False if cache_key else None,
+        callback_url=callback_url,
+        usage_event_id=usage_event_id,
+        worker_pid=os.getpid(),
+        heartbeat_at=datetime.utcnow()
     )
-    db.session.add(job)
-    db.session.commit()
+    with sign_phase_seconds.time(phase='db_commit'):
+        db.session.add(job)
+        db.session.commit()
     
-    try:
-        output_path = sign_ipa(
-            ipa_path, 
-            p12_path,
-            prov_path,
-            request.form['p12_password']
-        )
+    sign_options = dict(options or {})
+    if sign_options.get('dylibs'):
+        sign_options['dylibs'] = [dylib_store.path(h) for h in sign_options['dylibs']]
+    
+    # Hand the zsign run to the worker pool, which owns the workspace from here on
+    signing_queue.submit(
+        job.id,
+        workspace,
+        p12_password,
+        cache_key=cache_key,
+        ipa_hash=ipa_hash if bundle_cache.enabled else None,
+        use_credential=credential is not None,
+        options=sign_options or None,
+        on_done=on_done,
+        api_key=api_key,
+        zip_level=zip_level,
+        trace=trace
+    )
+    return job
+
+@api_bp.route('/sign', methods=['POST'])
+@require_api_key(consume=True)
+def sign_app(api_key):
+    trace = JobTrace()
+    if not toolchain.check():
+        return jsonify({'error': 'Signing is temporarily unavailable'}), 503
+    # Turn the request away before reading a possibly huge body
+    backpressure = signing_queue.admit(api_key)
+    if backpressure:
+        return backpressure_response(backpressure)
         
-        job.status = 'completed'
-        job.output_file = output_path
-        job.completed_at = datetime.utcnow()
+    bytes_received_total.inc(request.content_length or 0, endpoint='sign')
+    # The first form access parses the body and spools every file part to disk
+    with sign_phase_seconds.time(phase='spool'):
+        form = request.form
         
-        # Update API key usage
-        api_key.daily_usage += 1
-        api_key.last_used = datetime.utcnow()
+    credential = None
+    fields = SIGNING_FILES
+    if form.get('credential_id'):
+        credential = credential_registry.get(form.get('credential_id', type=int), api_key.id)
+        if not credential:
+            return jsonify({'error': 'Credential not found'}), 404
+        if credential.expires_at <= datetime.utcnow():
+            return jsonify({'error': 'Credential has expired'}), 400
+        # The registered credential replaces the p12, profile and password
+        fields = SIGNING_FILES[:1]
+    
+    for field, message in fields:
+        if field in request.files:
+            continue
+        sha256 = form.get(f'{field}_sha256')
+        if sha256:
+            if not SHA256_PATTERN.match(sha256) or not blob_store.find(api_key.id, sha256):
+                return jsonify({'error': f'Blob {sha256} not found, upload the file instead'}), 400
+            continue
+        upload_id = form.get(f'{field}_upload')
+        if not upload_id:
+            return jsonify({'error': message}), 400
+        upload = upload_store.get(upload_id, api_key.id)
+        if not upload or upload['sha256'] is None:
+            return jsonify({'error': f'Upload {upload_id} not found or incomplete'}), 400
         
-        db.session.commit()
+    if not credential and 'p12_password' not in form:
+        return jsonify({'error': 'No P12 password provided'}), 400
         
+    options, error = signing_options(
+        api_key,
+        dict({f: form.get(f) for f in OPTION_FIELDS}, dylibs=form.getlist('dylib')),
+        credential
+    )
+    if error:
+        return jsonify({'error': error}), 400
+        
+    callback_url = form.get('callback_url') or None
+    error = callback_url and url_error(callback_url)
+    if error:
+        return jsonify({'error': error}), 400
+    zip_level, error = requested_zip_level(form.get('zip_level'))
+    if error:
+        return jsonify({'error': error}), 400
+
+    # Save files into a private workspace, taking either a multipart file or a finished resumable upload
+    workspace = Workspace(current_app.config['UPLOAD_FOLDER'])
+    try:
+        filenames = {}
+        hashes = {}
+        targets = {
+            'ipa': workspace.ipa_path,
+            'p12': workspace.p12_path,
+            'mobileprovision': workspace.prov_path
+        }
+        with sign_phase_seconds.time(phase='save'):
+            for field, _ in fields:
+                if field in request.files:
+                    upload_file = request.files[field]
+                    filenames[field] = secure_filename(upload_file.filename)
+                    hashes[field] = save_upload(upload_file, targets[field])
+                elif form.get(f'{field}_sha256'):
+                    blob = blob_store.checkout(api_key.id, form[f'{field}_sha256'], targets[field])
+                    bytes_deduplicated_total.inc(blob.size, endpoint='sign')
+                    filenames[field], hashes[field] = blob.filename, blob.sha256
+                    continue
+                else:
+                    upload_id = form[f'{field}_upload']
+                    filenames[field] = upload_store.get(upload_id, api_key.id)['filename']
+                    hashes[field] = upload_store.claim(upload_id, api_key.id, targets[field])
+                # Let the next request for the same file send its hash instead
+                blob_store.adopt(api_key.id, targets[field], hashes[field], filenames[field])
+            
+            if credential:
+                credential_registry.materialize(credential, workspace)
+                p12_password = None
+            else:
+                p12_password = form['p12_password']
+        trace.mark('saved')
+                
+        # Reject mismatched inputs in milliseconds instead of after a full zsign run
+        with sign_phase_seconds.time(phase='inspect'):
+            inspection = inspect_request(workspace.ipa_path, options, workspace.p12_path, workspace.prov_path,
+                                         p12_password, credential)
+        trace.mark('inspected')
+        
+        job = queue_signing(api_key, workspace, filenames['ipa'], hashes, credential, p12_password, options,
+                            callback_url=callback_url, zip_level=zip_level, trace=trace,
+                            usage_event_id=g.usage_event_id)
+    except Exception:
+        workspace.cleanup()
+        raise
+    
+    warnings = [
+        f'The provisioning profile does not grant {name}; the signed app will lack it'
+        for name in inspection['missing_entitlements']
+    ]
+    if job.status == 'completed':
         return jsonify({
-            'status': 'success',
+            'status': 'completed',
             'job_id': job.id,
-            'message': 'IPA signed successfully'
+            'status_url': url_for('api.job_status', job_id=job.id),
+            'cache_hit': True,
+            'message': 'IPA signed successfully',
+            'warnings': warnings
         })
+    
+    return jsonify({
+        'status': 'pending',
+        'job_id': job.id,
+        'status_url': url_for('api.job_status', job_id=job.id),
+        'cache_hit': False,
+        'message': 'IPA queued for signing',
+        'warnings': warnings
+    }), 202
+
+def batch_reference(api_key, ref):
+    """Return an error if a manifest file reference names no file part, finished upload or blob."""
+    if not isinstance(ref, str) or not ref:
+        return 'File references must be non-empty strings'
+    if ref.startswith('blob:'):
+        sha256 = ref[len('blob:'):]
+        if not SHA256_PATTERN.match(sha256) or not blob_store.find(api_key.id, sha256):
+            return f'Blob {sha256} not found, upload the file instead'
+    elif ref.startswith('upload:'):
+        upload_id = ref[len('upload:'):]
+        upload = upload_store.get(upload_id, api_key.id)
+        if not upload or upload['sha256'] is None:
+            return f'Upload {upload_id} not found or incomplete'
+    elif ref not in request.files:
+        return f'No file part named {ref}'
+    return None
+
+def batch_result(index, job):
+    return {
+        'index': index,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('api.job_status', job_id=job.id),
+        'cache_hit': job.cache_hit,
+        'error': job.error_message
+    }
+
+@api_bp.route('/batch', methods=['POST'])
+@require_api_key
+def sign_batch(api_key):
+    """Sign many (IPA, credential) pairs from one request and stream each result as NDJSON.
+
+    Every file part is stored once however many items reference it, and
+    items count against the daily limit one by one as they start.
+    """
+    received = time.time()
+    if not toolchain.check():
+        return jsonify({'error': 'Signing is temporarily unavailable'}), 503
+    backpressure = signing_queue.admit(api_key)
+    if backpressure:
+        return backpressure_response(backpressure)
+        
+    bytes_received_total.inc(request.content_length or 0, endpoint='batch')
+    try:
+        manifest = json.loads(request.form.get('manifest') or '')
+    except ValueError:
+        return jsonify({'error': 'No valid JSON manifest provided'}), 400
+    items = manifest.get('items') if isinstance(manifest, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Manifest must contain a non-empty items list'}), 400
+    if len(items) > current_app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': f"A batch may contain at most {current_app.config['BATCH_MAX_ITEMS']} items"}), 400
+        
+    max_parallel = manifest.get('max_parallel', current_app.config['BATCH_MAX_PARALLEL'])
+    if not isinstance(max_parallel, int) or max_parallel <= 0:
+        return jsonify({'error': 'max_parallel must be a positive integer'}), 400
+    # Never more unfinished jobs than admit() would let the key queue
+    max_parallel = min(max_parallel, current_app.config['BATCH_MAX_PARALLEL'], api_key.get_max_queued())
+    zip_level, error = requested_zip_level(manifest.get('zip_level'))
+    if error:
+        return jsonify({'error': error}), 400
+    
+    # Validate every item before anything is stored or counted
+    plans = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            return jsonify({'error': f'Item {index}: must be an object'}), 400
+            
+        credential = None
+        fields = SIGNING_FILES
+        if item.get('credential_id') is not None:
+            credential_id = item['credential_id']
+            credential = credential_registry.get(credential_id, api_key.id) if isinstance(credential_id, int) else None
+            if not credential:
+                return jsonify({'error': f'Item {index}: Credential not found'}), 404
+            if credential.expires_at <= datetime.utcnow():
+                return jsonify({'error': f'Item {index}: Credential has expired'}), 400
+            fields = SIGNING_FILES[:1]
+        elif not isinstance(item.get('p12_password'), str):
+            return jsonify({'error': f'Item {index}: No P12 password provided'}), 400
+            
+        refs = {}
+        for field, message in fields:
+            if field not in item:
+                return jsonify({'error': f'Item {index}: {message}'}), 400
+            error = batch_reference(api_key, item[field])
+            if error:
+                return jsonify({'error': f'Item {index}: {error}'}), 400
+            refs[field] = item[field]
+            
+        options, error = signing_options(api_key, item, credential)
+        if error:
+            return jsonify({'error': f'Item {index}: {error}'}), 400
+        callback_url = item.get('callback_url') or None
+        error = callback_url and url_error(callback_url)
+        if error:
+            return jsonify({'error': f'Item {index}: {error}'}), 400
+        plans.append((refs, credential, None if credential else item['p12_password'], options, callback_url))
+    
+    # Store each distinct file once; item workspaces hard-link to it
+    staging = Workspace(current_app.config['UPLOAD_FOLDER'], prefix='batch-')
+    staged = {}
+    try:
+        for refs, *_ in plans:
+            for ref in refs.values():
+                if ref in staged:
+                    continue
+                path = staging.file(f'input-{len(staged)}')
+                if ref.startswith('blob:'):
+                    blob = blob_store.checkout(api_key.id, ref[len('blob:'):], path)
+                    bytes_deduplicated_total.inc(blob.size, endpoint='batch')
+                    staged[ref] = (path, blob.filename, blob.sha256)
+                    continue
+                if ref.startswith('upload:'):
+                    upload_id = ref[len('upload:'):]
+                    filename = upload_store.get(upload_id, api_key.id)['filename']
+                    staged[ref] = (path, filename, upload_store.claim(upload_id, api_key.id, path))
+                else:
+                    upload_file = request.files[ref]
+                    staged[ref] = (path, secure_filename(upload_file.filename), save_upload(upload_file, path))
+                blob_store.adopt(api_key.id, path, staged[ref][2], staged[ref][1])
+        db.session.commit()
+        saved = time.time()
         
-    except Exception as e:
-        job.status = 'failed'
-        job.error_message = str(e)
+        # Inspect every item up front, so a bad one fails the batch before any signing starts
+        apps = {}
+        with sign_phase_seconds.time(phase='inspect'):
+            for index, (refs, credential, p12_password, options, _) in enumerate(plans):
+                ipa_path = staged[refs['ipa']][0]
+                try:
+                    if ipa_path not in apps:
+                        apps[ipa_path] = read_app_info(ipa_path)
+                    inspect_request(
+                        ipa_path,
+                        options,
+                        None if credential else staged[refs['p12']][0],
+                        None if credential else staged[refs['mobileprovision']][0],
+                        p12_password,
+                        credential,
+                        app=apps[ipa_path]
+                    )
+                except InspectionError as e:
+                    raise InspectionError(f'Item {index}: {e}', e.code, dict(e.details, index=index))
+        inspected = time.time()
+    except Exception:
+        staging.cleanup()
+        raise
+    
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    finished = queue.Queue()
+    
+    def start_item(index, refs, credential, p12_password, options, callback_url):
+        # The batch was admitted as a whole; each item must still fit the key's queue
+        backpressure = signing_queue.admit(api_key)
+        if backpressure:
+            return {
+                'index': index,
+                'status': 'rejected',
+                'error': backpressure.message,
+                'retry_after': max(1, backpressure.retry_after)
+            }
+        decision = rate_limiter.acquire(api_key.id, api_key.get_daily_limit())
+        if not decision.allowed:
+            return {
+                'index': index,
+                'status': 'rejected',
+                'error': 'Daily limit exceeded',
+                'retry_after': math.ceil(decision.retry_after)
+            }
+            
+        workspace = Workspace(upload_folder)
+        try:
+            targets = {
+                'ipa': Workspace.IPA,
+                'p12': Workspace.P12,
+                'mobileprovision': Workspace.MOBILEPROVISION
+            }
+            hashes = {}
+            for field, ref in refs.items():
+                path, _, hashes[field] = staged[ref]
+                workspace.link(path, targets[field])
+            if credential:
+                credential_registry.materialize(credential, workspace)
+            # Every item's trace starts with the batch request; waiting for a free slot shows before 'queued'
+            trace = JobTrace(received)
+            trace.mark('saved', saved)
+            trace.mark('inspected', inspected)
+            trace.set(batch_index=index)
+            return queue_signing(api_key, workspace, staged[refs['ipa']][1], hashes, credential, p12_password,
+                                 options, on_done=finished.put, callback_url=callback_url, zip_level=zip_level,
+                                 trace=trace, usage_event_id=decision.event_id)
+        except Exception:
+            workspace.cleanup()
+            rate_limiter.release(api_key.id, decision.event_id)
+            raise
+    
+    # Seconds between database checks for finished jobs, and without any result before the batch gives up
+    poll_interval = current_app.config['JOB_HEARTBEAT_INTERVAL']
+    result_timeout = current_app.config['BATCH_RESULT_TIMEOUT']
+    
+    def generate():
+        waiting = collections.deque(enumerate(plans))
+        running = {}
+        last_result = time.monotonic()
+        try:
+            while waiting or running:
+                while waiting and len(running) < max_parallel:
+                    index, plan = waiting.popleft()
+                    try:
+                        started = start_item(index, *plan)
+                    except Exception as e:
+                        logger.exception(f'Failed to start batch item {index}')
+                        started = {'index': index, 'status': 'failed', 'error': str(e)}
+                    if isinstance(started, dict):
+                        yield json.dumps(started) + '\n'
+                    elif started.status == 'completed':
+                        yield json.dumps(batch_result(index, started)) + '\n'
+                    else:
+                        running[started.id] = index
+                
+                if not running:
+                    continue
+                try:
+                    done_ids = [finished.get(timeout=poll_interval)]
+                except queue.Empty:
+                    # A job whose callback never comes, e.g. one failed as orphaned, is found in the database
+                    done_ids = [
+                        job.id for job in SigningJob.query.filter(SigningJob.id.in_(running))
+                        .populate_existing() if job.status in ('completed', 'failed')
+                    ]
+                for job_id in done_ids:
+                    if job_id not in running:
+                        continue
+                    job = db.session.get(SigningJob, job_id, populate_existing=True)
+                    yield json.dumps(batch_result(running.pop(job_id), job)) + '\n'
+                    last_result = time.monotonic()
+                if running and time.monotonic() - last_result >= result_timeout:
+                    logger.warning(f'Batch gave up on {len(running)} job(s) after {result_timeout}s without a result')
+                    for job in SigningJob.query.filter(SigningJob.id.in_(running)).populate_existing():
+                        yield json.dumps(dict(
+                            batch_result(running[job.id], job),
+                            error='No result within the batch timeout; poll status_url for it'
+                        )) + '\n'
+                    for index, _ in waiting:
+                        yield json.dumps({
+                            'index': index,
+                            'status': 'rejected',
+                            'error': 'The batch stopped before this item started'
+                        }) + '\n'
+                    return
+        finally:
+            # Items not yet started when the client went away are simply never run
+            staging.cleanup()
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@api_bp.route('/preflight', methods=['POST'])
+@require_api_key
+def preflight(api_key):
+    """Report which files the server already holds for this key, so a sign request can send their hashes instead."""
+    data = request.get_json(silent=True)
+    files = data.get('files') if isinstance(data, dict) else None
+    if not isinstance(files, dict) or not files:
+        return jsonify({'error': 'No files provided'}), 400
+    if len(files) > 3 * current_app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': 'Too many files'}), 400
+        
+    result = {}
+    for name, info in files.items():
+        sha256 = info.get('sha256') if isinstance(info, dict) else None
+        size = info.get('size') if isinstance(info, dict) else None
+        if not isinstance(sha256, str) or not SHA256_PATTERN.match(sha256):
+            return jsonify({'error': f'{name}: sha256 must be a hex SHA-256'}), 400
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            return jsonify({'error': f'{name}: size must be a non-negative integer'}), 400
+        blob = blob_store.find(api_key.id, sha256, size)
+        if blob:
+            # Keep it around for the sign request that follows
+            blob_store.touch(blob)
+        result[name] = {'present': blob is not None}
+    db.session.commit()
+    return jsonify({'files': result, 'ttl': blob_store.ttl})
+
+@api_bp.route('/health', methods=['GET'])
+def health():
+    toolchain.check()
+    status = toolchain.status()
+    return jsonify({'status': 'ok' if status['ready'] else 'unavailable', 'toolchain': status}), 200 if status['ready'] else 503
+
+@api_bp.route('/jobs/<int:job_id>', methods=['GET'])
+@require_api_key(check_limit=False)
+def job_status(api_key, job_id):
+    job = SigningJob.query.filter_by(id=job_id, api_key_id=api_key.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+        
+    delivery = WebhookDelivery.query.filter_by(job_id=job.id).order_by(WebhookDelivery.id.desc()).first()
+    available = artifact_store.job_path(job) is not None
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'completed_at': job.completed_at.isoformat() if job.completed_at else None,
+        'cache_hit': job.cache_hit,
+        'error': job.error_message,
+        'download_url': url_for('api.download_job', job_id=job.id) if available else None,
+        'share_url': url_for(
+            'api.download_job', job_id=job.id, _external=True, **artifact_store.signed_query(job)
+        ) if available else None,
+        'expires_at': artifact_store.expires_at(job).isoformat() if available else None,
+        'webhook': delivery_response(delivery) if delivery else None
+    })
+
+def send_job_artifact(job):
+    path = artifact_store.job_path(job) if job else None
+    if not path:
+        if job and job.status == 'completed':
+            return jsonify({'error': 'The signed IPA has expired, sign the app again'}), 410
+        return jsonify({'error': 'Job not found or not completed'}), 404
+    stem = os.path.splitext(job.input_file or '')[0] or 'app'
+    return send_artifact(path, f'{stem}-signed.ipa', job.completed_at)
+
+@require_api_key(check_limit=False)
+def download_with_key(api_key, job_id):
+    return send_job_artifact(SigningJob.query.filter_by(id=job_id, api_key_id=api_key.id).first())
+
+@api_bp.route('/jobs/<int:job_id>/download', methods=['GET'])
+def download_job(job_id):
+    """Download a job's signed IPA, with the API key or with the signed query of its share_url.
+
+    Downloads can be resumed with Range requests and don't count towards
+    the daily limit.
+    """
+    if 'signature' not in request.args:
+        return download_with_key(job_id)
+    if not artifact_store.verify(job_id, request.args.get('expires'), request.args.get('signature')):
+        return jsonify({'error': 'Invalid or expired download link'}), 403
+    return send_job_artifact(db.session.get(SigningJob, job_id))
+
+def delivery_response(delivery):
+    return {
+        'id': delivery.id,
+        'job_id': delivery.job_id,
+        'url': delivery.url,
+        'event': delivery.event,
+        'status': delivery.status,
+        'attempts': delivery.attempts,
+        'next_attempt_at': delivery.next_attempt_at.isoformat() if delivery.status == 'pending' else None,
+        'last_status_code': delivery.last_status_code,
+        'last_error': delivery.last_error,
+        'delivered_at': delivery.delivered_at.isoformat() if delivery.delivered_at else None
+    }
+
+@api_bp.route('/webhook', methods=['GET'])
+@require_api_key(check_limit=False)
+def get_webhook(api_key):
+    key = db.session.get(APIKey, api_key.id)
+    if not key.webhook_secret:
+        key.webhook_secret = new_secret()
         db.session.commit()
-        return jsonify({'error': str(e)}), 500
-    finally:
-        # Cleanup
-        for path in [ipa_path, p12_path, prov_path]:
-            if os.path.exists(path):
-                os.remove(path)
+    return jsonify({'url': key.webhook_url, 'secret': key.webhook_secret})
+
+@api_bp.route('/webhook', methods=['PUT'])
+@require_api_key(check_limit=False)
+def set_webhook(api_key):
+    """Set or clear (url null) the key's webhook, optionally rotating the signing secret."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'url' not in data:
+        return jsonify({'error': 'No webhook URL provided'}), 400
+    url = data['url'] or None
+    error = url and url_error(url)
+    if error:
+        return jsonify({'error': error}), 400
+        
+    key = db.session.get(APIKey, api_key.id)
+    key.webhook_url = url
+    if not key.webhook_secret or data.get('rotate_secret') is True:
+        key.webhook_secret = new_secret()
+    db.session.commit()
+    return jsonify({'url': key.webhook_url, 'secret': key.webhook_secret})
+
+@api_bp.route('/webhook/deliveries', methods=['GET'])
+@require_api_key(check_limit=False)
+def list_deliveries(api_key):
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    deliveries = WebhookDelivery.query.filter_by(api_key_id=api_key.id).order_by(
+        WebhookDelivery.id.desc()
+    ).limit(limit).all()
+    return jsonify({'deliveries': [delivery_response(d) for d in deliveries]})
+
+def credential_response(credential):
+    return {
+        'credential_id': credential.id,
+        'name': credential.name,
+        'certificate_name': credential.certificate_name,
+        'certificate_serial': credential.certificate_serial,
+        'team_id': credential.team_id,
+        'profile_name': credential.profile_name,
+        'bundle_id': credential.bundle_id,
+        'expires_at': credential.expires_at.isoformat(),
+        'created_at': credential.created_at.isoformat() if credential.created_at else None
+    }
+
+@api_bp.route('/credentials', methods=['POST'])
+@require_api_key(check_limit=False)
+def create_credential(api_key):
+    if 'p12' not in request.files:
+        return jsonify({'error': 'No P12 certificate provided'}), 400
+        
+    if 'mobileprovision' not in request.files:
+        return jsonify({'error': 'No provisioning profile provided'}), 400
+        
+    if 'p12_password' not in request.form:
+        return jsonify({'error': 'No P12 password provided'}), 400
+        
+    p12_file = request.files['p12']
+    try:
+        credential = credential_registry.register(
+            api_key.id,
+            request.form.get('name') or secure_filename(p12_file.filename) or 'credential',
+            p12_file.read(),
+            request.form['p12_password'],
+            request.files['mobileprovision'].read()
+        )
+    except CredentialError as e:
+        return jsonify({'error': str(e)}), 400
+        
+    db.session.add(credential)
+    db.session.commit()
+    return jsonify(credential_response(credential)), 201
+
+@api_bp.route('/credentials', methods=['GET'])
+@require_api_key(check_limit=False)
+def list_credentials(api_key):
+    credentials = SigningCredential.query.filter_by(api_key_id=api_key.id).order_by(SigningCredential.id).all()
+    return jsonify({'credentials': [credential_response(c) for c in credentials]})
+
+@api_bp.route('/credentials/<int:credential_id>', methods=['DELETE'])
+@require_api_key(check_limit=False)
+def delete_credential(api_key, credential_id):
+    credential = credential_registry.get(credential_id, api_key.id)
+    if not credential:
+        return jsonify({'error': 'Credential not found'}), 404
+        
+    db.session.delete(credential)
+    db.session.commit()
+    credential_registry.forget(credential_id)
+    return jsonify({'status': 'deleted', 'credential_id': credential_id})
+
+def dylib_response(dylib):
+    return {
+        'sha256': dylib.sha256,
+        'filename': dylib.filename,
+        'size': dylib.size,
+        'created_at': dylib.created_at.isoformat() if dylib.created_at else None
+    }
+
+@api_bp.route('/dylibs', methods=['POST'])
+@require_api_key(check_limit=False)
+def upload_dylib(api_key):
+    if 'dylib' not in request.files:
+        return jsonify({'error': 'No dylib provided'}), 400
+        
+    dylib_file = request.files['dylib']
+    try:
+        dylib = dylib_store.put(api_key.id, dylib_file, secure_filename(dylib_file.filename) or 'tweak.dylib')
+    except DylibError as e:
+        return jsonify({'error': str(e)}), 400
+        
+    db.session.commit()
+    return jsonify(dylib_response(dylib)), 201
+
+@api_bp.route('/dylibs', methods=['GET'])
+@require_api_key(check_limit=False)
+def list_dylibs(api_key):
+    dylibs = Dylib.query.filter_by(api_key_id=api_key.id).order_by(Dylib.id).all()
+    return jsonify({'dylibs': [dylib_response(d) for d in dylibs]})
+
+@api_bp.errorhandler(InspectionError)
+def inspection_error(e):
+    inspection_rejections_total.inc(code=e.code)
+    return jsonify({'error': str(e), 'code': e.code, 'details': e.details}), 400
+
+@api_bp.errorhandler(BlobError)
+def blob_error(e):
+    return jsonify({'error': f'{e}, upload the file instead'}), 400
+
+@api_bp.errorhandler(UploadError)
+def upload_error(e):
+    body = {'error': str(e)}
+    if e.offset is not None:
+        body['offset'] = e.offset
+    return jsonify(body), e.status
+
+def upload_response(upload, status=200):
+    return jsonify({
+        'upload_id': upload['upload_id'],
+        'upload_url': url_for('api.upload_chunk', upload_id=upload['upload_id']),
+        'size': upload['size'],
+        'offset': upload['offset'],
+        'complete': upload['sha256'] is not None,
+        'sha256': upload['sha256']
+    }), status
+
+@api_bp.route('/uploads', methods=['POST'])
+@require_api_key
+def create_upload(api_key):
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename')
+    size = data.get('size')
+    if not filename:
+        return jsonify({'error': 'No filename provided'}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'Upload size must be a positive integer'}), 400
+    if size > current_app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'Upload exceeds maximum file size'}), 413
+        
+    upload = upload_store.create(api_key.id, secure_filename(filename), size)
+    return upload_response(upload, 201)
+
+@api_bp.route('/uploads/<upload_id>', methods=['GET'])
+@require_api_key(check_limit=False)
+def upload_status(api_key, upload_id):
+    upload = upload_store.get(upload_id, api_key.id)
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    return upload_response(upload)
+
+@api_bp.route('/uploads/<upload_id>', methods=['PATCH'])
+@require_api_key(check_limit=False)
+def upload_chunk(api_key, upload_id):
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+        
+    bytes_received_total.inc(request.content_length or 0, endpoint='upload')
+    # Read the raw body stream so Werkzeug never spools the chunk itself
+    upload = upload_store.append(upload_id, api_key.id, offset, request.stream)
+    return upload_response(upload)
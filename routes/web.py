@@ -1,4 +1,6 @@
-from flask import Blueprint, render_template
+import hmac
+from flask import Blueprint, Response, render_template, request, current_app, abort
+from utils.metrics import registry
 
 web_bp = Blueprint('web', __name__)
 
@@ -9,3 +11,10 @@ def index():
 @web_bp.route('/docs')
 def docs():
     return render_template('docs.html')
+
+@web_bp.route('/metrics')
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
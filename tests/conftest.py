@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+FAKE_ZSIGN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'fake_zsign.py')
+
+
+@pytest.fixture
+def app(tmp_path):
+    """An app on a throwaway SQLite database, with every folder under tmp_path and the fake zsign."""
+    from app import create_app, db
+
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "zsign.db"}',
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'SIGNED_FOLDER': str(tmp_path / 'signed'),
+        'SIGNED_CACHE_FOLDER': str(tmp_path / 'cache' / 'signed'),
+        'BUNDLE_CACHE_FOLDER': str(tmp_path / 'cache' / 'bundles'),
+        'DYLIB_FOLDER': str(tmp_path / 'dylibs'),
+        'BLOB_FOLDER': str(tmp_path / 'blobs'),
+        'JOB_ARCHIVE_FOLDER': str(tmp_path / 'job_archive'),
+        'RATE_LIMIT_STORE': 'memory',
+        'SIGNING_LEDGER': 'memory',
+        'METRICS_FOLDER': '',
+        'ZSIGN_PATH': FAKE_ZSIGN,
+        'ZSIGN_WARMUP': False,
+        'WEBHOOK_ALLOW_PRIVATE': True
+    })
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def api_key(app):
+    """An active regular API key; yields its key string and id."""
+    from models import APIKey, db
+
+    with app.app_context():
+        record = APIKey(key='test-key', name='Test', tier='regular')
+        db.session.add(record)
+        db.session.commit()
+        yield record.key, record.id
+
+
+@pytest.fixture
+def fake_zsign(monkeypatch):
+    """Path of the offline zsign stand-in, set to sign without burning CPU."""
+    monkeypatch.setenv('BENCH_ZSIGN_CPU_MS', '0')
+    return FAKE_ZSIGN
+
+
+@pytest.fixture
+def ipa(tmp_path):
+    from benchmarks.synthetic_ipa import make_ipa
+
+    return make_ipa(str(tmp_path / 'app.ipa'), 64 * 1024, 8)
+
+
+@pytest.fixture
+def credentials(tmp_path):
+    """(p12 path, profile path) from benchmarks.synthetic_ipa, unlocked by 'bench'."""
+    from benchmarks.synthetic_ipa import make_credentials
+
+    folder = tmp_path / 'credentials'
+    folder.mkdir()
+    return make_credentials(str(folder))
@@ -0,0 +1,56 @@
+import pytest
+from flask import Flask
+from werkzeug.wsgi import FileWrapper
+
+from utils.artifacts import send_artifact
+
+
+@pytest.fixture
+def artifact(tmp_path):
+    path = tmp_path / 'signed.ipa'
+    path.write_bytes(bytes(range(100)))
+    return str(path)
+
+
+def download(artifact, **headers):
+    app = Flask(__name__)
+    # Like most WSGI servers' file wrappers, werkzeug's sends everything up to the end of the file
+    environ = {'wsgi.file_wrapper': FileWrapper}
+    with app.test_request_context(headers=headers, environ_base=environ):
+        response = send_artifact(artifact, 'app-signed.ipa')
+        return response, b''.join(response.response) if response.response else b''
+
+
+def test_whole_file(artifact):
+    response, body = download(artifact)
+    assert response.status_code == 200
+    assert isinstance(response.response, FileWrapper)
+    assert body == bytes(range(100))
+    assert response.headers['Content-Length'] == '100'
+
+
+def test_range_sends_only_the_range(artifact):
+    response, body = download(artifact, Range='bytes=10-19')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 10-19/100'
+    assert body == bytes(range(10, 20))
+
+
+def test_open_ended_and_suffix_ranges(artifact):
+    assert download(artifact, Range='bytes=95-')[1] == bytes(range(95, 100))
+    assert download(artifact, Range='bytes=-3')[1] == bytes(range(97, 100))
+
+
+def test_unsatisfiable_range(artifact):
+    response, _ = download(artifact, Range='bytes=200-300')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */100'
+
+
+def test_validators(artifact):
+    response, _ = download(artifact)
+    etag = response.headers['ETag']
+    assert download(artifact, **{'If-None-Match': etag})[0].status_code == 304
+    # A stale If-Range gets the whole file
+    response, body = download(artifact, Range='bytes=0-9', **{'If-Range': '"stale"'})
+    assert response.status_code == 200 and len(body) == 100
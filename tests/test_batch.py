@@ -0,0 +1,38 @@
+import json
+
+from benchmarks.synthetic_ipa import P12_PASSWORD
+from models import SigningJob, db
+from utils.toolchain import toolchain
+
+
+def test_stream_ends_when_results_stop_coming(app, api_key, ipa, credentials, monkeypatch):
+    import routes.api
+
+    def queue_signing(key, workspace, input_file, *args, **kwargs):
+        # The first job was failed behind the batch's back, the second never finishes
+        status = 'failed' if not SigningJob.query.count() else 'pending'
+        job = SigningJob(api_key_id=key.id, status=status, input_file=input_file,
+                         error_message='Interrupted' if status == 'failed' else None)
+        db.session.add(job)
+        db.session.commit()
+        workspace.cleanup()
+        return job
+
+    monkeypatch.setattr(routes.api, 'queue_signing', queue_signing)
+    monkeypatch.setattr(toolchain, 'check', lambda: True)
+    app.config.update(JOB_HEARTBEAT_INTERVAL=1, BATCH_RESULT_TIMEOUT=1, BATCH_MAX_PARALLEL=1)
+
+    p12_path, profile_path = credentials
+    item = {'ipa': 'ipa', 'p12': 'p12', 'mobileprovision': 'profile', 'p12_password': P12_PASSWORD}
+    with open(ipa, 'rb') as ipa_file, open(p12_path, 'rb') as p12_file, open(profile_path, 'rb') as profile_file:
+        response = app.test_client().post('/api/batch', headers={'X-API-Key': api_key[0]}, data={
+            'manifest': json.dumps({'items': [item, item, item]}),
+            'ipa': (ipa_file, 'app.ipa'),
+            'p12': (p12_file, 'cert.p12'),
+            'profile': (profile_file, 'app.mobileprovision')
+        })
+    assert response.status_code == 200
+    lines = sorted((json.loads(line) for line in response.data.decode().splitlines()), key=lambda line: line['index'])
+    assert [(line['index'], line['status']) for line in lines] == [(0, 'failed'), (1, 'pending'), (2, 'rejected')]
+    assert lines[0]['error'] == 'Interrupted'
+    assert 'batch timeout' in lines[1]['error']
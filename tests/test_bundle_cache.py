@@ -0,0 +1,63 @@
+import os
+
+import pytest
+from flask import Flask
+
+from utils.bundle_cache import BundleCache
+from utils.signing import sign_ipa
+
+
+def make_app(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+    return app
+
+
+@pytest.fixture
+def bundle_cache(tmp_path):
+    return BundleCache(make_app(
+        BUNDLE_CACHE_FOLDER=str(tmp_path / 'bundles'), BUNDLE_CACHE_MAX_BYTES=10 * 1024 * 1024
+    ))
+
+
+def test_bundle_cache_extracts_once(bundle_cache, ipa):
+    with bundle_cache.checkout('key', ipa) as folder:
+        assert os.path.isfile(os.path.join(folder, 'Payload', 'Bench.app', 'Info.plist'))
+
+    def extract(ipa_path, dest):
+        raise AssertionError('a hit must not extract again')
+
+    with bundle_cache.checkout('key', ipa, extract=extract) as again:
+        assert again == folder
+
+
+def test_bundle_cache_counts_and_evicts_zsign_cache(bundle_cache, ipa, fake_zsign):
+    with bundle_cache.checkout('key', ipa) as folder:
+        # The signing runs in the entry's folder, so zsign's cache lands there
+        sign_ipa(folder, 'key.pem', 'profile.mobileprovision', None, zsign_path=fake_zsign)
+        assert os.path.isdir(os.path.join(folder, '.zsign_cache'))
+
+    size_path = os.path.join(bundle_cache.folder, 'key.size')
+    extracted, zsign_cache = BundleCache._read_size(size_path)
+    assert extracted > 0
+    assert zsign_cache == 4096
+
+    bundle_cache.max_bytes = 1
+    bundle_cache.evict()
+    assert os.listdir(bundle_cache.folder) == []
+
+
+def test_bundle_cache_drops_entry_when_signing_fails(bundle_cache, ipa):
+    with pytest.raises(RuntimeError):
+        with bundle_cache.checkout('key', ipa):
+            raise RuntimeError('zsign failed half way')
+    assert os.listdir(bundle_cache.folder) == []
+
+
+def test_bundle_cache_skips_entry_in_use(bundle_cache, ipa):
+    with bundle_cache.checkout('key', ipa):
+        with bundle_cache.checkout('key', ipa, blocking=False) as folder:
+            assert folder is None
+        bundle_cache.max_bytes = 1
+        bundle_cache.evict()
+        assert os.path.isdir(os.path.join(bundle_cache.folder, 'key'))
@@ -0,0 +1,131 @@
+import zipfile
+import plistlib
+from datetime import datetime, timedelta
+
+import pytest
+
+from benchmarks.synthetic_ipa import P12_PASSWORD
+from utils.certificate_handler import CertificateError, load_p12
+from utils.inspection import InspectionError, check_pair, inspect_request, read_app_info
+from utils.provisioning import ProvisioningError, bundle_id_allowed, parse_profile
+
+
+def read_credentials(credentials):
+    p12_path, profile_path = credentials
+    with open(p12_path, 'rb') as f:
+        _, certificate = load_p12(f.read(), P12_PASSWORD)
+    with open(profile_path, 'rb') as f:
+        return certificate, parse_profile(f.read())
+
+
+def write_ipa(path, entries):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, data in entries.items():
+            archive.writestr(name, data)
+    return str(path)
+
+
+def test_read_app_info(ipa):
+    info = read_app_info(ipa)
+    assert info['app'] == 'Bench.app'
+    assert info['bundle_id'] == 'com.example.bench'
+    assert (info['name'], info['version'], info['executable']) == ('Bench', '1.0', 'Bench')
+    assert info['entitlements'] is None
+
+
+def test_read_app_info_reads_archived_entitlements(tmp_path):
+    path = write_ipa(tmp_path / 'app.ipa', {
+        'Payload/A.app/Info.plist': plistlib.dumps({'CFBundleIdentifier': 'com.a', 'CFBundleExecutable': 'A'}),
+        'Payload/A.app/A': b'binary',
+        'Payload/A.app/archived-expanded-entitlements.xcent': plistlib.dumps({'aps-environment': 'production'}),
+        'Payload/A.app/Frameworks/F.framework/Info.plist': plistlib.dumps({'CFBundleIdentifier': 'com.f'})
+    })
+    info = read_app_info(path)
+    assert info['bundle_id'] == 'com.a'
+    assert info['entitlements'] == {'aps-environment': 'production'}
+
+
+@pytest.mark.parametrize('entries', [
+    {},
+    {'Payload/A.app/Info.plist': plistlib.dumps({'CFBundleIdentifier': 'com.a'}),
+     'Payload/B.app/Info.plist': plistlib.dumps({'CFBundleIdentifier': 'com.b'})},
+    {'Payload/A.app/Info.plist': b'not a plist'},
+    {'Payload/A.app/Info.plist': plistlib.dumps({'CFBundleExecutable': 'A'}), 'Payload/A.app/A': b''},
+    {'Payload/A.app/Info.plist': plistlib.dumps({'CFBundleIdentifier': 'com.a', 'CFBundleExecutable': 'A'})}
+])
+def test_read_app_info_rejects_malformed_ipa(entries, tmp_path):
+    with pytest.raises(InspectionError) as error:
+        read_app_info(write_ipa(tmp_path / 'app.ipa', entries))
+    assert error.value.code == 'invalid_ipa'
+
+
+def test_read_app_info_rejects_non_zip(tmp_path):
+    path = tmp_path / 'app.ipa'
+    path.write_bytes(b'not a zip')
+    with pytest.raises(InspectionError) as error:
+        read_app_info(str(path))
+    assert error.value.code == 'invalid_ipa'
+
+
+@pytest.mark.parametrize('pattern, bundle_id, allowed', [
+    ('*', 'com.example.app', True),
+    ('com.example.*', 'com.example.app', True),
+    ('com.example.*', 'com.other.app', False),
+    ('com.example.app', 'com.example.app', True),
+    ('com.example.app', 'com.example.app2', False),
+    ('', 'com.example.app', False)
+])
+def test_bundle_id_allowed(pattern, bundle_id, allowed):
+    assert bundle_id_allowed(pattern, bundle_id) is allowed
+
+
+def test_parse_profile(credentials):
+    _, profile = read_credentials(credentials)
+    assert profile['team_id'] == 'SMOKETEST1'
+    assert profile['app_id'] == 'SMOKETEST1.*'
+    assert profile['bundle_id'] == '*'
+    assert len(profile['certificates']) == 1
+    assert profile['expires_at'] > datetime.utcnow()
+
+
+def test_parse_profile_rejects_garbage():
+    with pytest.raises(ProvisioningError):
+        parse_profile(b'not a profile')
+
+
+def test_load_p12_rejects_wrong_password(credentials):
+    with open(credentials[0], 'rb') as f:
+        with pytest.raises(CertificateError):
+            load_p12(f.read(), 'wrong')
+
+
+def test_check_pair(credentials):
+    certificate, profile = read_credentials(credentials)
+    assert check_pair(certificate, profile)['team_id'] == 'SMOKETEST1'
+
+
+@pytest.mark.parametrize('change, code', [
+    ({'expires_at': datetime.utcnow() - timedelta(days=1)}, 'profile_expired'),
+    ({'team_id': 'OTHERTEAM1'}, 'team_mismatch'),
+    ({'app_id': ''}, 'invalid_profile'),
+    ({'certificates': []}, 'certificate_not_in_profile')
+])
+def test_check_pair_rejects(change, code, credentials):
+    certificate, profile = read_credentials(credentials)
+    with pytest.raises(InspectionError) as error:
+        check_pair(certificate, dict(profile, **change))
+    assert error.value.code == code
+
+
+def test_inspect_request(ipa, credentials):
+    p12_path, profile_path = credentials
+    summary = inspect_request(ipa, {'bundle_id': 'com.example.renamed'}, p12_path, profile_path, P12_PASSWORD)
+    assert summary['signing_bundle_id'] == 'com.example.renamed'
+    assert summary['missing_entitlements'] == []
+
+
+def test_inspect_request_reports_wrong_password(ipa, credentials):
+    p12_path, profile_path = credentials
+    with pytest.raises(InspectionError) as error:
+        inspect_request(ipa, None, p12_path, profile_path, 'wrong')
+    assert error.value.code == 'invalid_p12_password'
@@ -0,0 +1,65 @@
+import pytest
+
+from utils.rate_limit import MemoryWindow, SQLiteWindow
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def window(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryWindow()
+    return SQLiteWindow(str(tmp_path / 'ratelimit.sqlite'))
+
+
+def test_acquire_stops_at_limit(window):
+    assert window.acquire(1, 2, 60, 100)[:3] == (True, 1, 0)
+    assert window.acquire(1, 2, 60, 110)[:3] == (True, 2, 0)
+    allowed, count, retry_after, event_id = window.acquire(1, 2, 60, 120)
+    assert (allowed, count, event_id) == (False, 2, None)
+    # The oldest use leaves the window at 160
+    assert retry_after == 40
+
+
+def test_keys_are_counted_separately(window):
+    window.acquire(1, 1, 60, 100)
+    assert window.acquire(1, 1, 60, 100)[0] is False
+    assert window.acquire(2, 1, 60, 100)[0] is True
+
+
+def test_uses_leave_the_window(window):
+    window.acquire(1, 1, 60, 100)
+    assert window.acquire(1, 1, 60, 159)[0] is False
+    assert window.acquire(1, 1, 60, 161)[0] is True
+    assert window.count(1, 60, 161) == 1
+
+
+def test_peek_does_not_count(window):
+    assert window.acquire(1, 1, 60, 100, consume=False) == (True, 0, 0, None)
+    assert window.count(1, 60, 100) == 0
+
+
+def test_release_refunds_only_that_use(window):
+    first = window.acquire(1, 2, 60, 100)[3]
+    second = window.acquire(1, 2, 60, 110)[3]
+    assert first != second
+    window.release(1, first)
+    assert window.count(1, 60, 120) == 1
+    # A second refund of the same use, or one with another key's id, changes nothing
+    window.release(1, first)
+    window.release(2, second)
+    assert window.count(1, 60, 120) == 1
+    assert window.acquire(1, 2, 60, 120)[0] is True
+
+
+def test_purge_drops_expired_uses(window):
+    window.acquire(1, 5, 60, 100)
+    window.acquire(2, 5, 60, 150)
+    window.purge(120)
+    assert window.count(1, 1000, 200) == 0
+    assert window.count(2, 1000, 200) == 1
+
+
+def test_sqlite_window_is_shared(tmp_path):
+    path = str(tmp_path / 'ratelimit.sqlite')
+    first, second = SQLiteWindow(path), SQLiteWindow(path)
+    first.acquire(1, 1, 60, 100)
+    assert second.acquire(1, 1, 60, 100)[0] is False
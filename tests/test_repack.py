@@ -0,0 +1,50 @@
+import os
+import zipfile
+
+from utils.bundle_cache import extract_ipa
+from utils.repack import repack_ipa
+from utils.signing import sign_ipa
+
+
+def test_repack_reuses_unchanged_entries(ipa, fake_zsign, tmp_path):
+    folder = str(tmp_path / 'bundle')
+    extract_ipa(ipa, folder)
+    sign_ipa(folder, 'key.pem', 'profile.mobileprovision', None, zsign_path=fake_zsign)
+    # zsign's cache and debug output stay out of the IPA at any depth
+    os.makedirs(os.path.join(folder, 'Payload', 'Bench.app', '.zsign_debug'))
+    with open(os.path.join(folder, 'Payload', 'Bench.app', '.zsign_debug', 'log'), 'w') as f:
+        f.write('debug')
+
+    output = str(tmp_path / 'signed.ipa')
+    result = repack_ipa(ipa, folder, output, threads=2)
+
+    with zipfile.ZipFile(ipa) as original, zipfile.ZipFile(output) as signed:
+        assert signed.testzip() is None
+        names = signed.namelist()
+        assert names[:len(original.namelist())] == original.namelist()
+        assert names[len(original.namelist()):] == ['Payload/Bench.app/_CodeSignature/CodeResources']
+        for name in names:
+            with open(os.path.join(folder, name), 'rb') as f:
+                assert signed.read(name) == f.read()
+        executable = original.getinfo('Payload/Bench.app/Bench').file_size
+        resources = sum(info.file_size for info in original.infolist()) - executable
+
+    # Only the rewritten executable and the new signature were deflated again
+    assert result.reused_bytes == resources
+    assert result.compressed_bytes == executable + os.path.getsize(
+        os.path.join(folder, 'Payload', 'Bench.app', '_CodeSignature', 'CodeResources')
+    )
+
+
+def test_repack_stored(ipa, tmp_path):
+    folder = str(tmp_path / 'bundle')
+    extract_ipa(ipa, folder)
+    with open(os.path.join(folder, 'Payload', 'Bench.app', 'Bench'), 'ab') as f:
+        f.write(b'signature')
+
+    output = str(tmp_path / 'signed.ipa')
+    repack_ipa(ipa, folder, output, level=0)
+    with zipfile.ZipFile(output) as signed:
+        info = signed.getinfo('Payload/Bench.app/Bench')
+        assert info.compress_type == zipfile.ZIP_STORED
+        assert signed.read(info).endswith(b'signature')
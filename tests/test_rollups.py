@@ -0,0 +1,55 @@
+import sqlite3
+from datetime import datetime
+
+from sqlalchemy import inspect
+
+from models import DailyJobRollup, HourlyJobRollup, SigningJob, db
+from utils.rollups import record_job
+
+
+def finished_job(api_key_id, status='completed'):
+    job = SigningJob(api_key_id=api_key_id, status=status, created_at=datetime(2026, 1, 1, 12, 30))
+    db.session.add(job)
+    db.session.flush()
+    return job
+
+
+def rollup_rows(model):
+    return sorted((row.tier, row.status, row.count) for row in model.query.all())
+
+
+def test_tier_change_within_a_bucket_gets_its_own_row(app, api_key):
+    with app.app_context():
+        record_job(finished_job(api_key[1]), 'regular')
+        record_job(finished_job(api_key[1]), 'regular')
+        record_job(finished_job(api_key[1]), 'premium')
+        record_job(finished_job(api_key[1], 'failed'), 'premium')
+        db.session.commit()
+        for model in (HourlyJobRollup, DailyJobRollup):
+            assert rollup_rows(model) == [('premium', 'completed', 1), ('premium', 'failed', 1), ('regular', 'completed', 2)]
+
+
+def test_old_rollup_constraint_is_replaced(tmp_path, request):
+    # A database from before the tier was part of the rollup key
+    conn = sqlite3.connect(tmp_path / 'zsign.db')
+    conn.execute('CREATE TABLE api_key (id INTEGER PRIMARY KEY, key VARCHAR(64) NOT NULL UNIQUE, '
+                 'name VARCHAR(100) NOT NULL, tier VARCHAR(20) NOT NULL, created_at DATETIME, last_used DATETIME, '
+                 'daily_usage INTEGER, is_active BOOLEAN)')
+    conn.execute("INSERT INTO api_key (id, key, name, tier) VALUES (1, 'old-key', 'Old', 'regular')")
+    for table in ('hourly_job_rollup', 'daily_job_rollup'):
+        conn.execute(f'CREATE TABLE {table} (id INTEGER PRIMARY KEY, bucket DATETIME NOT NULL, '
+                     'api_key_id INTEGER NOT NULL REFERENCES api_key (id), tier VARCHAR(20) NOT NULL, '
+                     'status VARCHAR(20) NOT NULL, count INTEGER NOT NULL, UNIQUE (bucket, api_key_id, status))')
+        conn.execute(f"INSERT INTO {table} (bucket, api_key_id, tier, status, count) "
+                     "VALUES ('2026-01-01 00:00:00.000000', 1, 'regular', 'completed', 5)")
+    conn.commit()
+    conn.close()
+
+    app = request.getfixturevalue('app')
+    with app.app_context():
+        record_job(finished_job(1), 'premium')
+        db.session.commit()
+        for table in ('hourly_job_rollup', 'daily_job_rollup'):
+            unique = inspect(db.engine).get_unique_constraints(table)
+            assert [c['column_names'] for c in unique] == [['bucket', 'api_key_id', 'tier', 'status']]
+        assert rollup_rows(DailyJobRollup) == [('premium', 'completed', 1), ('regular', 'completed', 5)]
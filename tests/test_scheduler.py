@@ -0,0 +1,184 @@
+import time
+import threading
+from collections import Counter
+
+from utils.scheduler import FairScheduler, MemorySlots, SQLiteSlots
+
+
+def drain(scheduler, count):
+    """Run count tasks one at a time and return the tasks in the order they ran."""
+    ran = []
+    for _ in range(count):
+        key_id, task = scheduler.get()
+        ran.append(task)
+        scheduler.done(key_id)
+    return ran
+
+
+def test_tiers_share_turns_by_weight():
+    scheduler = FairScheduler(workers=1)
+    for i in range(20):
+        scheduler.put(('enterprise', i), 1, 'enterprise', 1)
+        scheduler.put(('regular', i), 2, 'regular', 1)
+    ran = drain(scheduler, 9)
+    assert Counter(tier for tier, _ in ran) == {'enterprise': 8, 'regular': 1}
+
+
+def test_keys_in_a_tier_take_turns():
+    scheduler = FairScheduler(workers=1)
+    for i in range(3):
+        scheduler.put(('a', i), 1, 'regular', 1)
+    scheduler.put(('b', 0), 2, 'regular', 1)
+    assert drain(scheduler, 4) == [('a', 0), ('b', 0), ('a', 1), ('a', 2)]
+
+
+def test_unknown_tier_is_regular():
+    scheduler = FairScheduler(workers=1)
+    scheduler.put('task', 1, 'gold', 1)
+    assert scheduler.qsize('regular') == 1
+
+
+def test_key_cap_leaves_slot_to_other_keys():
+    scheduler = FairScheduler(workers=2)
+    scheduler.put('a1', 1, 'regular', 1)
+    scheduler.put('a2', 1, 'regular', 1)
+    scheduler.put('b1', 2, 'regular', 1)
+    assert scheduler.get() == (1, 'a1')
+    # Key 1 is at its cap, so key 2 runs even though key 1 queued first
+    assert scheduler.get() == (2, 'b1')
+    assert scheduler.running() == 2
+    assert scheduler.running(1) == 1
+    scheduler.done(1)
+    assert scheduler.get() == (1, 'a2')
+
+
+def test_reserved_slots_are_kept_for_enterprise():
+    ledger = MemorySlots()
+    wants = {'regular': [(1, 5, 5)]}
+    assert ledger.claim(wants, 2, 1) is not None
+    assert ledger.claim(wants, 2, 1) is None
+    assert ledger.claim({'enterprise': [(2, 5, 1)]}, 2, 1)[:2] == ('enterprise', 2)
+
+
+def test_get_returns_none_once_closed_and_drained():
+    scheduler = FairScheduler(workers=1)
+    scheduler.put('task', 1, 'regular', 1)
+    scheduler.close()
+    assert scheduler.get() == (1, 'task')
+    scheduler.done(1)
+    assert scheduler.get() is None
+    scheduler.reopen()
+    scheduler.put('later', 1, 'regular', 1)
+    assert scheduler.get() == (1, 'later')
+
+
+def test_sqlite_ledger_holds_caps_and_total_across_schedulers(tmp_path):
+    path = str(tmp_path / 'slots.sqlite')
+    first, second = SQLiteSlots(path), SQLiteSlots(path)
+
+    slot = first.claim({'regular': [(1, 1, 2)]}, 2, 0)
+    assert slot[:2] == ('regular', 1)
+    # Key 1's one concurrent task runs in the other scheduler
+    assert second.claim({'regular': [(1, 1, 1)]}, 2, 0) is None
+    assert second.claim({'regular': [(2, 1, 1)]}, 2, 0)[:2] == ('regular', 2)
+    # Both workers of the host are taken
+    assert first.claim({'regular': [(3, 1, 1)]}, 2, 0) is None
+
+    first.release(slot[2])
+    assert second.claim({'regular': [(1, 1, 1)]}, 2, 0)[:2] == ('regular', 1)
+
+
+def test_fair_scheduler_on_shared_ledger(tmp_path):
+    path = str(tmp_path / 'slots.sqlite')
+    first = FairScheduler(workers=1, ledger=SQLiteSlots(path), capacity=1)
+    second = FairScheduler(workers=1, ledger=SQLiteSlots(path), capacity=1)
+    first.put('a', 1, 'regular', 1)
+    second.put('b', 2, 'regular', 1)
+    assert first.get() == (1, 'a')
+    assert second._pick() is None
+    first.done(1)
+    assert second.get() == (2, 'b')
+
+
+class BlockingSlots(MemorySlots):
+    """A ledger whose claims wait until released, like a SQLite write lock held by another process."""
+
+    def __init__(self):
+        super().__init__()
+        self.claiming = threading.Event()
+        self.unblock = threading.Event()
+
+    def claim(self, wants, workers, reserved, free=None):
+        self.claiming.set()
+        self.unblock.wait(5)
+        return super().claim(wants, workers, reserved, free)
+
+
+def test_put_and_done_do_not_wait_for_the_ledger():
+    ledger = BlockingSlots()
+    ledger.unblock.set()
+    scheduler = FairScheduler(workers=2, ledger=ledger)
+    scheduler.put('first', 1, 'regular', 2)
+    assert scheduler.get() == (1, 'first')
+
+    ledger.unblock.clear()
+    scheduler.put('second', 1, 'regular', 2)
+    picked = []
+    dispatcher = threading.Thread(target=lambda: picked.append(scheduler.get()))
+    dispatcher.start()
+    assert ledger.claiming.wait(5)
+
+    started = time.monotonic()
+    scheduler.put('third', 2, 'regular', 1)
+    scheduler.done(1)
+    assert time.monotonic() - started < 1
+
+    ledger.unblock.set()
+    dispatcher.join(5)
+    assert picked == [(1, 'second')]
+
+
+def test_sqlite_ledger_reports_writes_by_others(tmp_path):
+    path = str(tmp_path / 'slots.sqlite')
+    first, second = SQLiteSlots(path), SQLiteSlots(path)
+    first.changed()
+    assert not first.changed()
+
+    slot = second.claim({'regular': [(1, 1, 1)]}, 1, 0, free=1)
+    assert first.changed()
+    # Nothing new is waiting, so a claim that finds no slot writes nothing
+    assert second.claim({'regular': [(2, 1, 1)]}, 1, 0, free=1) is None
+    first.changed()
+    assert second.claim({'regular': [(2, 1, 1)]}, 1, 0, free=1) is None
+    assert not first.changed()
+
+    second.release(slot[2])
+    assert first.changed()
+
+
+def test_waiting_scheduler_wakes_when_another_frees_a_slot(tmp_path):
+    path = str(tmp_path / 'slots.sqlite')
+    first = FairScheduler(workers=1, ledger=SQLiteSlots(path), capacity=1)
+    second = FairScheduler(workers=1, ledger=SQLiteSlots(path), capacity=1)
+    first.put('a', 1, 'regular', 1)
+    assert first.get() == (1, 'a')
+
+    second.put('b', 2, 'regular', 1)
+    picked = []
+    dispatcher = threading.Thread(target=lambda: picked.append(second.get()))
+    dispatcher.start()
+    time.sleep(0.5)
+    assert not picked
+
+    first.done(1)
+    dispatcher.join(2)
+    assert picked == [(2, 'b')]
+
+
+def test_cleared_sqlite_ledger_frees_every_slot(tmp_path):
+    path = str(tmp_path / 'slots.sqlite')
+    SQLiteSlots(path).claim({'regular': [(1, 1, 1)]}, 1, 0)
+
+    # What recover() does before the web workers start
+    SQLiteSlots(path).clear()
+    assert SQLiteSlots(path).claim({'regular': [(2, 1, 1)]}, 1, 0)[:2] == ('regular', 2)
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+from flask import Flask
+
+from utils.signed_cache import SignedCache, file_sha256
+
+
+def make_app(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+    return app
+
+
+def write(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return str(path)
+
+
+@pytest.fixture
+def signed_cache(tmp_path):
+    return SignedCache(make_app(
+        SIGNED_CACHE_FOLDER=str(tmp_path / 'signed'), SIGNED_CACHE_MAX_BYTES=1500
+    ))
+
+
+def test_signed_cache_key_covers_password_and_options():
+    key = SignedCache.make_key('ipa', 'p12', 'prov', 'secret')
+    assert key == SignedCache.make_key('ipa', 'p12', 'prov', 'secret', {})
+    assert key != SignedCache.make_key('ipa', 'p12', 'prov', 'other')
+    assert key != SignedCache.make_key('ipa', 'p12', 'prov', 'secret', {'bundle_id': 'com.example'})
+
+
+def test_signed_cache_put_and_get(signed_cache, tmp_path):
+    source = write(tmp_path / 'signed.ipa', 100)
+    assert signed_cache.get('a' * 64) is None
+    path = signed_cache.put('a' * 64, source)
+    assert signed_cache.get('a' * 64) == path
+    assert file_sha256(path) == file_sha256(source)
+
+
+def test_signed_cache_evicts_least_recently_used(signed_cache, tmp_path):
+    a = signed_cache.put('a', write(tmp_path / 'a.ipa', 600))
+    b = signed_cache.put('b', write(tmp_path / 'b.ipa', 600))
+    os.utime(a, (1, 1))
+    os.utime(b, (2, 2))
+    # The hit makes a the most recently used entry
+    signed_cache.get('a')
+    signed_cache.put('c', write(tmp_path / 'c.ipa', 600))
+    assert signed_cache.get('b') is None
+    assert signed_cache.get('a') and signed_cache.get('c')
+
+
+def test_disabled_signed_cache(signed_cache, tmp_path):
+    signed_cache.max_bytes = 0
+    source = write(tmp_path / 'signed.ipa', 100)
+    assert signed_cache.put('a', source) == source
+    assert signed_cache.get('a') is None
@@ -0,0 +1,101 @@
+import os
+import time
+import zipfile
+
+import pytest
+
+from utils.signing import SigningError, ZsignLimits, parse_cpus, parse_tier_setting, run_zsign, sign_ipa
+
+
+def sign(ipa, tmp_path, zsign_path, **kwargs):
+    return sign_ipa(ipa, 'key.pem', 'profile.mobileprovision', 'password', str(tmp_path / 'signed.ipa'),
+                    zsign_path=zsign_path, **kwargs)
+
+
+def test_parse_settings():
+    assert parse_cpus('0-2,5') == frozenset({0, 1, 2, 5})
+    assert parse_tier_setting('regular=10 premium=5') == {'regular': 10, 'premium': 5}
+    assert parse_tier_setting(None) == {}
+
+
+def test_run_zsign_reports_exit_and_stderr():
+    returncode, stderr, usage = run_zsign(['sh', '-c', 'echo broken >&2; exit 3'])
+    assert (returncode, stderr) == (3, 'broken\n')
+    assert (usage.returncode, usage.stderr, usage.kill_reason) == (3, 'broken\n', None)
+    assert usage.wall_time >= 0
+
+
+def test_timeout_kills_the_process_group(tmp_path):
+    pid_file = tmp_path / 'helper.pid'
+    started = time.monotonic()
+    _, _, usage = run_zsign(['sh', '-c', f'sleep 30 & echo $! > {pid_file}; wait'], ZsignLimits(timeout=0.5))
+    assert usage.kill_reason == 'timeout'
+    assert time.monotonic() - started < 10
+
+    helper = int(pid_file.read_text())
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            os.kill(helper, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail('the helper zsign spawned outlived it')
+
+
+def test_file_size_limit(tmp_path):
+    target = tmp_path / 'big'
+    _, _, usage = run_zsign(
+        ['sh', '-c', f'exec head -c 1048576 /dev/zero > {target}'],
+        ZsignLimits(max_file_size=64 * 1024)
+    )
+    assert usage.kill_reason == 'file_size'
+
+
+def test_sign_ipa(ipa, fake_zsign, tmp_path):
+    result = sign(ipa, tmp_path, fake_zsign)
+    assert result.output_path == str(tmp_path / 'signed.ipa')
+    assert result.usage.returncode == 0
+    with zipfile.ZipFile(result.output_path) as archive:
+        assert 'Payload/Bench.app/Info.plist' in archive.namelist()
+    # zsign ran in a temporary directory, so its cache is not left next to the IPA
+    assert not os.path.exists(tmp_path / '.zsign_cache')
+
+
+def test_sign_folder_keeps_zsign_cache_in_it(ipa, fake_zsign, tmp_path):
+    folder = str(tmp_path / 'bundle')
+    with zipfile.ZipFile(ipa) as archive:
+        archive.extractall(folder)
+    result = sign_ipa(folder, 'key.pem', 'profile.mobileprovision', None, zsign_path=fake_zsign)
+    assert result.output_path == folder
+    assert os.path.isdir(os.path.join(folder, '.zsign_cache'))
+    assert os.path.isfile(os.path.join(folder, 'Payload', 'Bench.app', '_CodeSignature', 'CodeResources'))
+
+
+@pytest.mark.parametrize('failure, reason', [
+    ('password error', 'password'),
+    ('provision error', 'provision'),
+    ('bundle id mismatch', 'bundle_id'),
+    ('something else', 'zsign')
+])
+def test_zsign_failures_are_classified(failure, reason, ipa, fake_zsign, tmp_path, monkeypatch):
+    monkeypatch.setenv('BENCH_ZSIGN_FAIL', failure)
+    with pytest.raises(SigningError) as error:
+        sign(ipa, tmp_path, fake_zsign)
+    assert error.value.reason == reason
+    assert error.value.usage.returncode == 1
+
+
+def test_sign_timeout(ipa, fake_zsign, tmp_path, monkeypatch):
+    monkeypatch.setenv('BENCH_ZSIGN_CPU_MS', '30000')
+    with pytest.raises(SigningError) as error:
+        sign(ipa, tmp_path, fake_zsign, limits=ZsignLimits(timeout=0.5))
+    assert error.value.reason == 'timeout'
+    assert error.value.usage.kill_reason == 'timeout'
+
+
+def test_missing_zsign(ipa, tmp_path):
+    with pytest.raises(SigningError) as error:
+        sign(ipa, tmp_path, str(tmp_path / 'missing'))
+    assert error.value.reason == 'toolchain'
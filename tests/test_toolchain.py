@@ -0,0 +1,128 @@
+import os
+import time
+import shutil
+import subprocess
+
+import pytest
+from flask import Flask
+
+from utils.toolchain import Toolchain
+
+
+def new_toolchain(path, **config):
+    app = Flask(__name__)
+    app.config.update(dict({
+        'ZSIGN_PATH': str(path),
+        'ZSIGN_SHA256': None,
+        'ZSIGN_INSTALL_URL': None,
+        'ZSIGN_INSTALL_REF': None,
+        'ZSIGN_SMOKE_IPA': None,
+        'ZSIGN_RECHECK_INTERVAL': 0,
+        'ZSIGN_WARMUP': False
+    }, **config))
+    return Toolchain(app)
+
+
+@pytest.fixture
+def zsign(fake_zsign, tmp_path):
+    path = tmp_path / 'zsign' / 'zsign'
+    path.parent.mkdir()
+    shutil.copy(fake_zsign, path)
+    return path
+
+
+@pytest.fixture
+def zsign_repo(fake_zsign, tmp_path):
+    """A git repository holding the fake zsign, as the install URL would."""
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    shutil.copy(fake_zsign, repo / 'zsign')
+
+    def git(*args):
+        return subprocess.run(['git', '-C', str(repo), *args], check=True, capture_output=True, text=True).stdout.strip()
+
+    git('init', '-q')
+    git('add', 'zsign')
+    git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'zsign')
+    return repo, git('rev-parse', 'HEAD')
+
+
+def test_prepare_publishes_a_ready_state(zsign):
+    toolchain = new_toolchain(zsign)
+    assert not toolchain.check()
+    assert toolchain.prepare(install=False)
+    status = toolchain.status()
+    assert status['ready'] and status['smoke_test'] == 'passed'
+    assert status['version'] == '0.5 (benchmark stand-in)'
+    assert toolchain.require() == str(zsign)
+
+
+def test_check_never_verifies_on_the_request_path(zsign, monkeypatch):
+    toolchain = new_toolchain(zsign)
+    toolchain.prepare(install=False)
+    zsign.unlink()
+
+    def prepare(install=True):
+        raise AssertionError('check() must not prepare zsign')
+
+    monkeypatch.setattr(toolchain, 'prepare', prepare)
+    # Still the last published result until the background recheck runs
+    assert toolchain.check()
+
+
+def test_recheck_follows_the_binary(zsign, tmp_path):
+    toolchain = new_toolchain(zsign)
+    toolchain.prepare(install=False)
+    state = toolchain.state
+    toolchain.recheck()
+    assert toolchain.state.sha256 == state.sha256 and toolchain.state.checked_at >= state.checked_at
+
+    backup = tmp_path / 'zsign.bak'
+    shutil.move(zsign, backup)
+    toolchain.recheck()
+    assert not toolchain.ready
+    assert 'not found' in toolchain.error
+
+    shutil.move(backup, zsign)
+    toolchain.recheck()
+    assert toolchain.ready
+
+
+def test_background_recheck(zsign):
+    toolchain = new_toolchain(zsign, ZSIGN_RECHECK_INTERVAL=1)
+    toolchain.prepare(install=False)
+    toolchain.start()
+    try:
+        zsign.unlink()
+        deadline = time.monotonic() + 5
+        while toolchain.ready and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        toolchain.shutdown()
+    assert not toolchain.ready
+
+
+def test_unpinned_install_pins_what_it_fetched(zsign_repo, tmp_path):
+    repo, commit = zsign_repo
+    path = tmp_path / 'install' / 'zsign'
+    toolchain = new_toolchain(path, ZSIGN_INSTALL_URL=f'file://{repo}')
+    assert toolchain.prepare()
+
+    with open(f'{path}.pin') as f:
+        pinned_commit, pinned_sha256 = f.read().split()
+    assert (pinned_commit, pinned_sha256) == (commit, toolchain.sha256)
+
+    # A binary swapped after the install no longer matches the recorded checksum
+    with open(path, 'a') as f:
+        f.write('\n# replaced\n')
+    assert not toolchain.prepare()
+    assert 'checksum mismatch' in toolchain.error
+
+
+def test_install_checks_the_pinned_ref(zsign_repo, tmp_path):
+    repo, commit = zsign_repo
+    toolchain = new_toolchain(tmp_path / 'install' / 'zsign', ZSIGN_INSTALL_URL=f'file://{repo}',
+                              ZSIGN_INSTALL_REF=commit, ZSIGN_SHA256='0' * 64)
+    assert not toolchain.prepare()
+    assert 'does not match ZSIGN_SHA256' in toolchain.error
+    assert not os.path.exists(tmp_path / 'install' / 'zsign')
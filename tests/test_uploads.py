@@ -0,0 +1,94 @@
+import io
+import hashlib
+
+import pytest
+from flask import Flask
+
+from utils.uploads import UploadError, UploadStore
+
+
+def new_app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(UPLOAD_FOLDER=str(tmp_path), UPLOAD_SESSION_TTL=60)
+    return app
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadStore(new_app(tmp_path))
+
+
+def test_upload_resumes_in_another_worker(store, tmp_path):
+    upload = store.create(1, 'app.ipa', 10)
+    assert store.append(upload['upload_id'], 1, 0, io.BytesIO(b'hello'))['offset'] == 5
+
+    # A second store has no running hash and rebuilds it from the part file
+    other = UploadStore(new_app(tmp_path))
+    assert other.get(upload['upload_id'], 1)['offset'] == 5
+    done = other.append(upload['upload_id'], 1, 5, io.BytesIO(b'world'))
+    assert done['offset'] == 10
+    assert done['sha256'] == hashlib.sha256(b'helloworld').hexdigest()
+
+    path = tmp_path / 'claimed.ipa'
+    assert store.claim(upload['upload_id'], 1, str(path)) == done['sha256']
+    assert path.read_bytes() == b'helloworld'
+    assert store.get(upload['upload_id'], 1) is None
+
+
+def test_offset_mismatch_reports_current_offset(store):
+    upload = store.create(1, 'app.ipa', 10)
+    store.append(upload['upload_id'], 1, 0, io.BytesIO(b'hello'))
+    with pytest.raises(UploadError) as error:
+        store.append(upload['upload_id'], 1, 3, io.BytesIO(b'lo'))
+    assert (error.value.status, error.value.offset) == (409, 5)
+
+
+def test_chunk_past_declared_size_is_rejected(store):
+    upload = store.create(1, 'app.ipa', 4)
+    with pytest.raises(UploadError) as error:
+        store.append(upload['upload_id'], 1, 0, io.BytesIO(b'hello'))
+    assert error.value.status == 413
+    assert store.get(upload['upload_id'], 1)['offset'] == 0
+
+
+def test_upload_belongs_to_its_key(store):
+    upload = store.create(1, 'app.ipa', 4)
+    assert store.get(upload['upload_id'], 2) is None
+    assert store.get('../etc', 1) is None
+    with pytest.raises(UploadError) as error:
+        store.append(upload['upload_id'], 2, 0, io.BytesIO(b'data'))
+    assert error.value.status == 404
+
+
+def test_incomplete_upload_cannot_be_claimed(store, tmp_path):
+    upload = store.create(1, 'app.ipa', 4)
+    store.append(upload['upload_id'], 1, 0, io.BytesIO(b'da'))
+    with pytest.raises(UploadError):
+        store.claim(upload['upload_id'], 1, str(tmp_path / 'claimed.ipa'))
+
+
+def test_sweep_removes_stale_sessions(store):
+    upload = store.create(1, 'app.ipa', 4)
+    store.ttl = -1
+    store.sweep()
+    assert store.get(upload['upload_id'], 1) is None
+
+
+def test_resume_over_http(app, api_key):
+    client = app.test_client()
+    headers = {'X-API-Key': api_key[0]}
+    response = client.post('/api/uploads', json={'filename': 'app.ipa', 'size': 10}, headers=headers)
+    assert response.status_code == 201
+    upload_url = response.get_json()['upload_url']
+
+    response = client.patch(upload_url, data=b'hello', headers=dict(headers, **{'Upload-Offset': '0'}))
+    assert response.get_json()['offset'] == 5
+    # A retried chunk is refused with the offset to resume from
+    response = client.patch(upload_url, data=b'hello', headers=dict(headers, **{'Upload-Offset': '0'}))
+    assert response.status_code == 409
+    assert client.get(upload_url, headers=headers).get_json()['offset'] == 5
+
+    response = client.patch(upload_url, data=b'world', headers=dict(headers, **{'Upload-Offset': '5'}))
+    body = response.get_json()
+    assert body['complete'] is True
+    assert body['sha256'] == hashlib.sha256(b'helloworld').hexdigest()
@@ -0,0 +1,189 @@
+import hmac
+import json
+import time
+import socket
+import hashlib
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from models import SigningJob, WebhookDelivery, db
+import utils.webhooks
+from utils.webhooks import WebhookDispatcher, enqueue_delivery, signature, url_error, webhooks
+
+
+@pytest.fixture
+def receiver():
+    """A local HTTP server that records each request and answers with its status, 200 by default."""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        status = 200
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            received.append((dict(self.headers), body))
+            self.send_response(Handler.status)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.handler, server.received = Handler, received
+    server.url = f'http://127.0.0.1:{server.server_port}/hook'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def finished_job(api_key_id, url):
+    job = SigningJob(api_key_id=api_key_id, status='completed', input_file='app.ipa',
+                     completed_at=datetime.utcnow(), callback_url=url)
+    db.session.add(job)
+    db.session.flush()
+    delivery = enqueue_delivery(job)
+    db.session.commit()
+    return delivery.id
+
+
+def wait_for_attempt(app, delivery_id, attempts=1, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with app.app_context():
+            delivery = db.session.get(WebhookDelivery, delivery_id)
+            if delivery.attempts >= attempts:
+                return delivery
+        time.sleep(0.05)
+    raise AssertionError('the delivery was never attempted')
+
+
+def test_signature_is_hmac_of_timestamp_and_body():
+    expected = hmac.new(b'secret', b'1700000000.{"id":1}', hashlib.sha256).hexdigest()
+    assert signature('secret', '1700000000', b'{"id":1}') == f'sha256={expected}'
+
+
+@pytest.mark.parametrize('url', [
+    'ftp://example.com/hook',
+    '/relative',
+    'http:///no-host',
+    'http://127.0.0.1/hook',
+    'http://10.0.0.5/hook',
+    'http://169.254.169.254/latest/meta-data',
+    'http://[::1]/hook',
+    'http://[::ffff:127.0.0.1]/hook',
+    'http://localhost:8080/hook'
+])
+def test_url_error_rejects(url, monkeypatch):
+    monkeypatch.setattr(webhooks, 'allow_private', False)
+    assert url_error(url)
+
+
+def test_url_error_accepts_public_and_allowed_private(monkeypatch):
+    monkeypatch.setattr(webhooks, 'allow_private', False)
+    assert url_error('https://93.184.216.34/hook') is None
+    monkeypatch.setattr(webhooks, 'allow_private', True)
+    assert url_error('http://127.0.0.1/hook') is None
+
+
+def test_url_error_does_not_resolve_names(monkeypatch):
+    def getaddrinfo(*args, **kwargs):
+        raise AssertionError('resolved in the request path')
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    monkeypatch.setattr(webhooks, 'allow_private', False)
+    assert url_error('https://hooks.example.com/zsign') is None
+
+
+def test_retry_delay_backs_off_with_jitter():
+    dispatcher = WebhookDispatcher()
+    dispatcher.backoff, dispatcher.max_backoff = 30, 600
+    assert 24 <= dispatcher.retry_delay(1) <= 36
+    assert 96 <= dispatcher.retry_delay(3) <= 144
+    assert dispatcher.retry_delay(10) <= 720
+
+
+def test_delivery_is_signed(app, api_key, receiver):
+    with app.app_context():
+        delivery_id = finished_job(api_key[1], receiver.url)
+    dispatcher = WebhookDispatcher(app)
+    dispatcher.notify()
+    try:
+        delivery = wait_for_attempt(app, delivery_id)
+    finally:
+        dispatcher.shutdown()
+
+    assert (delivery.status, delivery.last_status_code) == ('delivered', 200)
+    headers, body = receiver.received[0]
+    assert json.loads(body)['job']['status'] == 'completed'
+    assert headers['X-Webhook-Id'] == str(delivery_id)
+    with app.app_context():
+        secret = db.session.get(WebhookDelivery, delivery_id).api_key.webhook_secret
+    assert headers['X-Webhook-Signature'] == signature(secret, headers['X-Webhook-Timestamp'], body)
+
+
+def test_failed_delivery_is_retried_then_given_up(app, api_key, receiver):
+    receiver.handler.status = 500
+    with app.app_context():
+        delivery_id = finished_job(api_key[1], receiver.url)
+    dispatcher = WebhookDispatcher(app)
+    dispatcher.max_attempts = 2
+    dispatcher.notify()
+    try:
+        delivery = wait_for_attempt(app, delivery_id)
+        assert (delivery.status, delivery.last_status_code, delivery.last_error) == ('pending', 500, 'HTTP 500')
+        assert (delivery.next_attempt_at - datetime.utcnow()).total_seconds() > 20
+
+        # Make the retry due now; the second failure is the last attempt
+        with app.app_context():
+            db.session.get(WebhookDelivery, delivery_id).next_attempt_at = datetime.utcnow()
+            db.session.commit()
+        dispatcher.notify()
+        delivery = wait_for_attempt(app, delivery_id, attempts=2)
+    finally:
+        dispatcher.shutdown()
+    assert (delivery.status, delivery.attempts) == ('failed', 2)
+    assert len(receiver.received) == 2
+
+
+def test_delivery_connects_to_the_checked_address(app, api_key, receiver, monkeypatch):
+    # The name doesn't exist, so the request can only reach the receiver through the pinned address
+    resolved = []
+    monkeypatch.setattr(utils.webhooks, 'resolve', lambda host: resolved.append(host) or ('127.0.0.1', None))
+    url = f'http://hooks.example.invalid:{receiver.server_port}/hook'
+    with app.app_context():
+        delivery_id = finished_job(api_key[1], url)
+    dispatcher = WebhookDispatcher(app)
+    dispatcher.allow_private = False
+    dispatcher.notify()
+    try:
+        delivery = wait_for_attempt(app, delivery_id)
+    finally:
+        dispatcher.shutdown()
+
+    assert (delivery.status, delivery.last_status_code) == ('delivered', 200)
+    assert resolved == ['hooks.example.invalid']
+    assert receiver.received[0][0]['Host'] == f'hooks.example.invalid:{receiver.server_port}'
+
+
+def test_delivery_to_a_name_rebound_to_a_private_address_fails(app, api_key, receiver, monkeypatch):
+    monkeypatch.setattr(socket, 'getaddrinfo', lambda *args, **kwargs: [
+        (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', ('93.184.216.34', 0)),
+        (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', ('127.0.0.1', 0))
+    ])
+    with app.app_context():
+        delivery_id = finished_job(api_key[1], f'http://hooks.example.invalid:{receiver.server_port}/hook')
+    dispatcher = WebhookDispatcher(app)
+    dispatcher.allow_private = False
+    dispatcher.notify()
+    try:
+        delivery = wait_for_attempt(app, delivery_id)
+    finally:
+        dispatcher.shutdown()
+
+    assert delivery.status == 'pending'
+    assert 'loopback, private or link-local' in delivery.last_error
+    assert receiver.received == []
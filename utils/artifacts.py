@@ -0,0 +1,278 @@
+import os
+import hmac
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from flask import Response, request
+
+from models import SigningJob, db
+from utils.metrics import downloads_total
+
+logger = logging.getLogger(__name__)
+
+# A file stored moments ago may belong to a job whose row isn't committed yet
+GRACE_PERIOD = 5 * 60
+QUERY_CHUNK = 500
+CHUNK_SIZE = 1024 * 1024
+
+
+def job_name(job_id):
+    return f'{job_id}.ipa'
+
+
+def _epoch(dt):
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+class ArtifactStore:
+    """Signed IPAs kept for download under their job id.
+
+    A job's artifact is its own name in SIGNED_FOLDER, hard-linked to the
+    signed cache entry when there is one, so cache eviction never breaks a
+    download and a cache hit costs no copy. A background sweeper removes
+    artifacts ARTIFACT_TTL seconds after their job finished, and the
+    oldest ones beyond ARTIFACT_MAX_BYTES.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.folder = None
+        self.ttl = 7 * 24 * 60 * 60
+        self.max_bytes = 0
+        self.sweep_interval = 300
+        self.secret = b''
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.folder = app.config['SIGNED_FOLDER']
+        self.ttl = app.config['ARTIFACT_TTL']
+        self.max_bytes = app.config['ARTIFACT_MAX_BYTES']
+        self.sweep_interval = app.config['ARTIFACT_SWEEP_INTERVAL']
+        self.secret = app.config['SECRET_KEY'].encode()
+        os.makedirs(self.folder, exist_ok=True)
+        app.extensions['artifact_store'] = self
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def store(self, name, source_path, keep_source=False):
+        """Put a signed IPA under name and return its path.
+
+        The source is moved in, or hard-linked (copied across filesystems)
+        with keep_source.
+        """
+        self.start()
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            if not keep_source:
+                shutil.move(source_path, tmp_path)
+            else:
+                try:
+                    os.link(source_path, tmp_path)
+                except OSError:
+                    shutil.copyfile(source_path, tmp_path)
+            path = self.path(name)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def expires_at(self, job):
+        return job.completed_at + timedelta(seconds=self.ttl)
+
+    def job_path(self, job):
+        """Return the path of a completed job's artifact, or None once it expired."""
+        if job.status != 'completed' or not job.output_file or self.expires_at(job) <= datetime.utcnow():
+            return None
+        path = self.path(job_name(job.id))
+        return path if os.path.exists(path) else None
+
+    def url_signature(self, job_id, expires):
+        return hmac.new(self.secret, f'artifact.{job_id}.{expires}'.encode(), hashlib.sha256).hexdigest()
+
+    def signed_query(self, job):
+        """Query arguments that let anyone holding them download a job's artifact until it expires."""
+        expires = int(_epoch(self.expires_at(job)))
+        return {'expires': expires, 'signature': self.url_signature(job.id, expires)}
+
+    def verify(self, job_id, expires, signature):
+        if not expires or not signature or not expires.isdigit() or int(expires) < time.time():
+            return False
+        return hmac.compare_digest(self.url_signature(job_id, int(expires)), signature)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='artifact-sweeper', daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.sweep_interval):
+            try:
+                with self.app.app_context():
+                    self.sweep()
+            except Exception:
+                logger.exception('Failed to sweep signed artifacts')
+
+    def sweep(self):
+        """Remove expired artifacts, then the oldest ones until the store fits in its quota."""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.folder):
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if entry.is_file(follow_symlinks=False):
+                stem = entry.name[:-len('.ipa')] if entry.name.endswith('.ipa') else None
+                job_id = int(stem) if stem and stem.isdigit() else None
+                entries.append([stat.st_mtime, entry.path, job_id, stat])
+
+        # A job's artifact ages from when the job finished; anything else, such as admin test signings, from its mtime
+        job_ids = [job_id for _, _, job_id, _ in entries if job_id is not None]
+        finished = {}
+        for i in range(0, len(job_ids), QUERY_CHUNK):
+            finished.update(db.session.query(SigningJob.id, SigningJob.completed_at).filter(
+                SigningJob.id.in_(job_ids[i:i + QUERY_CHUNK])
+            ))
+        for item in entries:
+            if item[2] is not None:
+                completed_at = finished.get(item[2])
+                item[0] = _epoch(completed_at) if completed_at else 0
+
+        entries.sort(key=lambda item: item[0])
+        # Several artifacts may share one inode, which only frees its space once the last is gone
+        links = Counter((stat.st_dev, stat.st_ino) for *_, stat in entries)
+        total = sum({(stat.st_dev, stat.st_ino): stat.st_size for *_, stat in entries}.values())
+        removed = []
+        for age, path, job_id, stat in entries:
+            expired = age < now - self.ttl
+            if not expired and (not self.max_bytes or total <= self.max_bytes):
+                continue
+            if stat.st_ctime > now - GRACE_PERIOD:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            links[inode] -= 1
+            if not links[inode]:
+                total -= stat.st_size
+            if job_id is not None:
+                removed.append(job_id)
+
+        for i in range(0, len(removed), QUERY_CHUNK):
+            SigningJob.query.filter(SigningJob.id.in_(removed[i:i + QUERY_CHUNK])).update(
+                {SigningJob.output_file: None}, synchronize_session=False
+            )
+        db.session.commit()
+        if removed:
+            logger.info(f'Removed {len(removed)} signed artifact(s)')
+        return len(removed)
+
+
+def _read_range(f, length):
+    with f:
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+def send_artifact(path, download_name, last_modified=None):
+    """Serve a stored artifact for the current request.
+
+    Handles ETag and Last-Modified validators, If-Range and a single byte
+    range. A whole file is handed to the server's file wrapper, which
+    gunicorn sends with sendfile() without copying it through Python; a
+    range is read and sent by length, since a file wrapper in general
+    sends everything up to the end of the file.
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    # An artifact is never rewritten in place, so its inode identifies its content
+    etag = f'{stat.st_ino:x}-{size:x}'
+    last_modified = (last_modified or datetime.utcfromtimestamp(stat.st_mtime)).replace(microsecond=0)
+
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': last_modified.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private'
+    }
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        not_modified = since is not None and last_modified <= since.replace(tzinfo=None)
+    if not_modified:
+        downloads_total.inc(status='304')
+        return Response(status=304, headers=headers)
+
+    start, end = 0, size
+    status = 200
+    byte_range = request.range
+    if_range = request.if_range
+    # A stale If-Range asks for the whole file instead of a piece of the new one
+    range_valid = not (if_range.etag or if_range.date) or if_range.etag == etag or (
+        if_range.date is not None and last_modified <= if_range.date.replace(tzinfo=None)
+    )
+    if byte_range and range_valid and byte_range.units == 'bytes' and len(byte_range.ranges) == 1:
+        span = byte_range.range_for_length(size)
+        if span is None:
+            downloads_total.inc(status='416')
+            return Response(status=416, headers=dict(headers, **{'Content-Range': f'bytes */{size}'}))
+        start, end = span
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+
+    body = None
+    if request.method != 'HEAD':
+        f = open(path, 'rb')
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper and start == 0 and end == size:
+            body = file_wrapper(f)
+        else:
+            f.seek(start)
+            body = _read_range(f, end - start)
+    response = Response(
+        body,
+        status=status,
+        headers=headers,
+        mimetype='application/octet-stream',
+        direct_passthrough=True
+    )
+    response.headers['Content-Length'] = str(end - start)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    downloads_total.inc(status=str(status))
+    return response
+
+
+artifact_store = ArtifactStore()
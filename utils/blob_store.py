@@ -0,0 +1,149 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import Blob, db
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = 10 * 60
+
+
+class BlobError(Exception):
+    pass
+
+
+class BlobStore:
+    """Deduplicated store of recently uploaded signing inputs, so repeat requests can skip the upload.
+
+    Each file is kept once under its SHA-256 and hard-linked into job
+    workspaces. A Blob row per key is its reference to the file, so a hash
+    alone never grants access to another user's IPA or certificate. A
+    reference expires BLOB_TTL seconds after it was last used, and a file
+    is removed once no reference to it is left.
+    """
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.ttl = 0
+        self._next_sweep = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['BLOB_FOLDER']
+        self.ttl = app.config['BLOB_TTL']
+        os.makedirs(self.folder, exist_ok=True)
+        app.extensions['blob_store'] = self
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def path(self, sha256):
+        return os.path.join(self.folder, sha256)
+
+    def find(self, api_key_id, sha256, size=None):
+        """Return the key's live Blob for sha256 (and size, if given), or None."""
+        if not self.enabled:
+            return None
+        blob = Blob.query.filter_by(api_key_id=api_key_id, sha256=sha256.lower()).first()
+        if blob is None or blob.last_used_at < datetime.utcnow() - timedelta(seconds=self.ttl):
+            return None
+        if size is not None and blob.size != size:
+            return None
+        if not os.path.exists(self.path(blob.sha256)):
+            return None
+        return blob
+
+    def touch(self, blob):
+        """Renew a reference's TTL; the caller commits."""
+        blob.last_used_at = datetime.utcnow()
+
+    def checkout(self, api_key_id, sha256, dest):
+        """Link the key's blob to dest and return its Blob row; the caller commits the renewed TTL."""
+        blob = self.find(api_key_id, sha256)
+        if blob is None:
+            raise BlobError(f'Blob {sha256} not found')
+        try:
+            os.link(self.path(blob.sha256), dest)
+        except FileNotFoundError:
+            # Swept between find() and here
+            raise BlobError(f'Blob {sha256} not found')
+        except OSError:
+            shutil.copyfile(self.path(blob.sha256), dest)
+        self.touch(blob)
+        return blob
+
+    def adopt(self, api_key_id, path, sha256, filename):
+        """Keep a freshly uploaded file whose hash is already known; the caller commits.
+
+        The file is hard-linked, so it stays usable where it is.
+        """
+        if not self.enabled:
+            return
+        self.maybe_sweep()
+        target = self.path(sha256)
+        if not os.path.exists(target):
+            fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+            os.close(fd)
+            os.remove(tmp_path)
+            try:
+                try:
+                    os.link(path, tmp_path)
+                except OSError:
+                    shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, target)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        size = os.path.getsize(target)
+        now = datetime.utcnow()
+        values = {Blob.last_used_at: now, Blob.size: size, Blob.filename: filename}
+        if Blob.query.filter_by(api_key_id=api_key_id, sha256=sha256).update(values):
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.add(Blob(api_key_id=api_key_id, sha256=sha256, filename=filename, size=size,
+                                    last_used_at=now))
+        except IntegrityError:
+            # A concurrent request from the same key adopted the same file
+            Blob.query.filter_by(api_key_id=api_key_id, sha256=sha256).update(values)
+
+    def maybe_sweep(self):
+        if time.monotonic() < self._next_sweep:
+            return
+        self._next_sweep = time.monotonic() + SWEEP_INTERVAL
+        try:
+            self.sweep()
+        except Exception:
+            logger.exception('Failed to sweep the blob store')
+
+    def sweep(self):
+        """Drop expired references, then every file that no reference points to; the caller commits."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        expired = Blob.query.filter(Blob.last_used_at < cutoff).delete(synchronize_session=False)
+        referenced = {sha256 for (sha256,) in db.session.query(Blob.sha256).distinct()}
+
+        removed = 0
+        recent = time.time() - SWEEP_INTERVAL
+        for entry in os.scandir(self.folder):
+            # A file linked in moments ago may belong to a reference another request hasn't committed yet
+            if entry.name in referenced or entry.stat().st_ctime > recent:
+                continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        if expired or removed:
+            logger.info(f'Blob store sweep: {expired} expired reference(s), {removed} file(s) removed')
+
+
+blob_store = BlobStore()
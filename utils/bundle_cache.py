@@ -0,0 +1,177 @@
+import os
+import fcntl
+import shutil
+import logging
+import zipfile
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def extract_ipa(ipa_path, dest):
+    """Unpack an IPA into dest and return the uncompressed size in bytes."""
+    with zipfile.ZipFile(ipa_path) as archive:
+        archive.extractall(dest)
+        return sum(info.file_size for info in archive.infolist())
+
+
+def tree_size(path):
+    """Bytes in the files under path, or 0 if it does not exist."""
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class BundleCache:
+    """LRU cache of extracted IPAs, keyed by the SHA-256 of the IPA.
+
+    zsign re-signs a folder in place and keeps its own cache in the
+    directory it runs in, so jobs run it inside the entry's folder: a
+    second signing of the same app (even with another certificate) then
+    only re-signs the Mach-O binaries and _CodeSignature. That
+    .zsign_cache counts towards the entry's size and goes with it on
+    eviction. Each entry is guarded by an flock so only one job signs a
+    given folder at a time.
+    """
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.max_bytes = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['BUNDLE_CACHE_FOLDER']
+        self.max_bytes = app.config['BUNDLE_CACHE_MAX_BYTES']
+        os.makedirs(self.folder, exist_ok=True)
+        app.extensions['bundle_cache'] = self
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _paths(self, key):
+        base = os.path.join(self.folder, key)
+        return base, f'{base}.size', f'{base}.lock'
+
+    @staticmethod
+    def _read_size(size_path):
+        """(extracted bytes, .zsign_cache bytes) from an entry's size file."""
+        with open(size_path) as f:
+            sizes = [int(value) for value in f.read().split()]
+        return sizes[0] if sizes else 0, sum(sizes[1:])
+
+    @staticmethod
+    def _write_size(size_path, extracted, zsign_cache):
+        with open(size_path, 'w') as f:
+            f.write(f'{extracted} {zsign_cache}')
+
+    @contextmanager
+    def _locked(self, key, blocking=True):
+        """Hold the flock on key's lock file, yielding False instead if blocking=False and it is taken.
+
+        Eviction unlinks the lock file, so a lock taken on a file that was
+        unlinked meanwhile is dropped and taken again on the new one.
+        """
+        lock_path = self._paths(key)[2]
+        while True:
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    if os.path.exists(lock_path) and os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                        yield True
+                        return
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _remove(self, key):
+        """Delete an entry's folder, size file and lock file; the caller holds its lock."""
+        bundle_dir, size_path, lock_path = self._paths(key)
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+        for path in (size_path, lock_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @contextmanager
+    def checkout(self, key, ipa_path, extract=extract_ipa, blocking=True):
+        """Yield the extracted bundle for key, unpacking ipa_path on a miss.
+
+        extract is called as extract(ipa_path, dest) and may be a function
+        that runs the unzip in a worker process. The bundle is also the
+        directory zsign should run in. If the body raises, the entry is
+        dropped because zsign may have left it half signed. With
+        blocking=False, None is yielded while another job holds the entry.
+        """
+        bundle_dir, size_path, lock_path = self._paths(key)
+        with self._locked(key, blocking) as locked:
+            if not locked:
+                yield None
+                return
+            if os.path.isdir(bundle_dir):
+                os.utime(bundle_dir)
+                try:
+                    extracted, _ = self._read_size(size_path)
+                except (FileNotFoundError, ValueError):
+                    extracted = tree_size(bundle_dir)
+            else:
+                tmp_dir = tempfile.mkdtemp(dir=self.folder, prefix=f'{key}.', suffix='.tmp')
+                try:
+                    extracted = extract(ipa_path, tmp_dir)
+                    os.rename(tmp_dir, bundle_dir)
+                except Exception:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    raise
+                self._write_size(size_path, extracted, 0)
+
+            try:
+                yield bundle_dir
+            except Exception:
+                self._remove(key)
+                raise
+            self._write_size(size_path, extracted, tree_size(os.path.join(bundle_dir, '.zsign_cache')))
+
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.folder):
+                if not entry.name.endswith('.size'):
+                    continue
+                key = entry.name[:-len('.size')]
+                bundle_dir, size_path, lock_path = self._paths(key)
+                try:
+                    size = sum(self._read_size(size_path))
+                    mtime = os.stat(bundle_dir).st_mtime
+                except (FileNotFoundError, ValueError):
+                    continue
+                entries.append((mtime, size, key))
+                total += size
+
+            entries.sort()
+            for _, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+                # Skip bundles a job is signing right now
+                with self._locked(key, blocking=False) as locked:
+                    if not locked:
+                        continue
+                    self._remove(key)
+                    logger.info(f'Evicted extracted bundle {key} from cache')
+                total -= size
+
+
+bundle_cache = BundleCache()
@@ -1 +1,51 @@
-# File removed as we're using zsign implementation
+from datetime import datetime
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives.serialization import pkcs12, Encoding, PrivateFormat, NoEncryption
+
+
+class CertificateError(Exception):
+    pass
+
+
+def load_p12(data: bytes, password: str):
+    """Unlock a P12 and return its (private_key, certificate) pair."""
+    try:
+        private_key, certificate, _ = pkcs12.load_key_and_certificates(data, password.encode())
+    except ValueError:
+        raise CertificateError("Invalid P12 certificate password")
+    if private_key is None or certificate is None:
+        raise CertificateError("P12 must contain a private key and a certificate")
+    return private_key, certificate
+
+
+def _name_attribute(certificate, oid):
+    values = certificate.subject.get_attributes_for_oid(oid)
+    return values[0].value if values else None
+
+
+def not_after(certificate) -> datetime:
+    # not_valid_after_utc only exists from cryptography 42; both are UTC
+    if hasattr(certificate, 'not_valid_after_utc'):
+        return certificate.not_valid_after_utc.replace(tzinfo=None)
+    return certificate.not_valid_after
+
+
+def certificate_info(certificate) -> dict:
+    return {
+        'common_name': _name_attribute(certificate, NameOID.COMMON_NAME),
+        # Apple puts the team identifier in the subject's OU
+        'team_id': _name_attribute(certificate, NameOID.ORGANIZATIONAL_UNIT_NAME),
+        'serial': format(certificate.serial_number, 'x'),
+        'expires_at': not_after(certificate)
+    }
+
+
+def certificate_der(certificate) -> bytes:
+    return certificate.public_bytes(Encoding.DER)
+
+
+def export_pem(private_key, certificate):
+    """Return the unlocked key and certificate as PEM bytes for zsign's -k/-c."""
+    key_pem = private_key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+    cert_pem = certificate.public_bytes(Encoding.PEM)
+    return key_pem, cert_pem
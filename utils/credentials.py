@@ -0,0 +1,104 @@
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from cryptography.fernet import Fernet
+
+from models import SigningCredential
+from utils.certificate_handler import CertificateError, load_p12, export_pem
+from utils.inspection import InspectionError, check_pair
+from utils.provisioning import ProvisioningError, parse_profile
+
+
+class CredentialError(Exception):
+    pass
+
+
+class CredentialRegistry:
+    """Validated signing credentials that clients upload once and sign with by id.
+
+    The P12 is unlocked at registration time and stored as PEM key material
+    encrypted with SECRET_KEY. Decrypted material is kept in a small LRU so
+    repeat signings only write two PEM files instead of re-parsing the P12.
+    """
+
+    def __init__(self, app=None):
+        self._fernet = None
+        self.cache_size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        secret = hashlib.sha256(app.config['SECRET_KEY'].encode()).digest()
+        self._fernet = Fernet(base64.urlsafe_b64encode(secret))
+        self.cache_size = app.config['CREDENTIAL_CACHE_SIZE']
+        app.extensions['credential_registry'] = self
+
+    def register(self, api_key_id, name, p12_data, p12_password, profile_data):
+        """Validate a P12 and profile pair and return an unsaved SigningCredential."""
+        try:
+            private_key, certificate = load_p12(p12_data, p12_password)
+            profile = parse_profile(profile_data)
+        except (CertificateError, ProvisioningError) as e:
+            raise CredentialError(str(e))
+
+        try:
+            cert = check_pair(certificate, profile)
+        except InspectionError as e:
+            raise CredentialError(str(e))
+
+        key_pem, cert_pem = export_pem(private_key, certificate)
+        return SigningCredential(
+            api_key_id=api_key_id,
+            name=name,
+            certificate_name=cert['common_name'],
+            certificate_serial=cert['serial'],
+            team_id=profile['team_id'] or cert['team_id'],
+            profile_name=profile['name'],
+            bundle_id=profile['bundle_id'],
+            expires_at=min(cert['expires_at'], profile['expires_at']),
+            p12_sha256=hashlib.sha256(p12_data).hexdigest(),
+            profile_sha256=hashlib.sha256(profile_data).hexdigest(),
+            key_material=self._fernet.encrypt(key_pem + cert_pem),
+            profile=profile_data
+        )
+
+    def get(self, credential_id, api_key_id):
+        return SigningCredential.query.filter_by(id=credential_id, api_key_id=api_key_id).first()
+
+    def unlocked(self, credential):
+        """Return (key_pem, cert_pem) for a credential, decrypting on a cache miss."""
+        with self._lock:
+            if credential.id in self._cache:
+                self._cache.move_to_end(credential.id)
+                return self._cache[credential.id]
+
+        material = self._fernet.decrypt(credential.key_material)
+        split = material.index(b'-----BEGIN CERTIFICATE-----')
+        pair = (material[:split], material[split:])
+
+        with self._lock:
+            self._cache[credential.id] = pair
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return pair
+
+    def materialize(self, credential, workspace):
+        """Write the credential's key, certificate and profile into a job workspace."""
+        key_pem, cert_pem = self.unlocked(credential)
+        for path, data in [
+            (workspace.key_path, key_pem),
+            (workspace.cert_path, cert_pem),
+            (workspace.prov_path, credential.profile)
+        ]:
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    def forget(self, credential_id):
+        with self._lock:
+            self._cache.pop(credential_id, None)
+
+
+credential_registry = CredentialRegistry()
@@ -1,105 +1,169 @@
 import discord
 from discord import app_commands
 import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError
 from models import APIKey, db
 from app import create_app
 
 class KeyManagementBot(discord.Client):
-    def __init__(self):
+    def __init__(self, app):
         intents = discord.Intents.default()
         intents.message_content = True
         intents.members = True
         super().__init__(intents=intents)
+        self.app = app
         self.tree = app_commands.CommandTree(self)
+        # Bounded pool so a slow database queues bot DB work instead of blocking the event loop
+        self.db_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('DISCORD_DB_WORKERS', '4')),
+            thread_name_prefix='discord-db'
+        )
+
+    def _with_app_context(self, fn, *args):
+        with self.app.app_context():
+            return fn(*args)
+
+    async def run_db(self, fn, *args):
+        """Run a blocking database function on the DB thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.db_executor,
+            functools.partial(self._with_app_context, fn, *args)
+        )
 
     async def setup_hook(self):
         print(f'Bot is being set up...')
+        backfilled = await self.run_db(backfill_discord_user_ids)
+        if backfilled:
+            print(f'Linked {backfilled} existing free keys to their Discord users')
         await self.tree.sync()
-        
+
     async def on_ready(self):
         print(f'Logged in as {self.user.name}')
         print('Bot is ready!')
 
+    async def close(self):
+        await super().close()
+        self.db_executor.shutdown(wait=False)
+
+def create_free_key(discord_user_id, username):
+    """Insert a free key for a Discord user, or return None if they already have one.
+
+    The unique index on discord_user_id makes the check and the insert a
+    single atomic step, so concurrent requests from one user can't both win.
+    """
+    api_key = APIKey(
+        key=APIKey.generate_key(),
+        name=f'Free-{username}-{discord_user_id}',
+        tier='regular',
+        discord_user_id=discord_user_id
+    )
+    db.session.add(api_key)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return api_key.key
+
+def delete_key(key):
+    APIKey.query.filter_by(key=key).delete()
+    db.session.commit()
+
+def backfill_discord_user_ids():
+    """Link free keys created before discord_user_id existed, using the id in their name."""
+    linked = 0
+    legacy_keys = APIKey.query.filter(
+        APIKey.discord_user_id.is_(None),
+        APIKey.name.like('Free-%')
+    ).all()
+    for api_key in legacy_keys:
+        user_id = api_key.name.rsplit('-', 1)[-1]
+        if not user_id.isdigit():
+            continue
+        try:
+            with db.session.begin_nested():
+                api_key.discord_user_id = int(user_id)
+            linked += 1
+        except IntegrityError:
+            # A second legacy key for the same user; leave it unlinked
+            pass
+    db.session.commit()
+    return linked
+
 def run_bot():
-    # Create Flask app context
-    app = create_app()
-    with app.app_context():
-        bot = KeyManagementBot()
-
-        @bot.tree.command(name="request_free", description="Request a free API key (10 requests/day)")
-        async def request_free(interaction: discord.Interaction):
-            """Request a free API key with IP restriction"""
-            server_id = os.getenv('DISCORD_SERVER_ID')
-            if str(interaction.guild_id) != server_id:
-                await interaction.response.send_message(
-                    "Free key requests are only available in our official server.",
-                    ephemeral=True
-                )
-                return
-
-            # Check if user already has a key
-            existing_key = APIKey.query.filter(
-                APIKey.name.like(f'Free-{interaction.user.name}-%')
-            ).first()
-
-            if existing_key:
-                await interaction.response.send_message(
-                    "You already have a free API key. Only one free key per user is allowed.\n"
-                    "For premium access with higher limits, please contact an admin in the server.",
-                    ephemeral=True
-                )
-                return
-
-            # Create API key with user's Discord ID in name for tracking
-            api_key = APIKey(
-                key=APIKey.generate_key(),
-                name=f'Free-{interaction.user.name}-{interaction.user.id}',
-                tier='regular'
+    # Create Flask app; DB work runs in the bot's thread pool with its own app context.
+    # The bot never signs, so it skips the zsign warm-up the web workers do.
+    app = create_app({'ZSIGN_WARMUP': False})
+    bot = KeyManagementBot(app)
+
+    @bot.tree.command(name="request_free", description="Request a free API key (10 requests/day)")
+    async def request_free(interaction: discord.Interaction):
+        """Request a free API key with IP restriction"""
+        server_id = os.getenv('DISCORD_SERVER_ID')
+        if str(interaction.guild_id) != server_id:
+            await interaction.response.send_message(
+                "Free key requests are only available in our official server.",
+                ephemeral=True
             )
-            
-            # Save to database
-            try:
-                db.session.add(api_key)
-                db.session.commit()
-                
-                # Send key via DM
-                try:
-                    await interaction.user.send(
-                        f"Here's your free API key: `{api_key.key}`\n\n"
-                        f"📝 Key Details:\n"
-                        f"• Rate Limit: 10 signing requests per day\n"
-                        f"• Valid for IP-restricted usage only\n\n"
-                        f"🔒 Important:\n"
-                        f"• Keep this key secure and don't share it\n"
-                        f"• For premium access (100 requests/day), contact an admin\n"
-                        f"• Report any security concerns to admins immediately"
-                    )
-                    await interaction.response.send_message(
-                        "✨ I've sent your free API key via DM! Check your messages for details.\n"
-                        "For premium access with higher limits, please contact an admin.",
-                        ephemeral=True
-                    )
-                except discord.Forbidden:
-                    await interaction.response.send_message(
-                        "I couldn't send you a DM. Please enable DMs from server members and try again.",
-                        ephemeral=True
-                    )
-                    # Rollback the key creation if we couldn't send it
-                    db.session.delete(api_key)
-                    db.session.commit()
-            except Exception as e:
-                print(f"Error creating API key: {str(e)}")
-                await interaction.response.send_message(
-                    "There was an error processing your request. Please try again later.",
-                    ephemeral=True
-                )
-
-        token = os.getenv('DISCORD_BOT_TOKEN')
-        if not token:
-            print("Error: DISCORD_BOT_TOKEN not found in environment variables")
             return
-            
+
+        # Acknowledge now so a slow database can't expire the interaction
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        # Create API key with user's Discord ID for tracking
         try:
-            bot.run(token)
+            key = await bot.run_db(create_free_key, interaction.user.id, interaction.user.name)
         except Exception as e:
-            print(f"Error running bot: {str(e)}")
+            print(f"Error creating API key: {str(e)}")
+            await interaction.followup.send(
+                "There was an error processing your request. Please try again later.",
+                ephemeral=True
+            )
+            return
+
+        if key is None:
+            await interaction.followup.send(
+                "You already have a free API key. Only one free key per user is allowed.\n"
+                "For premium access with higher limits, please contact an admin in the server.",
+                ephemeral=True
+            )
+            return
+
+        # Send key via DM
+        try:
+            await interaction.user.send(
+                f"Here's your free API key: `{key}`\n\n"
+                f"📝 Key Details:\n"
+                f"• Rate Limit: 10 signing requests per day\n"
+                f"• Valid for IP-restricted usage only\n\n"
+                f"🔒 Important:\n"
+                f"• Keep this key secure and don't share it\n"
+                f"• For premium access (100 requests/day), contact an admin\n"
+                f"• Report any security concerns to admins immediately"
+            )
+            await interaction.followup.send(
+                "✨ I've sent your free API key via DM! Check your messages for details.\n"
+                "For premium access with higher limits, please contact an admin.",
+                ephemeral=True
+            )
+        except discord.Forbidden:
+            await interaction.followup.send(
+                "I couldn't send you a DM. Please enable DMs from server members and try again.",
+                ephemeral=True
+            )
+            # Rollback the key creation if we couldn't send it
+            await bot.run_db(delete_key, key)
+
+    token = os.getenv('DISCORD_BOT_TOKEN')
+    if not token:
+        print("Error: DISCORD_BOT_TOKEN not found in environment variables")
+        return 1
+
+    try:
+        bot.run(token)
+    except Exception as e:
+        print(f"Error running bot: {str(e)}")
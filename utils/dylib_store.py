@@ -0,0 +1,84 @@
+import os
+import shutil
+import logging
+import tempfile
+
+from models import Dylib, db
+from utils.uploads import save_upload
+
+logger = logging.getLogger(__name__)
+
+# Thin 32/64-bit Mach-O in either byte order, and fat (universal) binaries
+MACHO_MAGICS = {
+    b'\xfe\xed\xfa\xce', b'\xce\xfa\xed\xfe',
+    b'\xfe\xed\xfa\xcf', b'\xcf\xfa\xed\xfe',
+    b'\xca\xfe\xba\xbe', b'\xbe\xba\xfe\xca'
+}
+
+
+class DylibError(Exception):
+    pass
+
+
+class DylibStore:
+    """Content-addressed store of dylibs for zsign to inject.
+
+    Each file is kept once under its SHA-256 however many keys upload it;
+    a Dylib row per key records who may reference it, so a hash alone
+    never grants access to another user's tweak.
+    """
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.upload_folder = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['DYLIB_FOLDER']
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        os.makedirs(self.folder, exist_ok=True)
+        app.extensions['dylib_store'] = self
+
+    def path(self, sha256):
+        return os.path.join(self.folder, f'{sha256}.dylib')
+
+    def put(self, api_key_id, file_storage, filename):
+        """Store an uploaded dylib and return the key's Dylib row; the caller commits."""
+        os.makedirs(self.upload_folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.upload_folder, suffix='.dylib')
+        os.close(fd)
+        try:
+            sha256 = save_upload(file_storage, tmp_path)
+            with open(tmp_path, 'rb') as f:
+                if f.read(4) not in MACHO_MAGICS:
+                    raise DylibError('File is not a Mach-O dylib')
+            size = os.path.getsize(tmp_path)
+            if not os.path.exists(self.path(sha256)):
+                shutil.move(tmp_path, self.path(sha256))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        dylib = Dylib.query.filter_by(api_key_id=api_key_id, sha256=sha256).first()
+        if dylib is None:
+            dylib = Dylib(api_key_id=api_key_id, sha256=sha256, filename=filename, size=size)
+            db.session.add(dylib)
+        return dylib
+
+    def resolve(self, api_key_id, hashes):
+        """Return the stored paths for the key's dylibs, in the order given."""
+        hashes = [h.lower() for h in hashes]
+        known = {d.sha256 for d in Dylib.query.filter(
+            Dylib.api_key_id == api_key_id,
+            Dylib.sha256.in_(hashes)
+        )}
+        paths = []
+        for sha256 in hashes:
+            if sha256 not in known or not os.path.exists(self.path(sha256)):
+                raise DylibError(f'Dylib {sha256} not found')
+            paths.append(self.path(sha256))
+        return paths
+
+
+dylib_store = DylibStore()
@@ -0,0 +1,155 @@
+import re
+import zipfile
+import plistlib
+from datetime import datetime
+
+from utils.certificate_handler import CertificateError, load_p12, certificate_info, certificate_der
+from utils.provisioning import ProvisioningError, parse_profile, bundle_id_allowed
+
+# Info.plist of the app itself, not of its frameworks or extensions
+APP_INFO_PLIST = re.compile(r'^Payload/([^/]+\.app)/Info\.plist$')
+MAX_INFO_PLIST_SIZE = 4 * 1024 * 1024
+# Rewritten for the signing team by zsign, so never missing from the result
+TEAM_ENTITLEMENTS = {'application-identifier', 'com.apple.developer.team-identifier', 'keychain-access-groups'}
+
+
+class InspectionError(Exception):
+    """A sign request whose inputs can't produce a usable IPA; code and details are returned to the client."""
+
+    def __init__(self, message, code, details=None):
+        super().__init__(message)
+        self.code = code
+        self.details = details or {}
+
+
+def _read_plist(archive, name):
+    entry = archive.getinfo(name)
+    if entry.file_size > MAX_INFO_PLIST_SIZE:
+        raise InspectionError(f'{name} is too large', 'invalid_ipa', {'size': entry.file_size})
+    return plistlib.loads(archive.read(entry))
+
+
+def read_app_info(ipa_path):
+    """Read the app's Info.plist, and its entitlements when Xcode archived them, straight out of the IPA.
+
+    Only the zip central directory and those two entries are read, however
+    large the IPA is.
+    """
+    try:
+        with zipfile.ZipFile(ipa_path) as archive:
+            matches = [(APP_INFO_PLIST.match(name), name) for name in archive.namelist()]
+            apps = [(match.group(1), name) for match, name in matches if match]
+            if len(apps) != 1:
+                raise InspectionError(
+                    'IPA must contain exactly one Payload/*.app bundle',
+                    'invalid_ipa',
+                    {'apps': [app for app, _ in apps]}
+                )
+            app_dir, plist_name = apps[0]
+            plist = _read_plist(archive, plist_name)
+            executable = plist.get('CFBundleExecutable') if isinstance(plist, dict) else None
+            has_executable = bool(executable) and f'Payload/{app_dir}/{executable}' in archive.NameToInfo
+            entitlements_name = f'Payload/{app_dir}/archived-expanded-entitlements.xcent'
+            entitlements = None
+            if entitlements_name in archive.NameToInfo:
+                entitlements = _read_plist(archive, entitlements_name)
+    except zipfile.BadZipFile as e:
+        raise InspectionError('IPA is not a valid zip archive', 'invalid_ipa', {'reason': str(e)})
+    except (plistlib.InvalidFileException, ValueError) as e:
+        raise InspectionError('Info.plist could not be parsed', 'invalid_ipa', {'reason': str(e)})
+
+    if not isinstance(plist, dict) or not isinstance(plist.get('CFBundleIdentifier'), str):
+        raise InspectionError('Info.plist has no CFBundleIdentifier', 'invalid_ipa')
+    if not has_executable:
+        raise InspectionError(
+            'The app executable named by CFBundleExecutable is missing',
+            'invalid_ipa',
+            {'executable': executable}
+        )
+    return {
+        'app': app_dir,
+        'bundle_id': plist['CFBundleIdentifier'],
+        'name': plist.get('CFBundleDisplayName') or plist.get('CFBundleName'),
+        'version': plist.get('CFBundleShortVersionString'),
+        'executable': executable,
+        'entitlements': entitlements if isinstance(entitlements, dict) else None
+    }
+
+
+def check_pair(certificate, profile):
+    """Check that a certificate can sign with a profile; returns the certificate_info."""
+    cert = certificate_info(certificate)
+    now = datetime.utcnow()
+    if cert['expires_at'] <= now:
+        raise InspectionError('Certificate has expired', 'certificate_expired',
+                              {'expires_at': cert['expires_at'].isoformat()})
+    if not profile['expires_at'] or profile['expires_at'] <= now:
+        raise InspectionError('Provisioning profile has expired', 'profile_expired',
+                              {'expires_at': profile['expires_at'].isoformat() if profile['expires_at'] else None})
+    if cert['team_id'] and profile['team_id'] and cert['team_id'] != profile['team_id']:
+        raise InspectionError(
+            f"Certificate team ID {cert['team_id']} does not match "
+            f"provisioning profile team ID {profile['team_id']}",
+            'team_mismatch',
+            {'certificate_team_id': cert['team_id'], 'profile_team_id': profile['team_id']}
+        )
+    if not profile['app_id']:
+        raise InspectionError(
+            'Provisioning profile has no application-identifier entitlement',
+            'invalid_profile'
+        )
+    if certificate_der(certificate) not in profile['certificates']:
+        raise InspectionError(
+            'Certificate is not included in the provisioning profile',
+            'certificate_not_in_profile',
+            {'certificate_serial': cert['serial'], 'certificate_name': cert['common_name']}
+        )
+    return cert
+
+
+def inspect_request(ipa_path, options=None, p12_path=None, prov_path=None, p12_password=None, credential=None,
+                    app=None):
+    """Check a sign request's files against each other before zsign runs.
+
+    Takes either the uploaded P12, profile and password, or a registered
+    credential, which was checked when it was registered. app is a
+    read_app_info result to reuse. Returns a short summary; problems raise
+    InspectionError.
+
+    Entitlements the app was built with but the profile does not grant are
+    listed in missing_entitlements rather than rejected: zsign signs with
+    the profile's entitlements, so the app still installs, only without
+    those capabilities.
+    """
+    app = app or read_app_info(ipa_path)
+    if credential:
+        pattern = credential.bundle_id
+        profile = parse_profile(credential.profile)
+    else:
+        try:
+            with open(prov_path, 'rb') as f:
+                profile = parse_profile(f.read())
+        except ProvisioningError as e:
+            raise InspectionError(str(e), 'invalid_profile')
+        try:
+            with open(p12_path, 'rb') as f:
+                _, certificate = load_p12(f.read(), p12_password)
+        except CertificateError as e:
+            code = 'invalid_p12_password' if 'password' in str(e) else 'invalid_p12'
+            raise InspectionError(str(e), code)
+        check_pair(certificate, profile)
+        pattern = profile['bundle_id']
+
+    # A requested bundle_id replaces the IPA's own when zsign signs it
+    bundle_id = (options or {}).get('bundle_id') or app['bundle_id']
+    if not bundle_id_allowed(pattern, bundle_id):
+        raise InspectionError(
+            f'Bundle ID {bundle_id} is not allowed by the provisioning profile ({pattern})',
+            'bundle_id_mismatch',
+            {'bundle_id': bundle_id, 'profile_bundle_id': pattern}
+        )
+    missing = sorted(
+        name for name in app['entitlements'] or {}
+        if name not in TEAM_ENTITLEMENTS and name not in profile['entitlements']
+    )
+    return dict(app, signing_bundle_id=bundle_id, missing_entitlements=missing)
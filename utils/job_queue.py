@@ -0,0 +1,493 @@
+import os
+import math
+import time
+import shutil
+import zipfile
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Callable
+from datetime import datetime, timedelta
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from models import SigningJob, db
+from utils.signing import sign_ipa, SigningError, ZsignLimits, parse_cpus, parse_tier_setting
+from utils.repack import repack_ipa
+from utils.signed_cache import signed_cache
+from utils.artifacts import artifact_store, job_name
+from utils.bundle_cache import bundle_cache, extract_ipa
+from utils.workspace import Workspace, remove_orphaned_workspaces
+from utils.rate_limit import rate_limiter
+from utils.rollups import record_job
+from utils.toolchain import toolchain
+from utils.trace import JobTrace
+from utils.scheduler import FairScheduler, MemorySlots, SQLiteSlots
+from utils.webhooks import webhooks, enqueue_delivery
+from utils.metrics import (
+    registry, Gauge, sign_phase_seconds, zsign_run_seconds, zsign_peak_rss_bytes,
+    bytes_signed_total, bytes_repacked_total, jobs_total, job_failures_total, jobs_in_flight,
+    admission_rejections_total
+)
+
+logger = logging.getLogger(__name__)
+
+Backpressure = namedtuple('Backpressure', ['message', 'retry_after'])
+UNFINISHED = ('pending', 'processing')
+
+
+@dataclass
+class SigningTask:
+    job_id: int
+    workspace: Workspace
+    p12_password: str
+    cache_key: str = None
+    ipa_hash: str = None
+    use_credential: bool = False
+    options: dict = None
+    on_done: Callable[[int], None] = None
+    zip_level: int = 6
+    tier: str = None
+    trace: JobTrace = None
+
+
+class SigningQueue:
+    """Runs queued signing jobs on a pool of worker processes.
+
+    Dispatcher threads pull jobs off a tier-weighted fair queue, mark them
+    as processing and hand the zsign run to a process pool, so the request
+    thread that enqueued the job can return immediately. zsign signs an
+    extracted folder in place and the pool repacks it into the signed IPA,
+    deflating only what zsign changed. Each zsign run is bounded by
+    ZsignLimits, niced and pinned to CPUs according to the key's tier.
+
+    The queue lives in this process's memory, so while a job is in it
+    a heartbeat thread refreshes the job's heartbeat_at every
+    JOB_HEARTBEAT_INTERVAL seconds. Every process's heartbeat thread also
+    fails unfinished jobs whose heartbeat is older than JOB_ORPHAN_AFTER,
+    which is what becomes of the jobs of a worker that was killed or
+    restarted without draining.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.workers = 1
+        self.backlog_limit = 0
+        self.repack_threads = 1
+        self.limits = ZsignLimits()
+        self.nice = {}
+        self.cpus = {}
+        self.min_free_bytes = 0
+        self.upload_folder = None
+        self.heartbeat_interval = 15
+        self.orphan_after = 90
+        self._queue = FairScheduler()
+        # Moving average of a job's run time, for Retry-After estimates
+        self._average_run = 10.0
+        self._pool = None
+        self._threads = []
+        self._lock = threading.Lock()
+        # Ids of the jobs this process has queued and not yet finished
+        self._held = set()
+        self._heartbeat = None
+        self._stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        # Each web worker runs its share of the host's SIGNING_WORKERS; the ledger holds them to the total
+        self.workers = max(1, app.config['SIGNING_PROCESS_WORKERS'])
+        self.backlog_limit = app.config['SIGNING_BACKLOG_LIMIT']
+        self.repack_threads = max(1, app.config['REPACK_THREADS'])
+        self.limits = ZsignLimits(
+            timeout=app.config['ZSIGN_TIMEOUT'] or None,
+            max_memory=app.config['ZSIGN_MAX_MEMORY'] or None,
+            max_file_size=app.config['ZSIGN_MAX_FILE_SIZE'] or None,
+            max_open_files=app.config['ZSIGN_MAX_OPEN_FILES'] or None
+        )
+        self.nice = parse_tier_setting(app.config['ZSIGN_NICE'])
+        self.cpus = parse_tier_setting(app.config['ZSIGN_CPUS'], parse_cpus)
+        self.min_free_bytes = app.config['SIGNING_MIN_FREE_BYTES']
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        self.heartbeat_interval = app.config['JOB_HEARTBEAT_INTERVAL']
+        self.orphan_after = app.config['JOB_ORPHAN_AFTER']
+        ledger = app.config['SIGNING_LEDGER']
+        self._queue = FairScheduler(
+            max(1, app.config['SIGNING_WORKERS']),
+            max(0, app.config['SIGNING_RESERVED_WORKERS']),
+            MemorySlots() if ledger == 'memory' else SQLiteSlots(ledger),
+            capacity=self.workers
+        )
+        app.extensions['signing_queue'] = self
+
+    def start(self):
+        """Start the heartbeat thread; every web worker runs one, whether or not it gets jobs."""
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._stopped.clear()
+            self._heartbeat = threading.Thread(target=self._beat, name='signing-heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def _start(self):
+        self.start()
+        with self._lock:
+            if self._pool is not None:
+                return
+            # spawn keeps the workers free of the parent's DB connections and threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._dispatch, name=f'signing-dispatch-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def admit(self, api_key):
+        """Decide whether api_key may start another signing, before its upload is read.
+
+        Returns None to go ahead, or a Backpressure with the reason and a
+        Retry-After estimate. A key may have at most get_max_queued()
+        unfinished jobs across all processes, and regular and premium keys
+        are also turned away while their tier's backlog here is full.
+        """
+        tier = api_key.tier
+        if tier != 'enterprise' and self._queue.qsize(tier) >= self.backlog_limit:
+            admission_rejections_total.inc(reason='backlog')
+            slots = max(1, self._queue.workers - self._queue.reserved)
+            return Backpressure(
+                'The signing queue is full, try again later',
+                math.ceil(self._average_run * (self._queue.qsize(tier) / slots + 1))
+            )
+
+        # A job no worker is keeping alive no longer holds one of the key's places
+        unfinished = SigningJob.query.filter(
+            SigningJob.api_key_id == api_key.id,
+            SigningJob.status.in_(UNFINISHED),
+            func.coalesce(SigningJob.heartbeat_at, SigningJob.created_at) >= self._stale_before()
+        ).count()
+        if unfinished >= api_key.get_max_queued():
+            admission_rejections_total.inc(reason='key_limit')
+            return Backpressure(
+                f'Too many unfinished signing jobs (at most {api_key.get_max_queued()})',
+                math.ceil(self._average_run * unfinished / api_key.get_max_concurrent())
+            )
+        return None
+
+    def submit(self, job_id, workspace, p12_password, cache_key=None, ipa_hash=None, use_credential=False,
+               options=None, on_done=None, api_key=None, zip_level=None, trace=None):
+        """Queue a job whose inputs are in workspace; the queue cleans it up when done.
+
+        With use_credential the workspace holds a registered credential's
+        PEM key and certificate instead of a P12, and p12_password is None.
+        options are extra sign_ipa keyword arguments such as dylibs.
+        on_done is called with the job id from a dispatcher thread once the
+        job has been finalised, whether it succeeded or not. api_key's
+        tier and get_max_concurrent() decide when the job gets a worker.
+        zip_level defaults to api_key's get_zip_level(). The job's trace
+        goes on from trace, the JobTrace of the request that created it.
+        """
+        self._start()
+        self._held.add(job_id)
+        trace = trace or JobTrace()
+        trace.mark('queued')
+        self._queue.put(
+            SigningTask(
+                job_id, workspace, p12_password, cache_key, ipa_hash, use_credential,
+                options=options, on_done=on_done,
+                zip_level=api_key.get_zip_level() if zip_level is None else zip_level,
+                tier=api_key.tier,
+                trace=trace
+            ),
+            api_key.id,
+            api_key.tier,
+            api_key.get_max_concurrent()
+        )
+
+    def limits_for(self, tier):
+        """Return the ZsignLimits for a job of tier, with its niceness and CPUs."""
+        return replace(self.limits, nice=self.nice.get(tier, 0), cpus=self.cpus.get(tier))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._pool is not None:
+                # Dispatchers exit once every queued job has run
+                self._queue.close()
+                if wait:
+                    for thread in self._threads:
+                        thread.join()
+                self._pool.shutdown(wait=wait)
+                self._pool = None
+                self._threads = []
+                self._queue.reopen()
+            # Heartbeats go on until the last job is finished
+            if self._heartbeat is not None:
+                self._stopped.set()
+                self._heartbeat.join()
+                self._heartbeat = None
+
+    def _stale_before(self):
+        return datetime.utcnow() - timedelta(seconds=self.orphan_after)
+
+    def _beat(self):
+        removed = remove_orphaned_workspaces(self.upload_folder)
+        if removed:
+            logger.warning(f'Removed {removed} workspace(s) left by stopped workers')
+        while True:
+            try:
+                with self.app.app_context():
+                    held = list(self._held)
+                    if held:
+                        SigningJob.query.filter(SigningJob.id.in_(held)).update(
+                            {SigningJob.heartbeat_at: datetime.utcnow()}, synchronize_session=False
+                        )
+                        db.session.commit()
+                    failed = fail_orphaned_jobs(self._stale_before())
+                if failed:
+                    logger.warning(f'Marked {failed} signing job(s) of stopped workers as failed')
+            except Exception:
+                logger.exception('Signing heartbeat failed')
+            if self._stopped.wait(self.heartbeat_interval):
+                return
+
+    def _dispatch(self):
+        while True:
+            picked = self._queue.get()
+            if picked is None:
+                return
+            key_id, task = picked
+            try:
+                self._run(task)
+            except Exception:
+                logger.exception('Signing dispatcher failed')
+            finally:
+                self._queue.done(key_id)
+                self._held.discard(task.job_id)
+                if task.on_done:
+                    try:
+                        task.on_done(task.job_id)
+                    except Exception:
+                        logger.exception('Signing job callback failed')
+
+    def _run(self, task):
+        jobs_in_flight.inc()
+        started = time.monotonic()
+        try:
+            self._process(task)
+        finally:
+            jobs_in_flight.dec()
+            self._average_run += (time.monotonic() - started - self._average_run) * 0.2
+
+    def _process(self, task):
+        with self.app.app_context():
+            job = db.session.get(SigningJob, task.job_id)
+            if job.status != 'pending':
+                # Failed as orphaned while its heartbeat was held up
+                logger.warning(f'Skipping signing job {job.id}, already {job.status}')
+                task.workspace.cleanup()
+                return
+            job.status = 'processing'
+            job.started_at = datetime.utcnow()
+            task.trace.mark('started')
+            sign_phase_seconds.observe((job.started_at - job.created_at).total_seconds(), phase='queue_wait')
+            db.session.commit()
+
+        output_path = None
+        error = None
+        usage = None
+        trace = task.trace
+        try:
+            result = self._sign(task)
+            usage = result.usage
+            zsign_run_seconds.observe(usage.wall_time)
+            zsign_peak_rss_bytes.observe(usage.peak_rss)
+            output_size = os.path.getsize(task.workspace.output_path)
+            bytes_signed_total.inc(output_size)
+            trace.set(output_bytes=output_size)
+            with sign_phase_seconds.time(phase='store'):
+                output_path = artifact_store.store(job_name(task.job_id), task.workspace.output_path)
+                if task.cache_key:
+                    signed_cache.put(task.cache_key, output_path)
+            trace.mark('stored')
+        except Exception as e:
+            error = str(e)
+            job_failures_total.inc(reason=getattr(e, 'reason', 'internal'))
+            usage = getattr(e, 'usage', None)
+            trace.set(error_reason=getattr(e, 'reason', 'internal'))
+        finally:
+            with sign_phase_seconds.time(phase='cleanup'):
+                task.workspace.cleanup()
+            trace.mark('cleaned')
+
+        with self.app.app_context(), sign_phase_seconds.time(phase='finalize'):
+            job = db.session.get(SigningJob, task.job_id)
+            if job.status != 'processing':
+                # Already failed, refunded and reported as orphaned; leave it that way
+                logger.warning(f'Signing job {job.id} finished after being marked {job.status}')
+                return
+            job.completed_at = datetime.utcnow()
+            if usage is not None:
+                job.zsign_wall_time = usage.wall_time
+                job.zsign_cpu_time = usage.cpu_time
+                job.zsign_peak_rss = usage.peak_rss
+                job.kill_reason = usage.kill_reason
+                trace.record_zsign(usage)
+            trace.mark('finished')
+            job.duration = trace.duration
+            job.trace = trace.to_json()
+            if error is None:
+                job.status = 'completed'
+                job.output_file = output_path
+            else:
+                job.status = 'failed'
+                job.error_message = error
+                # The use was counted at admission; failed signings don't count
+                rate_limiter.release(job.api_key_id, job.usage_event_id)
+            record_job(job, job.api_key.tier)
+            delivery = enqueue_delivery(job)
+            jobs_total.inc(status=job.status)
+            db.session.commit()
+        if delivery:
+            webhooks.notify()
+
+    def _sign(self, task):
+        workspace = task.workspace
+        zsign_path = toolchain.require()
+        if task.use_credential:
+            key_path, cert_path = workspace.key_path, workspace.cert_path
+        else:
+            key_path, cert_path = workspace.p12_path, None
+
+        self._check_disk_space(workspace)
+
+        def extract(ipa_path, dest):
+            with sign_phase_seconds.time(phase='extract'):
+                extracted = self._pool.submit(extract_ipa, ipa_path, dest).result()
+            task.trace.mark('extracted')
+            return extracted
+
+        def sign(folder):
+            # zsign only signs the folder; zipping it is left to repack_ipa
+            with sign_phase_seconds.time(phase='zsign'):
+                result = self._pool.submit(
+                    sign_ipa,
+                    folder,
+                    key_path,
+                    workspace.prov_path,
+                    task.p12_password,
+                    None,
+                    cert_path,
+                    zsign_path,
+                    limits=self.limits_for(task.tier),
+                    **(task.options or {})
+                ).result()
+            with sign_phase_seconds.time(phase='repack'):
+                repacked = self._pool.submit(
+                    repack_ipa, workspace.ipa_path, folder, workspace.output_path, task.zip_level,
+                    self.repack_threads
+                ).result()
+            bytes_repacked_total.inc(repacked.reused_bytes, mode='reused')
+            bytes_repacked_total.inc(repacked.compressed_bytes, mode='compressed')
+            task.trace.mark('repacked')
+            task.trace.set(reused_bytes=repacked.reused_bytes, compressed_bytes=repacked.compressed_bytes)
+            return result._replace(output_path=workspace.output_path)
+
+        def sign_extracted():
+            folder = workspace.file('bundle')
+            extract(workspace.ipa_path, folder)
+            return sign(folder)
+
+        # Injection and metadata rewrites would change the cached bundle in place
+        if task.options or not (task.ipa_hash and bundle_cache.enabled):
+            return sign_extracted()
+
+        # Sign the cached extracted bundle so zsign can reuse its folder cache
+        with bundle_cache.checkout(task.ipa_hash, workspace.ipa_path, extract=extract, blocking=False) as bundle_dir:
+            if bundle_dir is not None:
+                task.trace.set(bundle_cache=True)
+                return sign(bundle_dir)
+        # Another job is signing this bundle; extract a private copy rather than wait behind it
+        return sign_extracted()
+
+    def _check_disk_space(self, workspace):
+        """Fail early unless the upload disk has room to extract, sign and repack the IPA."""
+        try:
+            with zipfile.ZipFile(workspace.ipa_path) as archive:
+                extracted = sum(info.file_size for info in archive.infolist())
+        except zipfile.BadZipFile:
+            raise SigningError('The uploaded file is not a valid IPA', 'invalid_ipa')
+        # The extracted bundle plus a repacked IPA about the size of the upload
+        needed = extracted + os.path.getsize(workspace.ipa_path) + self.min_free_bytes
+        free = shutil.disk_usage(workspace.path).free
+        if free < needed:
+            raise SigningError(
+                f'Not enough free disk space to sign this IPA ({free // (1024 * 1024)} MB free, '
+                f'{needed // (1024 * 1024)} MB needed)',
+                'disk'
+            )
+
+
+signing_queue = SigningQueue()
+
+
+def _fail_unfinished(message, *criteria):
+    """Fail the unfinished jobs matching criteria and return how many this call failed.
+
+    Each job is claimed with a conditional update first, so processes
+    doing this at the same time never fail, refund or report a job twice.
+    """
+    unfinished = (SigningJob.status.in_(UNFINISHED), *criteria)
+    failed = 0
+    for job in SigningJob.query.filter(*unfinished).all():
+        claimed = SigningJob.query.filter(SigningJob.id == job.id, *unfinished).update(
+            {SigningJob.status: 'failed'}, synchronize_session=False
+        )
+        if not claimed:
+            continue
+        job.status = 'failed'
+        job.error_message = message
+        job.completed_at = datetime.utcnow()
+        rate_limiter.release(job.api_key_id, job.usage_event_id)
+        record_job(job, job.api_key.tier)
+        enqueue_delivery(job)
+        jobs_total.inc(status='failed')
+        failed += 1
+    db.session.commit()
+    return failed
+
+
+def fail_interrupted_jobs():
+    """Fail jobs left pending or processing by a server that was killed mid-signing.
+
+    Only safe while no web worker is running, since a live worker's jobs
+    look exactly the same. Their webhooks are sent once a web worker's
+    dispatcher starts.
+    """
+    return _fail_unfinished('Signing was interrupted by a server restart')
+
+
+def fail_orphaned_jobs(stale_before):
+    """Fail unfinished jobs whose worker last refreshed their heartbeat before stale_before.
+
+    Safe while other workers run: a live worker keeps refreshing its jobs.
+    Jobs from before heartbeats were recorded go by their created_at.
+    """
+    return _fail_unfinished(
+        'Signing was interrupted because its worker stopped',
+        func.coalesce(SigningJob.heartbeat_at, SigningJob.created_at) < stale_before
+    )
+
+
+registry.register(Gauge(
+    'zsign_jobs_queued',
+    'Signing jobs waiting for a dispatcher.',
+    callback=signing_queue.pending
+))
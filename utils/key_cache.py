@@ -0,0 +1,125 @@
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from sqlalchemy import func
+
+from models import APIKey, db
+
+
+@dataclass(frozen=True)
+class ResolvedKey:
+    """Detached snapshot of the APIKey fields request handling needs."""
+
+    id: int
+    key: str
+    name: str
+    tier: str
+    is_active: bool
+    daily_limit: int
+    max_concurrent: int
+    max_queued: int
+    zip_level: int
+
+    def get_daily_limit(self):
+        return self.daily_limit
+
+    def get_max_concurrent(self):
+        return self.max_concurrent
+
+    def get_max_queued(self):
+        return self.max_queued
+
+    def get_zip_level(self):
+        return self.zip_level
+
+
+class KeyCache:
+    """TTL + LRU cache of API key lookups, including misses.
+
+    Admin changes invalidate the entry in this process and stamp
+    APIKey.updated_at. Every worker reads the newest stamp at most every
+    KEY_CACHE_REVALIDATE seconds and empties its cache when it moved, so a
+    disabled key is refused everywhere within that time, not KEY_CACHE_TTL.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 0
+        self.revalidate = 0
+        self.max_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['KEY_CACHE_TTL']
+        self.revalidate = app.config['KEY_CACHE_REVALIDATE']
+        self.max_size = app.config['KEY_CACHE_SIZE']
+        app.extensions['key_cache'] = self
+
+    def resolve(self, key):
+        """Return the ResolvedKey for an active key, or None."""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._check_generation(now)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        record = APIKey.query.filter_by(key=key).first()
+        resolved = None
+        if record and record.is_active:
+            resolved = ResolvedKey(
+                id=record.id,
+                key=record.key,
+                name=record.name,
+                tier=record.tier,
+                is_active=record.is_active,
+                daily_limit=record.get_daily_limit(),
+                max_concurrent=record.get_max_concurrent(),
+                max_queued=record.get_max_queued(),
+                zip_level=record.get_zip_level()
+            )
+
+        with self._lock:
+            self._entries[key] = (now + self.ttl, resolved)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return resolved
+
+    def _check_generation(self, now):
+        # One indexed MAX() every few seconds instead of a lookup per request
+        generation = db.session.query(func.max(APIKey.updated_at)).scalar()
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+            self._next_check = now + self.revalidate
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self._entries)
+            }
+
+
+key_cache = KeyCache()
@@ -0,0 +1,383 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Seconds, spanning a fast DB commit up to a multi-minute zsign run on a large IPA
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Bytes, 16 MB to 8 GB
+SIZE_BUCKETS = tuple(16 * 1024 * 1024 * 2 ** i for i in range(10))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def snapshot(self):
+        """A copy of this process's values, {label values: value}."""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def add(values, key, value):
+        """Add another process's value for key into values."""
+        values[key] = values.get(key, 0) + value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.snapshot()
+        return [f'{self.name}{_labels(self.labelnames, key)} {value}' for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """A gauge that is either set directly or read from a callback at scrape time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def snapshot(self):
+        if self.callback is not None:
+            return {(): self.callback()}
+        return super().snapshot()
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.snapshot()
+        return [f'{self.name}{_labels(self.labelnames, key)} {value}' for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def totals(self):
+        """Return {label values: (count, sum)} for every observed label set."""
+        with self._lock:
+            return {key: (sum(counts), total) for key, (counts, total) in self._values.items()}
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+    @staticmethod
+    def add(values, key, value):
+        counts, total = value
+        if key in values:
+            counts = [a + b for a, b in zip(values[key][0], counts)]
+            total += values[key][1]
+        values[key] = (list(counts), total)
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.snapshot()
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """The metrics of every web worker, rendered in the Prometheus text format.
+
+    Each process counts in memory. With METRICS_FOLDER set, a started
+    process also writes its values to <pid>.json there every
+    METRICS_FLUSH_INTERVAL seconds and on shutdown, and a scrape, which
+    gunicorn hands to any one worker, adds that worker's live values to
+    the other workers' files: counters and histograms of every process
+    that wrote one, gauges of live processes only. Files left by dead
+    workers are folded into archive.json, so counters survive worker
+    restarts without the folder growing. Zsign runs in pool processes but
+    is measured by the dispatcher thread that waits for it, so it is
+    counted here.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self.folder = None
+        self.flush_interval = 10
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def init_app(self, app):
+        self.folder = app.config['METRICS_FOLDER'] or None
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        if self.folder:
+            os.makedirs(self.folder, exist_ok=True)
+        app.extensions['metrics'] = self
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def start(self):
+        """Start writing this process's values; call once in a worker right after it is forked.
+
+        Values counted before the fork are dropped, since every worker
+        inherits the same copy of them.
+        """
+        with self._lock:
+            if self._thread is not None or not self.folder:
+                return
+            for metric in self._metrics:
+                with metric._lock:
+                    metric._values.clear()
+            self._compact()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing metrics failed')
+
+    def _snapshot(self):
+        return {
+            metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+            for metric in self._metrics
+        }
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def flush(self):
+        """Write this process's values to its file in the folder."""
+        self._write(os.path.join(self.folder, f'{os.getpid()}.json'), self._snapshot())
+
+    @contextmanager
+    def _folder_lock(self, operation):
+        with open(os.path.join(self.folder, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _files(self):
+        """(pid or None for the archive, path) of each file in the folder but this process's own."""
+        for entry in os.scandir(self.folder):
+            stem, ext = os.path.splitext(entry.name)
+            if ext != '.json':
+                continue
+            if stem == 'archive':
+                yield None, entry.path
+            elif stem.isdigit() and int(stem) != os.getpid():
+                yield int(stem), entry.path
+
+    def _merge(self, totals, path, gauges=True):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        for metric in self._metrics:
+            if metric.kind == 'gauge' and not gauges:
+                continue
+            values = totals.setdefault(metric.name, {})
+            for key, value in data.get(metric.name, ()):
+                metric.add(values, tuple(key), value)
+
+    def _compact(self):
+        """Fold the counters and histograms of dead processes' files into archive.json."""
+        with self._folder_lock(fcntl.LOCK_EX):
+            archive_path = os.path.join(self.folder, 'archive.json')
+            dead = [path for pid, path in self._files() if pid is not None and not _alive(pid)]
+            # A file under this process's pid was left by an earlier process that had it
+            own_path = os.path.join(self.folder, f'{os.getpid()}.json')
+            if os.path.exists(own_path):
+                dead.append(own_path)
+            if not dead:
+                return
+            totals = {}
+            self._merge(totals, archive_path)
+            for path in dead:
+                self._merge(totals, path, gauges=False)
+            self._write(archive_path, {
+                name: [[list(key), value] for key, value in values.items()] for name, values in totals.items()
+            })
+            for path in dead:
+                os.remove(path)
+
+    def render(self):
+        totals = {metric.name: metric.snapshot() for metric in self._metrics}
+        if self.folder:
+            with self._folder_lock(fcntl.LOCK_SH):
+                for pid, path in self._files():
+                    self._merge(totals, path, gauges=pid is not None and _alive(pid))
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples(totals[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+sign_phase_seconds = registry.register(Histogram(
+    'zsign_sign_phase_seconds',
+    'Time spent in each phase of a sign request and its job.',
+    ['phase']
+))
+zsign_run_seconds = registry.register(Histogram(
+    'zsign_run_seconds',
+    'Wall time of the zsign subprocess.'
+))
+zsign_peak_rss_bytes = registry.register(Histogram(
+    'zsign_peak_rss_bytes',
+    'Peak resident set size of the zsign subprocess.',
+    buckets=SIZE_BUCKETS
+))
+bytes_received_total = registry.register(Counter(
+    'zsign_bytes_received_total',
+    'Request body bytes received by upload and signing endpoints.',
+    ['endpoint']
+))
+bytes_deduplicated_total = registry.register(Counter(
+    'zsign_bytes_deduplicated_total',
+    'Bytes of input files referenced by hash from the blob store instead of uploaded.',
+    ['endpoint']
+))
+bytes_signed_total = registry.register(Counter(
+    'zsign_bytes_signed_total',
+    'Bytes of signed IPA produced.'
+))
+bytes_repacked_total = registry.register(Counter(
+    'zsign_bytes_repacked_total',
+    'Uncompressed bytes of signed IPAs, by whether their compressed data was reused from the input or deflated again.',
+    ['mode']
+))
+downloads_total = registry.register(Counter(
+    'zsign_downloads_total',
+    'Signed IPA download responses by HTTP status.',
+    ['status']
+))
+jobs_total = registry.register(Counter(
+    'zsign_jobs_total',
+    'Signing jobs by outcome.',
+    ['status']
+))
+job_failures_total = registry.register(Counter(
+    'zsign_job_failures_total',
+    'Failed signing jobs by error class.',
+    ['reason']
+))
+admission_rejections_total = registry.register(Counter(
+    'zsign_admission_rejections_total',
+    'Sign requests turned away before their upload was read.',
+    ['reason']
+))
+inspection_rejections_total = registry.register(Counter(
+    'zsign_inspection_rejections_total',
+    'Sign requests rejected by inspection before zsign ran, by error code.',
+    ['code']
+))
+jobs_in_flight = registry.register(Gauge(
+    'zsign_jobs_in_flight',
+    'Signing jobs currently being processed.'
+))
@@ -0,0 +1,139 @@
+import logging
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import AddConstraint, UniqueConstraint
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# db.create_all() only creates missing tables, so a column or index added to a
+# table that already exists is listed here, oldest first, and added by
+# upgrade_schema() on a database created before it. Types and index
+# definitions are read from the models; only nullable columns can be added.
+ADDED_COLUMNS = [
+    ('signing_job', 'started_at'),
+    ('signing_job', 'cache_hit'),
+    ('api_key', 'discord_user_id'),
+    ('api_key', 'webhook_url'),
+    ('api_key', 'webhook_secret'),
+    ('signing_job', 'callback_url'),
+    ('signing_job', 'zsign_wall_time'),
+    ('signing_job', 'zsign_cpu_time'),
+    ('signing_job', 'zsign_peak_rss'),
+    ('signing_job', 'kill_reason'),
+    ('signing_job', 'duration'),
+    ('signing_job', 'trace'),
+    ('signing_job', 'usage_event_id'),
+    ('api_key', 'updated_at'),
+    ('signing_job', 'worker_pid'),
+    ('signing_job', 'heartbeat_at')
+]
+ADDED_INDEXES = [
+    'ix_signing_job_api_key_id',
+    'ix_signing_job_created_at',
+    'ix_api_key_discord_user_id',
+    'ix_api_key_name',
+    'ix_api_key_tier',
+    'ix_api_key_created_at',
+    'ix_signing_job_status',
+    'ix_signing_job_duration',
+    'ix_api_key_updated_at'
+]
+# Unique constraints whose columns changed, as (table, old columns), oldest first. The
+# new constraint is read from the model and replaces the old one where it still exists.
+REPLACED_UNIQUE_CONSTRAINTS = [
+    ('hourly_job_rollup', ('bucket', 'api_key_id', 'status')),
+    ('daily_job_rollup', ('bucket', 'api_key_id', 'status'))
+]
+
+
+def _column_ddl(table, column_name):
+    column = db.metadata.tables[table].columns[column_name]
+    if not column.nullable:
+        raise ValueError(f'{table}.{column_name} must be nullable to be added to an existing table')
+    column_type = column.type.compile(dialect=db.engine.dialect)
+    return f'ALTER TABLE {table} ADD COLUMN {column_name} {column_type}'
+
+
+def _index(name):
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(name)
+
+
+def _old_unique(table, columns):
+    """The reflected unique constraint of table on exactly columns, or None."""
+    for constraint in inspect(db.engine).get_unique_constraints(table):
+        if tuple(constraint['column_names']) == tuple(columns):
+            return constraint
+    return None
+
+
+def _replace_unique(table_name, old):
+    table = db.metadata.tables[table_name]
+    new = next(c for c in table.constraints if isinstance(c, UniqueConstraint))
+    with db.engine.begin() as conn:
+        if db.engine.dialect.name != 'sqlite':
+            conn.exec_driver_sql(f'ALTER TABLE {table_name} DROP CONSTRAINT {old["name"]}')
+            conn.execute(AddConstraint(new))
+            return
+        # SQLite can't drop a constraint, so the table is rebuilt with the new one
+        columns = ', '.join(column.name for column in table.columns)
+        conn.exec_driver_sql(f'ALTER TABLE {table_name} RENAME TO {table_name}_old')
+        table.create(conn)
+        conn.exec_driver_sql(f'INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {table_name}_old')
+        conn.exec_driver_sql(f'DROP TABLE {table_name}_old')
+
+
+def upgrade_schema():
+    """Add the columns and indexes in ADDED_COLUMNS and ADDED_INDEXES that the database lacks,
+    and apply REPLACED_UNIQUE_CONSTRAINTS.
+
+    Safe to run on every start and from several processes at once: each
+    step is checked first, and a step another process got to first is
+    skipped. Returns the number of changes made.
+    """
+    changes = 0
+    for table, column_name in ADDED_COLUMNS:
+        if column_name in {c['name'] for c in inspect(db.engine).get_columns(table)}:
+            continue
+        try:
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(_column_ddl(table, column_name))
+        except DBAPIError:
+            if column_name not in {c['name'] for c in inspect(db.engine).get_columns(table)}:
+                raise
+            continue
+        logger.info(f'Added column {table}.{column_name}')
+        changes += 1
+
+    for name in ADDED_INDEXES:
+        index = _index(name)
+        if name in {i['name'] for i in inspect(db.engine).get_indexes(index.table.name)}:
+            continue
+        try:
+            index.create(bind=db.engine, checkfirst=True)
+        except DBAPIError:
+            if name not in {i['name'] for i in inspect(db.engine).get_indexes(index.table.name)}:
+                raise
+            continue
+        logger.info(f'Created index {name}')
+        changes += 1
+
+    for table, columns in REPLACED_UNIQUE_CONSTRAINTS:
+        old = _old_unique(table, columns)
+        if old is None:
+            continue
+        try:
+            _replace_unique(table, old)
+        except DBAPIError:
+            if _old_unique(table, columns) is not None:
+                raise
+            continue
+        logger.info(f'Replaced unique constraint on {table} ({", ".join(columns)})')
+        changes += 1
+    return changes
@@ -0,0 +1,75 @@
+import json
+import base64
+import binascii
+from datetime import datetime
+from dataclasses import dataclass
+
+from sqlalchemy import tuple_
+
+
+@dataclass
+class KeysetPage:
+    items: list
+    next_cursor: str = None
+    prev_cursor: str = None
+
+
+def encode_cursor(value, row_id):
+    if isinstance(value, datetime):
+        payload = {'dt': value.isoformat(), 'id': row_id}
+    else:
+        payload = {'v': value, 'id': row_id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (value, id) from a cursor, or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        value = datetime.fromisoformat(payload['dt']) if 'dt' in payload else payload['v']
+        return value, int(payload['id'])
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        return None
+
+
+def keyset_page(query, column, id_column, descending=True, after=None, before=None, per_page=50):
+    """Return one page of query ordered by (column, id), seeking from a cursor instead of OFFSET.
+
+    The cost of a page stays the same however deep it is. column must be
+    NOT NULL, since NULLs don't compare in the seek condition.
+    """
+    start = decode_cursor(before)
+    backwards = start is not None
+    if not backwards:
+        start = decode_cursor(after)
+
+    # Walking backwards is walking forwards in the opposite order, then flipping the page
+    newest_first = descending != backwards
+    if start is not None:
+        position = tuple_(column, id_column)
+        query = query.filter(position < start if newest_first else position > start)
+    if newest_first:
+        query = query.order_by(column.desc(), id_column.desc())
+    else:
+        query = query.order_by(column.asc(), id_column.asc())
+
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def cursor(row):
+        return encode_cursor(getattr(row, column.key), getattr(row, id_column.key))
+
+    page = KeysetPage(rows)
+    if rows:
+        if backwards:
+            page.next_cursor = cursor(rows[-1])
+            page.prev_cursor = cursor(rows[0]) if more else None
+        else:
+            page.next_cursor = cursor(rows[-1]) if more else None
+            page.prev_cursor = cursor(rows[0]) if start is not None else None
+    return page
@@ -1 +1,103 @@
-# File removed as we're using zsign implementation
+import plistlib
+from datetime import datetime, timezone
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+def _read_tlv(data: bytes, offset: int):
+    """Read one DER element and return (tag, content_start, content_end)."""
+    if offset + 2 > len(data):
+        raise ProvisioningError("Truncated provisioning profile")
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        count = length & 0x7f
+        if count == 0 or offset + count > len(data):
+            raise ProvisioningError("Unsupported provisioning profile encoding")
+        length = int.from_bytes(data[offset:offset + count], 'big')
+        offset += count
+    if offset + length > len(data):
+        raise ProvisioningError("Truncated provisioning profile")
+    return tag, offset, offset + length
+
+
+def cms_content(data: bytes) -> bytes:
+    """Return the signed payload of a CMS (PKCS#7) SignedData blob.
+
+    Walks ContentInfo -> [0] SignedData -> encapContentInfo -> [0] eContent,
+    which is all a mobileprovision needs; the signature is not verified.
+    """
+    _, start, _ = _read_tlv(data, 0)                    # ContentInfo SEQUENCE
+    _, _, oid_end = _read_tlv(data, start)              # contentType OID
+    _, start, _ = _read_tlv(data, oid_end)              # [0] EXPLICIT
+    _, start, _ = _read_tlv(data, start)                # SignedData SEQUENCE
+    _, _, offset = _read_tlv(data, start)               # version INTEGER
+    _, _, offset = _read_tlv(data, offset)              # digestAlgorithms SET
+    _, start, _ = _read_tlv(data, offset)               # encapContentInfo SEQUENCE
+    _, _, oid_end = _read_tlv(data, start)              # eContentType OID
+    _, start, _ = _read_tlv(data, oid_end)              # [0] EXPLICIT
+    tag, start, end = _read_tlv(data, start)            # eContent OCTET STRING
+    if tag != 0x04:
+        raise ProvisioningError("Unsupported provisioning profile encoding")
+    return data[start:end]
+
+
+def _profile_plist(data: bytes) -> dict:
+    try:
+        payload = cms_content(data)
+    except ProvisioningError:
+        # Fall back to the embedded XML for BER-encoded profiles
+        start = data.find(b'<?xml')
+        end = data.find(b'</plist>')
+        if start < 0 or end < 0:
+            raise ProvisioningError("Invalid provisioning profile")
+        payload = data[start:end + len(b'</plist>')]
+    try:
+        return plistlib.loads(payload)
+    except Exception:
+        raise ProvisioningError("Invalid provisioning profile")
+
+
+def _utc(value):
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def parse_profile(data: bytes) -> dict:
+    plist = _profile_plist(data)
+    entitlements = plist.get('Entitlements', {})
+    team_ids = plist.get('TeamIdentifier') or []
+    team_id = team_ids[0] if team_ids else None
+
+    # application-identifier is "<TEAMID>.<bundle id pattern>"
+    app_id = entitlements.get('application-identifier', '')
+    prefix = f'{team_id}.' if team_id else ''
+    bundle_id = app_id[len(prefix):] if prefix and app_id.startswith(prefix) else app_id.split('.', 1)[-1]
+
+    return {
+        'name': plist.get('Name'),
+        'uuid': plist.get('UUID'),
+        'team_id': team_id,
+        'app_id': app_id,
+        'bundle_id': bundle_id,
+        'entitlements': entitlements,
+        'certificates': [bytes(cert) for cert in plist.get('DeveloperCertificates', [])],
+        'provisioned_devices': plist.get('ProvisionedDevices'),
+        'created_at': _utc(plist.get('CreationDate')),
+        'expires_at': _utc(plist.get('ExpirationDate'))
+    }
+
+
+def bundle_id_allowed(pattern: str, bundle_id: str) -> bool:
+    """Check a bundle id against a profile pattern such as com.example.* or *."""
+    if not pattern:
+        return False
+    if pattern == '*':
+        return True
+    if pattern.endswith('*'):
+        return bundle_id.startswith(pattern[:-1])
+    return pattern == bundle_id
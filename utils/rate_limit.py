@@ -0,0 +1,243 @@
+import os
+import time
+import sqlite3
+import logging
+import itertools
+import threading
+from collections import deque, namedtuple
+from datetime import datetime
+
+from models import APIKey, db
+
+logger = logging.getLogger(__name__)
+
+# event_id identifies the use a consuming acquire() counted, for refunding exactly that use later
+Decision = namedtuple('Decision', ['allowed', 'limit', 'remaining', 'retry_after', 'event_id'])
+
+
+class MemoryWindow:
+    """Sliding-window log kept in this process only.
+
+    Each key's events are (timestamp, event id) pairs, oldest first. A key
+    is dropped as soon as its window is empty.
+    """
+
+    def __init__(self):
+        self._events = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _trim(self, key_id, cutoff):
+        events = self._events.get(key_id)
+        while events and events[0][0] <= cutoff:
+            events.popleft()
+        if events is not None and not events:
+            del self._events[key_id]
+        return events or ()
+
+    def acquire(self, key_id, limit, window, now, consume=True):
+        with self._lock:
+            events = self._trim(key_id, now - window)
+            if len(events) >= limit:
+                return False, len(events), events[0][0] + window - now, None
+            if not consume:
+                return True, len(events), 0, None
+            event_id = next(self._ids)
+            events = self._events.setdefault(key_id, deque())
+            events.append((now, event_id))
+            return True, len(events), 0, event_id
+
+    def release(self, key_id, event_id):
+        with self._lock:
+            events = self._events.get(key_id, ())
+            for event in events:
+                if event[1] == event_id:
+                    events.remove(event)
+                    break
+            if key_id in self._events and not events:
+                del self._events[key_id]
+
+    def count(self, key_id, window, now):
+        with self._lock:
+            return len(self._trim(key_id, now - window))
+
+    def purge(self, cutoff):
+        with self._lock:
+            for key_id in list(self._events):
+                self._trim(key_id, cutoff)
+
+
+class SQLiteWindow:
+    """Sliding-window log in a SQLite file shared by every worker on the host.
+
+    BEGIN IMMEDIATE takes SQLite's write lock, so the check and the insert
+    are one atomic step even across processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(usage_events)')]
+            if columns and 'id' not in columns:
+                # Stores from before event ids; AUTOINCREMENT can only come from recreating the table
+                conn.execute('ALTER TABLE usage_events RENAME TO usage_events_old')
+                conn.execute('DROP INDEX IF EXISTS ix_usage_events_key_ts')
+            # AUTOINCREMENT never reuses an id, so a late refund can't delete a newer use
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS usage_events '
+                '(id INTEGER PRIMARY KEY AUTOINCREMENT, api_key_id INTEGER NOT NULL, ts REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_usage_events_key_ts ON usage_events (api_key_id, ts)')
+            if columns and 'id' not in columns:
+                conn.execute('INSERT INTO usage_events (api_key_id, ts) SELECT api_key_id, ts FROM usage_events_old')
+                conn.execute('DROP TABLE usage_events_old')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection inherited across fork (e.g. a preloaded app) must not be reused
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def acquire(self, key_id, limit, window, now, consume=True):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM usage_events WHERE api_key_id = ? AND ts <= ?', (key_id, now - window))
+            count, oldest = conn.execute(
+                'SELECT COUNT(*), MIN(ts) FROM usage_events WHERE api_key_id = ?', (key_id,)
+            ).fetchone()
+            if count >= limit:
+                conn.execute('COMMIT')
+                return False, count, oldest + window - now, None
+            event_id = None
+            if consume:
+                event_id = conn.execute(
+                    'INSERT INTO usage_events (api_key_id, ts) VALUES (?, ?)', (key_id, now)
+                ).lastrowid
+                count += 1
+            conn.execute('COMMIT')
+            return True, count, 0, event_id
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release(self, key_id, event_id):
+        self._conn().execute('DELETE FROM usage_events WHERE id = ? AND api_key_id = ?', (event_id, key_id))
+
+    def count(self, key_id, window, now):
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM usage_events WHERE api_key_id = ? AND ts > ?', (key_id, now - window)
+        ).fetchone()[0]
+
+    def purge(self, cutoff):
+        # acquire() only trims the key it checks; this clears keys that went quiet
+        self._conn().execute('DELETE FROM usage_events WHERE ts <= ?', (cutoff,))
+
+
+class RateLimiter:
+    """Rolling daily quota per API key.
+
+    Admission is decided against the window store alone; APIKey.daily_usage
+    and last_used are only a reporting copy, written in one batch every
+    RATE_LIMIT_FLUSH_INTERVAL seconds by a background thread.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.window = 24 * 60 * 60
+        self.flush_interval = 30
+        self._store = None
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.window = app.config['RATE_LIMIT_WINDOW']
+        self.flush_interval = app.config['RATE_LIMIT_FLUSH_INTERVAL']
+        store = app.config['RATE_LIMIT_STORE']
+        self._store = MemoryWindow() if store == 'memory' else SQLiteWindow(store)
+        app.extensions['rate_limiter'] = self
+
+    def _decide(self, key_id, limit, consume):
+        now = time.time()
+        allowed, count, retry_after, event_id = self._store.acquire(key_id, limit, self.window, now, consume)
+        if allowed and consume:
+            self._touch(key_id, now)
+        return Decision(allowed, limit, max(0, limit - count), retry_after, event_id)
+
+    def acquire(self, key_id, limit):
+        """Count one use against the key if it is under its limit."""
+        return self._decide(key_id, limit, consume=True)
+
+    def peek(self, key_id, limit):
+        """Check the limit without counting a use."""
+        return self._decide(key_id, limit, consume=False)
+
+    def release(self, key_id, event_id):
+        """Give back the use event_id, from acquire(), that did not end in a signed IPA.
+
+        Only that use is removed, so a late refund never cancels a newer
+        one, and a use that already left the window is simply gone.
+        """
+        if event_id is None:
+            return
+        self._store.release(key_id, event_id)
+        self._touch(key_id, None)
+
+    def _touch(self, key_id, used_at):
+        with self._lock:
+            if used_at is not None or key_id not in self._touched:
+                self._touched[key_id] = used_at
+        self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._run, name='rate-limit-flush', daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush API key usage')
+
+    def flush(self):
+        now = time.time()
+        self._store.purge(now - self.window)
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+
+        with self.app.app_context():
+            for key_id, used_at in touched.items():
+                values = {APIKey.daily_usage: self._store.count(key_id, self.window, now)}
+                if used_at is not None:
+                    values[APIKey.last_used] = datetime.utcfromtimestamp(used_at)
+                APIKey.query.filter_by(id=key_id).update(values)
+            db.session.commit()
+
+    def shutdown(self):
+        self._stopped.set()
+        self.flush()
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,159 @@
+import os
+import zlib
+import shutil
+import struct
+import zipfile
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 1024 * 1024
+LOCAL_HEADER_SIZE = 30
+# zsign's own cache and debug output inside a folder it signed, not part of the app; skipped at any depth
+IGNORED_FILES = {'.zsign_cache', '.zsign_debug'}
+
+# Uncompressed bytes whose compressed data was copied from the original IPA, and bytes deflated again
+RepackResult = namedtuple('RepackResult', ['reused_bytes', 'compressed_bytes'])
+
+
+def _crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+
+def _pack(path, original, level, tmp_dir):
+    """Compress one file unless it still matches its original entry.
+
+    Returns None for an unchanged file, else (data path, crc, compressed
+    size, size). The data path is a temporary file in tmp_dir, or path
+    itself when level is 0 and the file is stored as is.
+    """
+    size = os.path.getsize(path)
+    if original is not None and size == original.file_size and _crc32(path) == original.CRC:
+        return None
+    if not level:
+        return path, _crc32(path), size, size
+
+    # Raw deflate, as zip stores it; zlib releases the GIL, so files compress in parallel threads
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            dst.write(compressor.compress(chunk))
+        dst.write(compressor.flush())
+        compress_size = dst.tell()
+    return tmp_path, crc, compress_size, size
+
+
+def _copy(source, dest, length):
+    while length:
+        chunk = source.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated zip entry')
+        dest.write(chunk)
+        length -= len(chunk)
+
+
+def _write_entry(archive, info, source, offset):
+    """Append an entry whose compressed data is info.compress_size bytes of source from offset."""
+    # Sizes and CRC are known up front, so no data descriptor follows the data
+    info.flag_bits &= ~0x08
+    info.header_offset = archive.fp.tell()
+    archive.fp.write(info.FileHeader())
+    source.seek(offset)
+    _copy(source, archive.fp, info.compress_size)
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive.start_dir = archive.fp.tell()
+
+
+def _data_offset(source, info):
+    source.seek(info.header_offset)
+    header = source.read(LOCAL_HEADER_SIZE)
+    if len(header) != LOCAL_HEADER_SIZE or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f'Bad local header for {info.filename}')
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def _entry(name, date_time, external_attr, compress_type, crc, compress_size, file_size):
+    info = zipfile.ZipInfo(name, date_time)
+    info.external_attr = external_attr
+    info.compress_type = compress_type
+    info.CRC = crc
+    info.compress_size = compress_size
+    info.file_size = file_size
+    return info
+
+
+def repack_ipa(source_path, folder, output_path, level=6, threads=None):
+    """Zip a signed folder into output_path, reusing source_path's compressed data where nothing changed.
+
+    folder is source_path extracted and then signed in place. A file whose
+    size and CRC still match its entry in source_path keeps that entry's
+    compressed bytes verbatim, so only the binaries and _CodeSignature
+    files zsign rewrote, and anything it added, are deflated again, at
+    level across threads. Entries keep the original order and attributes.
+    """
+    files = {}
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = [name for name in dirs if name not in IGNORED_FILES]
+        for name in names:
+            if name in IGNORED_FILES:
+                continue
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, folder).replace(os.sep, '/')] = path
+
+    compress_type = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)), prefix='repack-')
+    reused_bytes = compressed_bytes = 0
+    try:
+        with zipfile.ZipFile(source_path) as original, open(source_path, 'rb') as source, \
+                ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as pool, \
+                zipfile.ZipFile(output_path, 'w', allowZip64=True) as archive:
+            plan = []
+            for info in original.infolist():
+                if info.is_dir():
+                    if os.path.isdir(os.path.join(folder, info.filename)):
+                        plan.append((info, None, None))
+                elif info.filename in files:
+                    path = files.pop(info.filename)
+                    plan.append((info, path, pool.submit(_pack, path, info, level, tmp_dir)))
+            for name in sorted(files):
+                plan.append((None, files[name], pool.submit(_pack, files[name], None, level, tmp_dir)))
+
+            for info, path, future in plan:
+                packed = future.result() if future else None
+                if packed is None:
+                    entry = _entry(info.filename, info.date_time, info.external_attr, info.compress_type,
+                                   info.CRC, info.compress_size, info.file_size)
+                    _write_entry(archive, entry, source, _data_offset(source, info))
+                    reused_bytes += info.file_size
+                    continue
+
+                data_path, crc, compress_size, file_size = packed
+                if info is None:
+                    stat = zipfile.ZipInfo.from_file(path, os.path.relpath(path, folder))
+                    name, date_time, external_attr = stat.filename, stat.date_time, stat.external_attr
+                else:
+                    name, external_attr = info.filename, info.external_attr
+                    date_time = zipfile.ZipInfo.from_file(path).date_time
+                entry = _entry(name, date_time, external_attr, compress_type, crc, compress_size, file_size)
+                with open(data_path, 'rb') as data:
+                    _write_entry(archive, entry, data, 0)
+                if data_path != path:
+                    os.remove(data_path)
+                compressed_bytes += file_size
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return RepackResult(reused_bytes, compressed_bytes)
@@ -0,0 +1,96 @@
+import os
+import gzip
+import json
+import click
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+
+from models import SigningJob, WebhookDelivery, db
+from utils.rollups import FINAL_STATUSES, day_bucket
+
+
+def job_record(job):
+    """Every column of a job, ready for json.dumps."""
+    record = {}
+    for column in inspect(SigningJob).columns:
+        value = getattr(job, column.key)
+        record[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+def write_archive(folder, jobs):
+    """Write jobs to a gzipped JSON-lines file named after their id range and return its path."""
+    month = jobs[0].created_at.strftime('%Y-%m')
+    directory = os.path.join(folder, month)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'jobs-{jobs[0].id}-{jobs[-1].id}.jsonl.gz')
+    # A crash mid-write leaves only the .tmp file, and the rows are still in the database
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        for job in jobs:
+            f.write(json.dumps(job_record(job)) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def remove_output(path, signed_folder):
+    # Outputs in the signed cache are shared between jobs and evicted by the cache itself
+    if not path or os.path.dirname(os.path.abspath(path)) != os.path.abspath(signed_folder):
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+@click.command('archive-jobs')
+@click.option('--days', type=int, default=None, help='Keep jobs from this many days (default JOB_RETENTION_DAYS).')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+@click.option('--dry-run', is_flag=True, help='Count the jobs that would be archived and stop.')
+@with_appcontext
+def archive_jobs_command(days, batch_size, dry_run):
+    """Move finished jobs past the retention period to gzipped JSON-lines files.
+
+    Only whole days are archived, so the rollups for every day still in the
+    table stay exactly reproducible by rebuild-rollups. The rollups of the
+    archived days are kept as they are.
+    """
+    if days is None:
+        days = current_app.config['JOB_RETENTION_DAYS']
+    cutoff = day_bucket(datetime.utcnow() - timedelta(days=days))
+    folder = current_app.config['JOB_ARCHIVE_FOLDER']
+    signed_folder = current_app.config['SIGNED_FOLDER']
+    expired = SigningJob.query.filter(
+        SigningJob.status.in_(FINAL_STATUSES),
+        SigningJob.created_at < cutoff
+    )
+
+    if dry_run:
+        click.echo(f'{expired.count()} job(s) created before {cutoff:%Y-%m-%d} would be archived')
+        return
+
+    archived = 0
+    last_id = 0
+    while True:
+        jobs = expired.filter(SigningJob.id > last_id).order_by(SigningJob.id).limit(batch_size).all()
+        if not jobs:
+            break
+        path = write_archive(folder, jobs)
+        outputs = [job.output_file for job in jobs]
+        last_id = jobs[-1].id
+        ids = [job.id for job in jobs]
+        WebhookDelivery.query.filter(WebhookDelivery.job_id.in_(ids)).delete(synchronize_session=False)
+        SigningJob.query.filter(SigningJob.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        # Files go only once their rows are gone, so a failed commit never leaves a job without its output
+        for output in outputs:
+            remove_output(output, signed_folder)
+        archived += len(jobs)
+        click.echo(f'Archived {len(jobs)} job(s) to {path}')
+        db.session.expunge_all()
+
+    click.echo(f'Archived {archived} job(s) created before {cutoff:%Y-%m-%d}')
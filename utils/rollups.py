@@ -0,0 +1,71 @@
+import click
+from collections import Counter
+from flask.cli import with_appcontext
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import APIKey, SigningJob, HourlyJobRollup, DailyJobRollup, db
+
+FINAL_STATUSES = ('completed', 'failed')
+
+
+def hour_bucket(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _increment(model, bucket, api_key_id, tier, status, amount=1):
+    filters = dict(bucket=bucket, api_key_id=api_key_id, tier=tier, status=status)
+    if model.query.filter_by(**filters).update({model.count: model.count + amount}):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(count=amount, **filters))
+    except IntegrityError:
+        # Another worker created the row between our UPDATE and INSERT
+        model.query.filter_by(**filters).update({model.count: model.count + amount})
+
+
+def record_job(job, tier):
+    """Count a finished job in the hourly and daily rollups; the caller commits."""
+    _increment(HourlyJobRollup, hour_bucket(job.created_at), job.api_key_id, tier, job.status)
+    _increment(DailyJobRollup, day_bucket(job.created_at), job.api_key_id, tier, job.status)
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """Recompute the job rollups from the SigningJob table.
+
+    Days before the oldest remaining finished job were archived by
+    archive-jobs, so their rollups are the only record left and are kept.
+    """
+    finished = SigningJob.status.in_(FINAL_STATUSES)
+    oldest = db.session.query(func.min(SigningJob.created_at)).filter(finished).scalar()
+    if oldest is None:
+        click.echo('No finished jobs to rebuild from')
+        return
+    since = day_bucket(oldest)
+
+    tiers = dict(db.session.query(APIKey.id, APIKey.tier).all())
+    hourly = Counter()
+    daily = Counter()
+    jobs = db.session.query(
+        SigningJob.created_at, SigningJob.api_key_id, SigningJob.status
+    ).filter(finished).yield_per(10000)
+    for created_at, api_key_id, status in jobs:
+        hourly[(hour_bucket(created_at), api_key_id, status)] += 1
+        daily[(day_bucket(created_at), api_key_id, status)] += 1
+
+    for model, counts in ((HourlyJobRollup, hourly), (DailyJobRollup, daily)):
+        model.query.filter(model.bucket >= since).delete()
+        db.session.bulk_save_objects([
+            model(bucket=bucket, api_key_id=api_key_id, tier=tiers.get(api_key_id, 'regular'),
+                  status=status, count=count)
+            for (bucket, api_key_id, status), count in counts.items()
+        ])
+    db.session.commit()
+    click.echo(f'Rebuilt {len(hourly)} hourly and {len(daily)} daily rollup rows from {since:%Y-%m-%d}')
@@ -0,0 +1,382 @@
+import os
+import time
+import sqlite3
+import logging
+import itertools
+import threading
+from collections import Counter, OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# Share of dispatch turns each tier gets while several tiers have work waiting
+TIER_WEIGHTS = {
+    'enterprise': 8,
+    'premium': 4,
+    'regular': 1
+}
+# Seconds another process's published waiting work counts for unless it refreshes it
+WAITING_TTL = 5
+# Seconds between read-only checks of the ledger while queued work waits for a slot
+POLL_INTERVAL = 0.25
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def choose(wants, running_total, running, passes, clock, rivals, workers, reserved):
+    """Decide which of this process's keys starts a task next, as (tier, key id), or None to wait.
+
+    wants maps tiers to [(key id, cap, queued)] of the keys with queued
+    tasks here, in round-robin order. running_total and running (by key)
+    count running tasks everywhere. passes are the tiers' stride passes,
+    where an idle tier rejoins at clock. rivals are tiers other processes
+    have runnable work in; when one of them is due first, this process
+    waits and leaves the slot to it.
+    """
+    if running_total >= workers:
+        return None
+
+    def open_to(tier):
+        return tier == 'enterprise' or running_total < workers - reserved
+
+    best = None
+    for tier, keys in wants.items():
+        if not open_to(tier):
+            continue
+        for key_id, cap, _ in keys:
+            if running.get(key_id, 0) < cap:
+                tier_pass = max(passes.get(tier, 0.0), clock)
+                if best is None or tier_pass < best[0]:
+                    best = (tier_pass, tier, key_id)
+                break
+    if best is None:
+        return None
+    for tier in rivals:
+        if open_to(tier) and max(passes.get(tier, 0.0), clock) < best[0]:
+            return None
+    return best[1], best[2]
+
+
+def _advance(passes, clock, tier):
+    """Return (passes, clock) after tier takes a turn."""
+    tier_pass = max(passes.get(tier, 0.0), clock)
+    return dict(passes, **{tier: tier_pass + 1 / TIER_WEIGHTS[tier]}), tier_pass
+
+
+class MemorySlots:
+    """Slot ledger kept in this process only."""
+
+    def __init__(self):
+        self._slots = {}  # slot id -> key id
+        self._ids = itertools.count(1)
+        self._passes = {}
+        self._clock = 0.0
+        self._lock = threading.Lock()
+
+    def claim(self, wants, workers, reserved, free=None):
+        """Take a slot for one of wants' keys and return (tier, key id, slot id), or None."""
+        with self._lock:
+            picked = choose(wants, len(self._slots), Counter(self._slots.values()), self._passes, self._clock,
+                            (), workers, reserved)
+            if picked is None:
+                return None
+            tier, key_id = picked
+            self._passes, self._clock = _advance(self._passes, self._clock, tier)
+            slot_id = next(self._ids)
+            self._slots[slot_id] = key_id
+            return tier, key_id, slot_id
+
+    def release(self, slot_id):
+        with self._lock:
+            self._slots.pop(slot_id, None)
+
+    def changed(self):
+        # Every change comes from this process, which wakes its scheduler itself
+        return False
+
+
+class SQLiteSlots:
+    """Slot ledger in a SQLite file shared by every web worker on the host.
+
+    Running slots, the tiers' passes and how much runnable work each
+    process has waiting per tier live in the file, and a claim reads and
+    updates them in one BEGIN IMMEDIATE transaction. Rows of processes
+    that died are dropped by the next claim. A process's waiting work is
+    only rewritten when it changes, or to keep it from going stale, so a
+    claim that finds nothing to do doesn't wake every other process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._published = (None, None, 0.0)  # (pid, waiting rows, time) last written from this process
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS signing_slots '
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER NOT NULL, api_key_id INTEGER NOT NULL, '
+            'tier TEXT NOT NULL, started REAL NOT NULL)'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS signing_waiting '
+            '(pid INTEGER NOT NULL, tier TEXT NOT NULL, runnable INTEGER NOT NULL, updated REAL NOT NULL, '
+            'PRIMARY KEY (pid, tier))'
+        )
+        # One row per tier, plus the scheduler clock under the tier name ''
+        conn.execute('CREATE TABLE IF NOT EXISTS signing_passes (tier TEXT PRIMARY KEY, pass REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection inherited across fork (e.g. a preloaded app) must not be reused
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def claim(self, wants, workers, reserved, free=None):
+        """Take a slot for one of wants' keys and return (tier, key id, slot id), or None.
+
+        free is how many more tasks this process could start right now; no
+        more than that of its waiting work is published to the others.
+        """
+        conn = self._conn()
+        pid = os.getpid()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for (other,) in conn.execute(
+                'SELECT pid FROM signing_slots UNION SELECT pid FROM signing_waiting'
+            ).fetchall():
+                if other != pid and not _alive(other):
+                    conn.execute('DELETE FROM signing_slots WHERE pid = ?', (other,))
+                    conn.execute('DELETE FROM signing_waiting WHERE pid = ?', (other,))
+
+            running = dict(conn.execute('SELECT api_key_id, COUNT(*) FROM signing_slots GROUP BY api_key_id'))
+            passes = dict(conn.execute('SELECT tier, pass FROM signing_passes'))
+            clock = passes.pop('', 0.0)
+            rivals = {tier for (tier,) in conn.execute(
+                'SELECT DISTINCT tier FROM signing_waiting WHERE pid != ? AND runnable > 0 AND updated > ?',
+                (pid, now - WAITING_TTL)
+            )}
+
+            claimed = None
+            picked = choose(wants, sum(running.values()), running, passes, clock, rivals, workers, reserved)
+            if picked is not None:
+                tier, key_id = picked
+                passes, clock = _advance(passes, clock, tier)
+                conn.executemany(
+                    'INSERT OR REPLACE INTO signing_passes (tier, pass) VALUES (?, ?)',
+                    [(tier, passes[tier]), ('', clock)]
+                )
+                slot_id = conn.execute(
+                    'INSERT INTO signing_slots (pid, api_key_id, tier, started) VALUES (?, ?, ?, ?)',
+                    (pid, key_id, tier, now)
+                ).lastrowid
+                running[key_id] = running.get(key_id, 0) + 1
+                claimed = (tier, key_id, slot_id)
+
+            # Tell the other processes what is still waiting here and could run
+            if free is not None:
+                free -= 1 if claimed else 0
+            waiting = tuple(
+                (tier, min(free if free is not None else workers, sum(
+                    queued - (1 if claimed and claimed[1] == key_id else 0)
+                    for key_id, cap, queued in wants.get(tier, ())
+                    if running.get(key_id, 0) < cap
+                )))
+                for tier in TIER_WEIGHTS
+            )
+            published_pid, published, published_at = self._published
+            publish = (published_pid, published) != (pid, waiting) or now - published_at >= WAITING_TTL / 2
+            if publish:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO signing_waiting (pid, tier, runnable, updated) VALUES (?, ?, ?, ?)',
+                    [(pid, tier, runnable, now) for tier, runnable in waiting]
+                )
+            conn.execute('COMMIT')
+            if publish:
+                self._published = (pid, waiting, now)
+            return claimed
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release(self, slot_id):
+        self._conn().execute('DELETE FROM signing_slots WHERE id = ?', (slot_id,))
+
+    def clear(self):
+        """Drop every process's slots and waiting work; only safe while no worker is running."""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM signing_slots')
+        conn.execute('DELETE FROM signing_waiting')
+        conn.execute('COMMIT')
+
+    def changed(self):
+        """Whether another connection has written to the ledger since this thread last asked.
+
+        Reads SQLite's data_version, so waiting for a slot takes no lock.
+        """
+        version = self._conn().execute('PRAGMA data_version').fetchone()[0]
+        changed = version != getattr(self._local, 'version', None)
+        self._local.version = version
+        return changed
+
+
+class FairScheduler:
+    """Weighted fair queue of signing tasks.
+
+    Tiers take turns in proportion to TIER_WEIGHTS (stride scheduling), keys
+    within a tier take turns round-robin, and a key never has more than its
+    max_concurrent tasks running. reserved slots of the workers are kept
+    free for enterprise keys, so a flood of lower-tier work can't occupy
+    every worker.
+
+    Tasks are queued in this process, but running slots and the tiers'
+    passes are kept in a ledger. With a SQLiteSlots ledger shared by the
+    web workers, workers, the caps, the weights and the reserved slots
+    hold across all of them, and capacity is how many tasks this process
+    runs at once. The ledger is only consulted outside the queue's lock,
+    so put() and done() never wait on another process.
+    """
+
+    def __init__(self, workers=1, reserved=0, ledger=None, capacity=None):
+        self.workers = workers
+        self.reserved = min(reserved, workers - 1)
+        self.ledger = ledger or MemorySlots()
+        self.capacity = capacity or workers
+        self._cond = threading.Condition()
+        # One claim at a time from this process, so two dispatchers never take a slot for the same task
+        self._claim_lock = threading.Lock()
+        self._keys = {tier: OrderedDict() for tier in TIER_WEIGHTS}  # key id -> deque of tasks
+        self._caps = {}
+        self._slots = {}  # key id -> ledger slot ids of its running tasks
+        self._running_total = 0
+        self._queued = Counter()
+        self._changes = 0  # bumped by every put, done and close, to wake dispatchers
+        self._closed = False
+
+    def put(self, task, key_id, tier, max_concurrent):
+        tier = tier if tier in TIER_WEIGHTS else 'regular'
+        with self._cond:
+            self._keys[tier].setdefault(key_id, deque()).append(task)
+            self._caps[key_id] = max(1, max_concurrent)
+            self._queued[tier] += 1
+            self._changes += 1
+            self._cond.notify_all()
+
+    def _wants(self):
+        return {
+            tier: [(key_id, self._caps[key_id], len(tasks)) for key_id, tasks in keys.items()]
+            for tier, keys in self._keys.items() if keys
+        }
+
+    def _take(self, claimed):
+        """Pop the task a ledger claim was made for; called with the lock held."""
+        tier, key_id, slot_id = claimed
+        keys = self._keys[tier]
+        task = keys[key_id].popleft()
+        # Round-robin: the key goes to the back of its tier
+        if keys[key_id]:
+            keys.move_to_end(key_id)
+        else:
+            del keys[key_id]
+        self._queued[tier] -= 1
+        self._slots.setdefault(key_id, []).append(slot_id)
+        self._running_total += 1
+        return key_id, task
+
+    def _pick(self):
+        """Claim a slot for the next task and return (key id, task), or None if none may run now."""
+        with self._claim_lock:
+            with self._cond:
+                wants = self._wants()
+                free = self.capacity - self._running_total
+            if not wants:
+                return None
+            claimed = self.ledger.claim(wants, self.workers, self.reserved, free=free)
+            if claimed is None:
+                return None
+            # Only claimers take tasks out, so the claimed key still has one queued
+            with self._cond:
+                return self._take(claimed)
+
+    def _changed(self):
+        try:
+            return self.ledger.changed()
+        except Exception:
+            logger.exception('Signing slot ledger failed')
+            return True
+
+    def get(self):
+        """Block until a task may run and return (key id, task), or None once closed and drained."""
+        while True:
+            with self._cond:
+                while not self.qsize():
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                changes = self._changes
+            try:
+                picked = self._pick()
+            except Exception:
+                logger.exception('Signing slot ledger failed')
+                picked = None
+            if picked is not None:
+                return picked
+
+            # Wait for a change here, a write to the ledger by another process, or
+            # WAITING_TTL / 2 to refresh this process's waiting work in the ledger
+            deadline = time.monotonic() + WAITING_TTL / 2
+            while time.monotonic() < deadline and not self._changed():
+                with self._cond:
+                    if self._changes != changes:
+                        break
+                    self._cond.wait(POLL_INTERVAL)
+
+    def done(self, key_id):
+        with self._cond:
+            slots = self._slots[key_id]
+            slot_id = slots.pop()
+            if not slots:
+                del self._slots[key_id]
+                if not any(key_id in keys for keys in self._keys.values()):
+                    self._caps.pop(key_id, None)
+            self._running_total -= 1
+        try:
+            self.ledger.release(slot_id)
+        except Exception:
+            logger.exception('Signing slot ledger failed')
+        with self._cond:
+            self._changes += 1
+            self._cond.notify_all()
+
+    def close(self):
+        """Let get() return None to every caller once the queued tasks have run."""
+        with self._cond:
+            self._closed = True
+            self._changes += 1
+            self._cond.notify_all()
+
+    def reopen(self):
+        with self._cond:
+            self._closed = False
+
+    def qsize(self, tier=None):
+        if tier is None:
+            return sum(self._queued.values())
+        return self._queued[tier]
+
+    def running(self, key_id=None):
+        """Tasks running from this process, of key_id or in total."""
+        if key_id is None:
+            return self._running_total
+        return len(self._slots.get(key_id, ()))
@@ -0,0 +1,118 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SignedCache:
+    """Content-addressed cache of signed IPAs with size-based LRU eviction.
+
+    Entries are plain files named after their cache key. A hit bumps the
+    file's mtime, and eviction removes the least recently used files until
+    the cache fits in its disk budget.
+    """
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.max_bytes = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['SIGNED_CACHE_FOLDER']
+        self.max_bytes = app.config['SIGNED_CACHE_MAX_BYTES']
+        os.makedirs(self.folder, exist_ok=True)
+        app.extensions['signed_cache'] = self
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(ipa_hash, p12_hash, prov_hash, p12_password, options=None):
+        # The password is part of the key so a cached result is never served
+        # to a request that could not have unlocked the certificate itself.
+        material = json.dumps({
+            'ipa': ipa_hash,
+            'p12': p12_hash,
+            'mobileprovision': prov_hash,
+            'password': hashlib.sha256(p12_password.encode()).hexdigest(),
+            'options': options or {}
+        }, sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f'{key}.ipa')
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, source_path):
+        """Hard-link (or copy) a freshly signed IPA into the cache and return its cached path."""
+        if not self.enabled:
+            return source_path
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            try:
+                os.link(source_path, tmp_path)
+            except OSError:
+                shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.folder):
+                if not entry.name.endswith('.ipa'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    logger.info(f'Evicted signed IPA {os.path.basename(path)} from cache')
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+signed_cache = SignedCache()
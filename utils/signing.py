@@ -1,56 +1,266 @@
 import os
+import time
+import shutil
+import signal
+import resource
+import tempfile
+import threading
 import subprocess
 import logging
-import shutil
-from werkzeug.utils import secure_filename
+from collections import namedtuple
+from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
-def sign_ipa(ipa_path: str, p12_path: str, prov_path: str, p12_password: str) -> str:
+DEFAULT_ZSIGN_PATH = '/tmp/zsign/zsign'
+
+# Resource use of one zsign run: started_at is a time.time() value, wall_time and cpu_time are seconds and
+# peak_rss is bytes, all for the zsign process itself. kill_reason is None unless it was killed, e.g.
+# 'timeout' or 'file_size', and stderr is at most STDERR_TAIL characters from its end.
+ZsignUsage = namedtuple('ZsignUsage', [
+    'started_at', 'wall_time', 'cpu_time', 'peak_rss', 'kill_reason', 'returncode', 'stderr'
+])
+# usage is the ZsignUsage of the run that produced output_path
+SigningResult = namedtuple('SigningResult', ['output_path', 'usage'])
+
+STDERR_TAIL = 4096
+
+# Signals a kill reason is named after instead of the signal itself
+KILL_REASONS = {
+    signal.SIGXFSZ: 'file_size',
+    signal.SIGXCPU: 'cpu_time'
+}
+
+
+class SigningError(Exception):
+    """A failed signing; reason is the error class, e.g. 'password' or 'provision'.
+
+    usage is the ZsignUsage of the zsign run, if zsign got to run.
+    """
+
+    def __init__(self, message, reason='internal', usage=None):
+        super().__init__(message)
+        self.reason = reason
+        self.usage = usage
+
+    def __reduce__(self):
+        # Keep the reason and usage when the error crosses the process pool
+        return (SigningError, (str(self), self.reason, self.usage))
+
+
+@dataclass(frozen=True)
+class ZsignLimits:
+    """Bounds for one zsign run; None leaves a bound unset.
+
+    timeout is wall-clock seconds, after which zsign's whole process group
+    is killed. max_memory (address space), max_file_size and
+    max_open_files become rlimits. nice and cpus (a CPU affinity set) set
+    the process's priority and placement.
+    """
+    timeout: float = None
+    max_memory: int = None
+    max_file_size: int = None
+    max_open_files: int = None
+    nice: int = 0
+    cpus: frozenset = None
+
+    def _apply(self):
+        # Runs in the child between fork and exec
+        if self.nice:
+            os.nice(self.nice)
+        if self.cpus:
+            os.sched_setaffinity(0, self.cpus)
+        for limit, value in (
+            (resource.RLIMIT_AS, self.max_memory),
+            (resource.RLIMIT_FSIZE, self.max_file_size),
+            (resource.RLIMIT_NOFILE, self.max_open_files)
+        ):
+            if value:
+                _, hard = resource.getrlimit(limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                resource.setrlimit(limit, (value, value))
+
+    @property
+    def restricts_child(self):
+        return bool(self.nice or self.cpus or self.max_memory or self.max_file_size or self.max_open_files)
+
+
+def parse_cpus(value):
+    """Parse a CPU list such as '0-3,6' into a frozenset of CPU numbers."""
+    cpus = set()
+    for part in value.split(','):
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return frozenset(cpus)
+
+
+def parse_tier_setting(value, parse=int):
+    """Parse 'regular=10 premium=5' into {'regular': 10, 'premium': 5}."""
+    settings = {}
+    for item in (value or '').split():
+        tier, _, setting = item.partition('=')
+        settings[tier] = parse(setting)
+    return settings
+
+
+def _kill_group(pgid):
     try:
-        # Create temp directory for zsign binary if not exists
-        zsign_dir = '/tmp/zsign'
-        os.makedirs(zsign_dir, exist_ok=True)
-        
-        # Clone zsign if not already present
-        if not os.path.exists(os.path.join(zsign_dir, 'zsign')):
-            subprocess.run(['git', 'clone', 'https://github.com/gyke69/compiled-zsign.git', zsign_dir], check=True)
-            subprocess.run(['chmod', '+x', os.path.join(zsign_dir, 'zsign')], check=True)
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_zsign(cmd, limits=None, cwd=None):
+    """Run zsign under limits in cwd and return (returncode, stderr, ZsignUsage).
+
+    zsign runs in its own session, so a timeout kills the helpers it
+    spawned along with it, and so does its exit.
+    """
+    limits = limits or ZsignLimits()
+    with tempfile.TemporaryFile() as stderr:
+        started_at = time.time()
+        start = time.monotonic()
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+            cwd=cwd,
+            start_new_session=True,
+            preexec_fn=limits._apply if limits.restricts_child else None
+        )
+        timed_out = threading.Event()
+
+        def expire():
+            timed_out.set()
+            _kill_group(process.pid)
+
+        timer = None
+        if limits.timeout:
+            timer = threading.Timer(limits.timeout, expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            # wait4 reports this child's own rusage; RUSAGE_CHILDREN would mix in earlier runs
+            _, status, usage = os.wait4(process.pid, 0)
+        finally:
+            if timer:
+                timer.cancel()
+            _kill_group(process.pid)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        wall_time = time.monotonic() - start
+
+        kill_reason = None
+        if timed_out.is_set():
+            kill_reason = 'timeout'
+        elif os.WIFSIGNALED(status):
+            sig = os.WTERMSIG(status)
+            kill_reason = KILL_REASONS.get(sig) or signal.Signals(sig).name.lower()
+        stderr.seek(0)
+        output = stderr.read().decode(errors='replace')
+        return (
+            process.returncode,
+            output,
+            ZsignUsage(
+                started_at, wall_time, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024, kill_reason,
+                process.returncode, output[-STDERR_TAIL:]
+            )
+        )
+
+
+def sign_ipa(ipa_path: str, p12_path: str, prov_path: str, p12_password: str, output_path: str = None,
+             cert_path: str = None, zsign_path: str = DEFAULT_ZSIGN_PATH, dylibs: list = None,
+             weak_dylibs: bool = False, bundle_id: str = None, bundle_name: str = None,
+             bundle_version: str = None, zip_level: int = 9, limits: ZsignLimits = None,
+             work_dir: str = None) -> SigningResult:
+    """Sign an IPA, or an extracted IPA folder, with zsign and return a SigningResult.
+
+    p12_path may also be an unencrypted PEM private key, in which case
+    cert_path is its certificate and p12_password is None. zsign_path must
+    already be installed; utils.toolchain prepares it at startup.
+
+    dylibs are injected into the main executable, as weak load commands
+    with weak_dylibs. bundle_id, bundle_name and bundle_version rewrite
+    the app's Info.plist. zsign changes a folder input in place; with
+    output_path None it is only signed there, without zipping it up, and
+    the result's output_path is the folder. zip_level is zsign's deflate
+    level for output_path. limits bound the zsign process. Failures raise
+    SigningError.
+
+    zsign keeps its .zsign_cache in the directory it runs in, work_dir. It
+    defaults to a folder input itself, so the cache stays with the folder,
+    and to a temporary directory removed afterwards for an IPA input.
+    """
+    usage = None
+    tmp_dir = None
+    if work_dir is None:
+        if os.path.isdir(ipa_path):
+            work_dir = ipa_path
+        else:
+            work_dir = tmp_dir = tempfile.mkdtemp(prefix='zsign-')
+    try:
+        if not os.path.exists(zsign_path):
+            raise SigningError(f"zsign binary not found at {zsign_path}", 'toolchain')
         
         # Prepare output path
-        output_dir = os.path.dirname(ipa_path)
-        output_path = os.path.join(output_dir, 'signed.ipa')
+        if output_path is None and not os.path.isdir(ipa_path):
+            output_dir = os.path.dirname(ipa_path)
+            output_path = os.path.join(output_dir, 'signed.ipa')
         
         # Build zsign command
-        cmd = [
-            os.path.join(zsign_dir, 'zsign'),
-            '-k', p12_path,
-            '-p', p12_password,
-            '-m', prov_path,
-            '-o', output_path,
-            '-z', '9',
-            ipa_path
-        ]
+        cmd = [zsign_path, '-k', p12_path]
+        if cert_path:
+            cmd += ['-c', cert_path]
+        if p12_password is not None:
+            cmd += ['-p', p12_password]
+        for dylib in dylibs or ():
+            cmd += ['-l', dylib]
+        if dylibs and weak_dylibs:
+            cmd.append('-w')
+        if bundle_id:
+            cmd += ['-b', bundle_id]
+        if bundle_name:
+            cmd += ['-n', bundle_name]
+        if bundle_version:
+            cmd += ['-r', bundle_version]
+        cmd += ['-m', prov_path]
+        if output_path:
+            cmd += ['-o', output_path, '-z', str(zip_level)]
+        cmd.append(ipa_path)
         
         # Execute zsign
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        returncode, stderr, usage = run_zsign(cmd, limits, cwd=work_dir)
+        if usage.kill_reason == 'timeout':
+            raise SigningError(f'zsign did not finish within {limits.timeout:g} seconds', 'timeout', usage)
+        if usage.kill_reason:
+            raise SigningError(f'zsign was killed ({usage.kill_reason})', 'killed', usage)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
         
+        if output_path is None:
+            return SigningResult(ipa_path, usage)
         if not os.path.exists(output_path):
-            raise Exception("Failed to generate signed IPA")
+            raise SigningError("Failed to generate signed IPA", 'no_output', usage)
             
-        return output_path
+        return SigningResult(output_path, usage)
         
     except subprocess.CalledProcessError as e:
         error_msg = f"zsign failed: {e.stderr}"
         logger.error(error_msg)
         if "password error" in e.stderr.lower():
-            raise Exception("Invalid P12 certificate password")
+            raise SigningError("Invalid P12 certificate password", 'password', usage)
         elif "provision error" in e.stderr.lower():
-            raise Exception("Invalid provisioning profile")
+            raise SigningError("Invalid provisioning profile", 'provision', usage)
         elif "bundle id" in e.stderr.lower():
-            raise Exception("Bundle ID mismatch between IPA and provisioning profile")
-        raise Exception(error_msg)
+            raise SigningError("Bundle ID mismatch between IPA and provisioning profile", 'bundle_id', usage)
+        raise SigningError(error_msg, 'zsign', usage)
+    except SigningError:
+        # Already says what went wrong, e.g. a timeout from run_zsign
+        raise
     except Exception as e:
         error_msg = f"Signing failed: {str(e)}"
         logger.error(error_msg)
-        raise Exception(error_msg)
+        raise SigningError(error_msg, getattr(e, 'reason', 'internal'), usage)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
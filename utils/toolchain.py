@@ -0,0 +1,391 @@
+import os
+import fcntl
+import shutil
+import struct
+import logging
+import plistlib
+import zipfile
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+from datetime import datetime, timedelta
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs7
+
+from utils.signed_cache import file_sha256
+from utils.signing import sign_ipa, ZsignLimits
+
+logger = logging.getLogger(__name__)
+
+# seconds; the smoke IPA is tiny, so anything slower means zsign is hung
+SMOKE_TIMEOUT = 120
+SMOKE_BUNDLE_ID = 'com.zsign.smoketest'
+SMOKE_EXECUTABLE = 'ZsignSmoke'
+
+
+class ToolchainError(Exception):
+    pass
+
+
+def write_smoke_credentials(folder):
+    """Write a throwaway self-signed key, certificate and matching profile for the smoke sign."""
+    team_id = 'SMOKETEST1'
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, 'zsign smoke test'),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, team_id)
+    ])
+    now = datetime.utcnow()
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    profile = plistlib.dumps({
+        'Name': 'zsign smoke test',
+        'TeamIdentifier': [team_id],
+        'CreationDate': now,
+        'ExpirationDate': now + timedelta(days=1),
+        'Entitlements': {'application-identifier': f'{team_id}.*'},
+        'DeveloperCertificates': [certificate.public_bytes(serialization.Encoding.DER)]
+    })
+    signed_profile = (
+        pkcs7.PKCS7SignatureBuilder()
+        .set_data(profile)
+        .add_signer(certificate, key, hashes.SHA256())
+        .sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.Binary])
+    )
+
+    paths = {
+        'key': os.path.join(folder, 'smoke.key.pem'),
+        'cert': os.path.join(folder, 'smoke.cert.pem'),
+        'profile': os.path.join(folder, 'smoke.mobileprovision')
+    }
+    with open(paths['key'], 'wb') as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+    with open(paths['cert'], 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(paths['profile'], 'wb') as f:
+        f.write(signed_profile)
+    return paths
+
+
+def _smoke_executable():
+    """A minimal arm64 Mach-O executable: __PAGEZERO, a __TEXT segment holding one ret, and __LINKEDIT."""
+    page = 0x4000
+    base = 0x100000000
+
+    def segment(name, vmaddr, vmsize, fileoff, filesize, prot, sections=()):
+        command = struct.pack('<II16sQQQQiiII', 0x19, 72 + 80 * len(sections), name.encode(),
+                              vmaddr, vmsize, fileoff, filesize, prot, prot, len(sections), 0)
+        return command + b''.join(sections)
+
+    text_section = struct.pack('<16s16sQQIIIIIIII', b'__text', b'__TEXT', base + 0x1000, 4, 0x1000, 2,
+                               0, 0, 0x80000400, 0, 0, 0)
+    commands = [
+        segment('__PAGEZERO', 0, base, 0, 0, 0),
+        segment('__TEXT', base, page, 0, page, 5, [text_section]),
+        segment('__LINKEDIT', base + page, page, page, 16, 1)
+    ]
+    header = struct.pack('<IiiIIIII', 0xfeedfacf, 0x0100000c, 0, 2, len(commands),
+                         sum(len(command) for command in commands), 0x200085, 0)
+    binary = bytearray(page + 16)
+    load_commands = header + b''.join(commands)
+    binary[:len(load_commands)] = load_commands
+    binary[0x1000:0x1004] = struct.pack('<I', 0xd65f03c0)  # ret
+    return bytes(binary)
+
+
+def write_smoke_ipa(folder):
+    """Write a tiny IPA for the smoke sign, one app whose bundle ID matches the smoke profile."""
+    path = os.path.join(folder, 'smoke.ipa')
+    app_dir = f'Payload/{SMOKE_EXECUTABLE}.app'
+    info = plistlib.dumps({
+        'CFBundleIdentifier': SMOKE_BUNDLE_ID,
+        'CFBundleExecutable': SMOKE_EXECUTABLE,
+        'CFBundleName': SMOKE_EXECUTABLE,
+        'CFBundlePackageType': 'APPL',
+        'CFBundleVersion': '1',
+        'CFBundleShortVersionString': '1.0',
+        'MinimumOSVersion': '12.0'
+    })
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(f'{app_dir}/Info.plist', info)
+        executable = zipfile.ZipInfo(f'{app_dir}/{SMOKE_EXECUTABLE}')
+        executable.compress_type = zipfile.ZIP_DEFLATED
+        executable.external_attr = 0o100755 << 16
+        archive.writestr(executable, _smoke_executable())
+    return path
+
+
+class ToolchainState(namedtuple('ToolchainState', [
+    'sha256', 'version', 'smoke_test', 'error', 'checked_at', 'file_stat'
+])):
+    """Result of one verification of zsign, published as a whole so readers never see half of one."""
+    __slots__ = ()
+
+    @property
+    def ready(self):
+        return self.error is None and self.version is not None
+
+
+UNCHECKED = ToolchainState(None, None, 'skipped', 'Signing toolchain has not been checked yet', None, None)
+
+
+class Toolchain:
+    """Resolves, verifies and smoke-tests the zsign binary at startup.
+
+    The request path only reads the last published ToolchainState; it
+    never fetches, hashes or runs the binary itself. A background thread
+    re-verifies it every ZSIGN_RECHECK_INTERVAL seconds, so a binary
+    removed or replaced after startup takes signing offline instead of
+    failing every job, and a good one put back brings it online again.
+    """
+
+    def __init__(self, app=None):
+        self.path = None
+        self.expected_sha256 = None
+        self.install_url = None
+        self.install_ref = None
+        self.smoke_ipa = None
+        self.recheck_interval = 60
+        self.state = UNCHECKED
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config['ZSIGN_PATH']
+        self.expected_sha256 = app.config['ZSIGN_SHA256']
+        self.install_url = app.config['ZSIGN_INSTALL_URL']
+        self.install_ref = app.config['ZSIGN_INSTALL_REF']
+        self.smoke_ipa = app.config['ZSIGN_SMOKE_IPA']
+        self.recheck_interval = app.config['ZSIGN_RECHECK_INTERVAL']
+        app.extensions['toolchain'] = self
+        if app.config['ZSIGN_WARMUP']:
+            self.prepare()
+
+    @property
+    def ready(self):
+        return self.state.ready
+
+    @property
+    def sha256(self):
+        return self.state.sha256
+
+    @property
+    def version(self):
+        return self.state.version
+
+    @property
+    def error(self):
+        return self.state.error
+
+    def prepare(self, install=True):
+        """Install (unless install=False), verify and smoke-sign zsign, publish the result and return whether it is ready."""
+        sha256 = version = file_stat = None
+        smoke_test = 'skipped'
+        error = None
+        try:
+            if install:
+                self._install()
+            elif not os.path.exists(self.path):
+                raise ToolchainError(f'zsign binary not found at {self.path}')
+            file_stat, sha256, version = self._verify()
+            self._smoke_sign()
+            smoke_test = 'passed'
+            logger.info(f'zsign {version} ready at {self.path}')
+        except Exception as e:
+            error = str(e)
+            if version:
+                smoke_test = 'failed'
+            logger.error(f'zsign toolchain not ready: {error}')
+        self.state = ToolchainState(sha256, version, smoke_test, error, datetime.utcnow(), file_stat)
+        return self.state.ready
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def start(self):
+        """Start re-verifying zsign in the background, once per process."""
+        if not self.recheck_interval:
+            return
+        with self._lock:
+            # A thread started before a fork did not survive into this process
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._stopped.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='zsign-recheck', daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.recheck_interval):
+            try:
+                self.recheck()
+            except Exception:
+                logger.exception('zsign recheck failed')
+
+    def recheck(self):
+        """Re-verify zsign; an unchanged, ready binary is only stat'ed.
+
+        A changed, missing or failed one is verified and smoke-signed
+        again, without fetching it.
+        """
+        state = self.state
+        if state.ready and self._stat() == state.file_stat:
+            self.state = state._replace(checked_at=datetime.utcnow())
+        else:
+            self.prepare(install=False)
+
+    def check(self):
+        """Return whether zsign was ready at its last verification, starting the rechecks if needed."""
+        self.start()
+        return self.state.ready
+
+    def _pin_path(self):
+        return f'{self.path}.pin'
+
+    def _install(self):
+        if os.path.exists(self.path):
+            return
+        if not self.install_url:
+            raise ToolchainError(f'zsign binary not found at {self.path}')
+
+        # Several workers may boot at once; only one of them clones
+        target_dir = os.path.dirname(self.path)
+        os.makedirs(os.path.dirname(target_dir) or '/', exist_ok=True)
+        with open(f'{target_dir}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.path):
+                    return
+                clone_dir = tempfile.mkdtemp(dir=os.path.dirname(target_dir), prefix='zsign-clone-')
+                try:
+                    commit = self._fetch(clone_dir)
+                    binary = os.path.join(clone_dir, os.path.basename(self.path))
+                    if not os.path.exists(binary):
+                        raise ToolchainError(f'{self.install_url} does not contain {os.path.basename(self.path)}')
+                    sha256 = file_sha256(binary)
+                    if self.expected_sha256 and sha256 != self.expected_sha256.lower():
+                        raise ToolchainError(f'zsign fetched from {self.install_url} does not match ZSIGN_SHA256')
+                    if not (self.install_ref or self.expected_sha256):
+                        logger.warning(
+                            f'Fetched zsign {commit} ({sha256}) from {self.install_url} unpinned; it is pinned '
+                            f'from now on, and ZSIGN_INSTALL_REF={commit} ZSIGN_SHA256={sha256} pin it for new hosts'
+                        )
+                    # Recorded next to the binary, so a later swap is caught even without ZSIGN_SHA256
+                    with open(os.path.join(clone_dir, f'{os.path.basename(self.path)}.pin'), 'w') as f:
+                        f.write(f'{commit} {sha256}\n')
+                    os.chmod(binary, 0o755)
+                    shutil.rmtree(target_dir, ignore_errors=True)
+                    os.rename(clone_dir, target_dir)
+                except subprocess.CalledProcessError as e:
+                    raise ToolchainError(f'Failed to fetch zsign: {e.stderr.strip()}')
+                finally:
+                    shutil.rmtree(clone_dir, ignore_errors=True)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fetch(self, clone_dir):
+        """Check out ZSIGN_INSTALL_REF, or the default branch if it is unset, and return the commit."""
+        def git(*args):
+            return subprocess.run(['git', '-C', clone_dir, *args],
+                                  check=True, capture_output=True, text=True, timeout=300).stdout.strip()
+
+        if not self.install_ref:
+            git('clone', '--depth', '1', self.install_url, '.')
+            return git('rev-parse', 'HEAD')
+        git('init', '-q')
+        git('fetch', '--depth', '1', self.install_url, self.install_ref)
+        git('checkout', '-q', 'FETCH_HEAD')
+        commit = git('rev-parse', 'HEAD')
+        if commit != self.install_ref.lower():
+            raise ToolchainError(f'{self.install_url} gave commit {commit}, expected ZSIGN_INSTALL_REF {self.install_ref}')
+        return commit
+
+    def _pinned_sha256(self):
+        """ZSIGN_SHA256, or the checksum recorded when the binary was fetched."""
+        if self.expected_sha256:
+            return self.expected_sha256.lower()
+        try:
+            with open(self._pin_path()) as f:
+                return f.read().split()[1]
+        except (OSError, IndexError):
+            return None
+
+    def _verify(self):
+        """Check the binary and return its (stat, sha256, version)."""
+        if not os.access(self.path, os.X_OK):
+            raise ToolchainError(f'zsign at {self.path} is not executable')
+
+        file_stat = self._stat()
+        sha256 = file_sha256(self.path)
+        expected = self._pinned_sha256()
+        if expected and sha256 != expected:
+            raise ToolchainError(f'zsign checksum mismatch: expected {expected}, got {sha256}')
+
+        result = subprocess.run([self.path, '-v'], capture_output=True, text=True, timeout=30)
+        output = (result.stdout or result.stderr).strip()
+        if not output:
+            raise ToolchainError('zsign -v printed no version')
+        return file_stat, sha256, output.splitlines()[0].split(':')[-1].strip()
+
+    def _smoke_sign(self):
+        with tempfile.TemporaryDirectory(prefix='zsign-smoke-') as folder:
+            credentials = write_smoke_credentials(folder)
+            smoke_ipa = self.smoke_ipa or write_smoke_ipa(folder)
+            output_path = os.path.join(folder, 'signed.ipa')
+            sign_ipa(smoke_ipa, credentials['key'], credentials['profile'], None,
+                     output_path, credentials['cert'], zsign_path=self.path, limits=ZsignLimits(timeout=SMOKE_TIMEOUT))
+
+    def require(self):
+        """Return the verified zsign path or raise if the toolchain isn't ready."""
+        state = self.state
+        self.start()
+        if not state.ready:
+            raise ToolchainError(f'Signing toolchain is not ready: {state.error}')
+        return self.path
+
+    def status(self):
+        state = self.state
+        return {
+            'ready': state.ready,
+            'path': self.path,
+            'version': state.version,
+            'sha256': state.sha256,
+            'smoke_test': state.smoke_test,
+            'error': state.error,
+            'checked_at': state.checked_at.isoformat() if state.checked_at else None
+        }
+
+
+toolchain = Toolchain()
@@ -0,0 +1,67 @@
+import json
+import time
+
+# Kept on a job's trace, from the end of zsign's stderr where its error is
+STDERR_LIMIT = 1000
+# Phases of a job as (name, first event, last event)
+PHASES = (
+    ('upload', 'received', 'saved'),
+    ('inspect', 'saved', 'inspected'),
+    ('queue', 'queued', 'started'),
+    ('extract', 'started', 'extracted'),
+    ('zsign', 'zsign_start', 'zsign_end'),
+    ('repack', 'zsign_end', 'repacked'),
+    ('store', 'repacked', 'stored'),
+    ('cleanup', 'stored', 'cleaned')
+)
+
+
+class JobTrace:
+    """Timeline and sizes of one signing job, stored as JSON on SigningJob.trace.
+
+    Events are milliseconds since the request was received, so a slow job
+    shows where its time went: waiting in the queue, extracting, in zsign,
+    repacking or storing the output. Other facts, such as input_bytes or
+    zsign's exit code, are set as plain values next to them.
+    """
+
+    def __init__(self, received=None):
+        self.received = received or time.time()
+        self.events = {'received': 0}
+        self.values = {}
+
+    def mark(self, event, at=None):
+        """Record that event happened now, or at the time.time() value at."""
+        self.events[event] = round(((at or time.time()) - self.received) * 1000)
+
+    def set(self, **values):
+        self.values.update(values)
+
+    def record_zsign(self, usage):
+        """Add a zsign run's ZsignUsage: its start and end, exit code, stderr tail and CPU time."""
+        self.mark('zsign_start', usage.started_at)
+        self.mark('zsign_end', usage.started_at + usage.wall_time)
+        self.set(
+            zsign_exit_code=usage.returncode,
+            zsign_stderr=usage.stderr[-STDERR_LIMIT:] or None,
+            zsign_cpu_time=round(usage.cpu_time, 3),
+            zsign_peak_rss=usage.peak_rss,
+            kill_reason=usage.kill_reason
+        )
+
+    @property
+    def duration(self):
+        """Seconds from the request being received to the last event."""
+        return max(self.events.values()) / 1000
+
+    def to_json(self):
+        return json.dumps(dict(self.values, events=self.events), separators=(',', ':'))
+
+
+def phase_times(events):
+    """Milliseconds spent in each of PHASES whose events are both in a trace's events."""
+    return {
+        name: events[last] - events[first]
+        for name, first, last in PHASES
+        if first in events and last in events
+    }
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import logging
+import tempfile
+import threading
+from flask import Request, current_app
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class HashingSpool:
+    """Named temp file that hashes multipart upload data as Werkzeug writes it.
+
+    Spooling straight into UPLOAD_FOLDER lets save_upload rename the file
+    into place instead of copying it a second time.
+    """
+
+    def __init__(self, folder):
+        self._file = tempfile.NamedTemporaryFile(dir=folder, prefix='spool-', delete=False)
+        self.name = self._file.name
+        self.sha256 = hashlib.sha256()
+        self.claimed = False
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def discard(self):
+        self._file.close()
+        if not self.claimed and os.path.exists(self.name):
+            os.remove(self.name)
+
+
+class UploadRequest(Request):
+    """Request class that spools file uploads through HashingSpool."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = HashingSpool(current_app.config['UPLOAD_FOLDER'])
+        self.__dict__.setdefault('_spools', []).append(spool)
+        return spool
+
+    def close(self):
+        super().close()
+        for spool in self.__dict__.get('_spools', []):
+            spool.discard()
+
+
+def save_upload(file_storage, path):
+    """Move an uploaded file to path and return its SHA-256."""
+    stream = file_storage.stream
+    if isinstance(stream, HashingSpool):
+        stream.flush()
+        os.replace(stream.name, path)
+        stream.claimed = True
+        return stream.sha256.hexdigest()
+
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class UploadStore:
+    """Resumable uploads written in chunks to UPLOAD_FOLDER/sessions.
+
+    Each session is a .part file plus a .json metadata file, so any web
+    worker can resume it. The running SHA-256 is kept in memory and
+    rebuilt from disk when a chunk arrives at a worker that did not see
+    the previous ones.
+    """
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.ttl = 0
+        self._hashers = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = os.path.join(app.config['UPLOAD_FOLDER'], 'sessions')
+        self.ttl = app.config['UPLOAD_SESSION_TTL']
+        os.makedirs(self.folder, exist_ok=True)
+        app.extensions['upload_store'] = self
+
+    def _paths(self, upload_id):
+        base = os.path.join(self.folder, upload_id)
+        return f'{base}.part', f'{base}.json'
+
+    def _write_meta(self, meta):
+        _, meta_path = self._paths(meta['upload_id'])
+        tmp_path = f'{meta_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def create(self, api_key_id, filename, size):
+        self.sweep()
+        upload_id = uuid.uuid4().hex
+        part_path, _ = self._paths(upload_id)
+        open(part_path, 'wb').close()
+        meta = {
+            'upload_id': upload_id,
+            'api_key_id': api_key_id,
+            'filename': filename,
+            'size': size,
+            'offset': 0,
+            'sha256': None,
+            'created_at': time.time()
+        }
+        self._write_meta(meta)
+        return meta
+
+    def get(self, upload_id, api_key_id):
+        if not upload_id or not upload_id.isalnum():
+            return None
+        part_path, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if meta['api_key_id'] != api_key_id:
+            return None
+        meta['offset'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return meta
+
+    def _hasher(self, upload_id, part_path, offset):
+        with self._lock:
+            cached = self._hashers.pop(upload_id, None)
+        if cached and cached[0] == offset:
+            return cached[1]
+
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            remaining = offset
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+        return digest
+
+    def append(self, upload_id, api_key_id, offset, stream):
+        """Append a chunk at offset and return the updated session metadata."""
+        meta = self.get(upload_id, api_key_id)
+        if meta is None:
+            raise UploadError('Upload not found', 404)
+
+        part_path, _ = self._paths(upload_id)
+        with open(part_path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                current = os.fstat(f.fileno()).st_size
+                if offset != current:
+                    raise UploadError('Upload offset mismatch', 409, offset=current)
+
+                digest = self._hasher(upload_id, part_path, current)
+                written = current
+                try:
+                    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                        if written + len(chunk) > meta['size']:
+                            raise UploadError('Upload exceeds declared size', 413, offset=written)
+                        f.write(chunk)
+                        digest.update(chunk)
+                        written += len(chunk)
+                finally:
+                    # Keep whatever arrived so a dropped connection resumes from here
+                    f.flush()
+                    with self._lock:
+                        self._hashers[upload_id] = (written, digest)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        meta['offset'] = written
+        if written == meta['size']:
+            with self._lock:
+                self._hashers.pop(upload_id, None)
+            meta['sha256'] = digest.hexdigest()
+            self._write_meta(meta)
+        return meta
+
+    def claim(self, upload_id, api_key_id, path):
+        """Move a completed upload to path and return its SHA-256."""
+        meta = self.get(upload_id, api_key_id)
+        if meta is None or meta['sha256'] is None:
+            raise UploadError('Upload not found or incomplete', 400)
+        part_path, meta_path = self._paths(upload_id)
+        os.replace(part_path, path)
+        os.remove(meta_path)
+        return meta['sha256']
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.folder):
+            if not entry.name.endswith('.json'):
+                continue
+            part_path, meta_path = self._paths(entry.name[:-len('.json')])
+            try:
+                # The .part file is touched by every chunk, so active uploads survive
+                last_write = os.stat(part_path if os.path.exists(part_path) else meta_path).st_mtime
+                if last_write >= cutoff:
+                    continue
+                for path in (part_path, meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+            except FileNotFoundError:
+                continue
+
+
+upload_store = UploadStore()
@@ -0,0 +1,311 @@
+import hmac
+import json
+import time
+import random
+import socket
+import hashlib
+import logging
+import secrets
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from models import WebhookDelivery, db
+
+logger = logging.getLogger(__name__)
+
+MAX_URL_LENGTH = 2048
+PRIVATE_ERROR = 'Webhook URL must not point to a loopback, private or link-local address'
+
+
+def url_error(url):
+    """Return why url cannot receive webhooks, or None if it can.
+
+    Runs inside the request that sets the URL, so it never resolves the
+    host; a name is checked each time a delivery connects to it.
+    """
+    if not isinstance(url, str) or len(url) > MAX_URL_LENGTH:
+        return 'Webhook URL must be a string of at most 2048 characters'
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return 'Webhook URL must be an absolute http or https URL'
+    if webhooks.allow_private:
+        return None
+    host = parsed.hostname.rstrip('.')
+    if host == 'localhost' or host.endswith('.localhost'):
+        return PRIVATE_ERROR
+    try:
+        return address_error(ipaddress.ip_address(host))
+    except ValueError:
+        return None
+
+
+def address_error(address):
+    """Return why address must not receive webhooks, or None if it is global.
+
+    Keeps webhooks from being pointed at loopback, private networks or a
+    cloud metadata endpoint, unless WEBHOOK_ALLOW_PRIVATE is set.
+    """
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    if not address.is_global:
+        return PRIVATE_ERROR
+    return None
+
+
+def resolve(host):
+    """Resolve host and return (address, error), with error None when every address it has is global."""
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return None, f'Webhook host {host} does not resolve'
+    addresses = [ipaddress.ip_address(info[4][0].split('%')[0]) for info in infos]
+    for address in addresses:
+        error = address_error(address)
+        if error:
+            return None, error
+    return str(addresses[0]), None
+
+
+class PinnedAdapter(HTTPAdapter):
+    """Connects to the address resolve() checked, not to whatever the name resolves to next.
+
+    Checking the host and then letting the connection resolve it again
+    would let a name be rebound to a private address in between. The URL,
+    Host header, SNI and certificate check all keep the original name.
+    """
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        host = host_params['host']
+        address, error = resolve(host)
+        if error:
+            raise requests.ConnectionError(error, request=request)
+        host_params['host'] = address
+        if host_params['scheme'] == 'https':
+            pool_kwargs['server_hostname'] = host
+            pool_kwargs['assert_hostname'] = host
+        return host_params, pool_kwargs
+
+    def add_headers(self, request, **kwargs):
+        # Otherwise the Host header would name the address connected to
+        request.headers.setdefault('Host', urlparse(request.url).netloc.rpartition('@')[2])
+
+
+def new_secret():
+    return secrets.token_hex(32)
+
+
+def signature(secret, timestamp, body):
+    """HMAC-SHA256 over "<timestamp>.<body>", as sent in X-Webhook-Signature."""
+    message = f'{timestamp}.'.encode() + body
+    return 'sha256=' + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def job_payload(job):
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'input_file': job.input_file,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'completed_at': job.completed_at.isoformat() if job.completed_at else None,
+        'cache_hit': job.cache_hit,
+        'error': job.error_message
+    }
+
+
+def enqueue_delivery(job):
+    """Record a delivery for a job that just finished; the caller commits.
+
+    The delivery row is written in the same transaction as the job's final
+    status, so a crash can lose neither one without the other.
+    """
+    api_key = job.api_key
+    url = job.callback_url or api_key.webhook_url
+    if not url:
+        return None
+    if not api_key.webhook_secret:
+        api_key.webhook_secret = new_secret()
+
+    event = f'job.{job.status}'
+    delivery = WebhookDelivery(api_key_id=api_key.id, job_id=job.id, url=url, event=event, payload='')
+    db.session.add(delivery)
+    db.session.flush()
+    delivery.payload = json.dumps({
+        'id': delivery.id,
+        'event': event,
+        'job': job_payload(job)
+    })
+    return delivery
+
+
+class WebhookDispatcher:
+    """Sends pending webhook deliveries from a background thread.
+
+    Deliveries live in the database, so retries survive restarts and any
+    process may send them. A delivery is claimed by pushing its
+    next_attempt_at past the send timeout, which keeps two processes from
+    sending it at once. Failed attempts back off exponentially up to
+    WEBHOOK_MAX_ATTEMPTS. The host is resolved and checked on every
+    attempt, since what a name points to can change after it was
+    registered, and the request goes to the address that was checked.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.timeout = 10
+        self.max_attempts = 8
+        self.backoff = 30
+        self.max_backoff = 6 * 60 * 60
+        self.poll_interval = 5
+        self.concurrency = 4
+        self.allow_private = False
+        # requests.Session is not thread-safe, so each sending thread has its own
+        self._local = threading.local()
+        self._sessions = []
+        self._pool = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.timeout = app.config['WEBHOOK_TIMEOUT']
+        self.max_attempts = app.config['WEBHOOK_MAX_ATTEMPTS']
+        self.backoff = app.config['WEBHOOK_BACKOFF']
+        self.max_backoff = app.config['WEBHOOK_MAX_BACKOFF']
+        self.poll_interval = app.config['WEBHOOK_POLL_INTERVAL']
+        self.concurrency = max(1, app.config['WEBHOOK_CONCURRENCY'])
+        self.allow_private = app.config['WEBHOOK_ALLOW_PRIVATE']
+        app.extensions['webhooks'] = self
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='webhook-send')
+            self._thread = threading.Thread(target=self._run, name='webhook-dispatch', daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """Wake the dispatcher after committing new deliveries."""
+        self.start()
+        self._wake.set()
+
+    def shutdown(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stopped.set()
+            self._wake.set()
+            self._thread.join()
+            self._pool.shutdown(wait=True)
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                delay = self.deliver_due()
+            except Exception:
+                logger.exception('Webhook dispatcher failed')
+                delay = self.poll_interval
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def retry_delay(self, attempts):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        # Jitter keeps a receiver that comes back up from being hit by every retry at once
+        return delay * random.uniform(0.8, 1.2)
+
+    def deliver_due(self):
+        """Send every delivery that is due and return the seconds until the next one."""
+        with self.app.app_context():
+            now = datetime.utcnow()
+            due = WebhookDelivery.query.filter(
+                WebhookDelivery.status == 'pending',
+                WebhookDelivery.next_attempt_at <= now
+            ).order_by(WebhookDelivery.next_attempt_at).limit(self.concurrency * 4).all()
+
+            lease = now + timedelta(seconds=self.timeout + 30)
+            claimed = []
+            for delivery in due:
+                if WebhookDelivery.query.filter_by(
+                    id=delivery.id, status='pending', next_attempt_at=delivery.next_attempt_at
+                ).update({WebhookDelivery.next_attempt_at: lease}, synchronize_session=False):
+                    claimed.append((delivery.id, delivery.url, delivery.payload, delivery.api_key.webhook_secret))
+            db.session.commit()
+
+        results = list(self._pool.map(lambda c: self._send(*c[1:]), claimed))
+
+        with self.app.app_context():
+            for (delivery_id, *_), (status_code, error) in zip(claimed, results):
+                delivery = db.session.get(WebhookDelivery, delivery_id)
+                delivery.attempts += 1
+                delivery.last_status_code = status_code
+                delivery.last_error = error
+                if error is None:
+                    delivery.status = 'delivered'
+                    delivery.delivered_at = datetime.utcnow()
+                elif delivery.attempts >= self.max_attempts:
+                    delivery.status = 'failed'
+                    logger.warning(f'Giving up on webhook delivery {delivery_id} after {delivery.attempts} attempts: {error}')
+                else:
+                    delivery.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.retry_delay(delivery.attempts))
+            db.session.commit()
+
+            if len(claimed) == self.concurrency * 4:
+                return 0
+            upcoming = db.session.query(db.func.min(WebhookDelivery.next_attempt_at)).filter(
+                WebhookDelivery.status == 'pending'
+            ).scalar()
+        if upcoming is None:
+            return self.poll_interval
+        return min(self.poll_interval, max(0, (upcoming - datetime.utcnow()).total_seconds()))
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            if not self.allow_private:
+                # A proxy from the environment would resolve the host again itself
+                session.trust_env = False
+                session.mount('http://', PinnedAdapter())
+                session.mount('https://', PinnedAdapter())
+            self._sessions.append(session)
+        return session
+
+    def _send(self, url, payload, secret):
+        """POST one delivery; returns (status code, error), with error None on a 2xx."""
+        body = payload.encode()
+        timestamp = str(int(time.time()))
+        delivery_id = json.loads(payload)['id']
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': 'zsign-webhooks',
+            'X-Webhook-Id': str(delivery_id),
+            'X-Webhook-Timestamp': timestamp,
+            'X-Webhook-Signature': signature(secret, timestamp, body)
+        }
+        try:
+            response = self._session().post(url, data=body, headers=headers, timeout=self.timeout, allow_redirects=False)
+        except requests.RequestException as e:
+            return None, str(e)[:500]
+        if 200 <= response.status_code < 300:
+            return response.status_code, None
+        return response.status_code, f'HTTP {response.status_code}'
+
+
+webhooks = WebhookDispatcher()
@@ -0,0 +1,96 @@
+import os
+import re
+import shutil
+import tempfile
+
+# job-<pid>-xxxx: the pid of the process that made a workspace and cleans it up
+WORKSPACE_NAME = re.compile(r'^(?:job|test|batch)-(\d+)-')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_orphaned_workspaces(root):
+    """Delete the workspaces under root whose process is no longer running; returns how many."""
+    removed = 0
+    if not os.path.isdir(root):
+        return removed
+    for entry in os.scandir(root):
+        match = WORKSPACE_NAME.match(entry.name)
+        if match and entry.is_dir() and not _alive(int(match.group(1))):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class Workspace:
+    """Private directory holding one job's inputs and output.
+
+    Every job gets its own directory under UPLOAD_FOLDER with fixed file
+    names inside it, so concurrent jobs never share a path no matter what
+    the uploaded files were called. The directory is named after the
+    process that owns it, so another one can tell when it was left behind.
+    """
+
+    IPA = 'app.ipa'
+    P12 = 'cert.p12'
+    MOBILEPROVISION = 'profile.mobileprovision'
+    KEY = 'key.pem'
+    CERT = 'cert.pem'
+    OUTPUT = 'signed.ipa'
+
+    def __init__(self, root, prefix='job-'):
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(dir=root, prefix=f'{prefix}{os.getpid()}-')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def ipa_path(self):
+        return self.file(self.IPA)
+
+    @property
+    def p12_path(self):
+        return self.file(self.P12)
+
+    @property
+    def prov_path(self):
+        return self.file(self.MOBILEPROVISION)
+
+    @property
+    def key_path(self):
+        return self.file(self.KEY)
+
+    @property
+    def cert_path(self):
+        return self.file(self.CERT)
+
+    @property
+    def output_path(self):
+        return self.file(self.OUTPUT)
+
+    def link(self, source, name):
+        """Put a staged file into the workspace, hard-linking when possible to avoid a copy."""
+        dest = self.file(name)
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copyfile(source, dest)
+        return dest
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,4 @@
+from app import create_app
+
+# Loaded once by the gunicorn master (preload_app) and inherited by every worker
+app = create_app()